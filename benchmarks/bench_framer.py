@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+"""Compare message_iterator throughput against the old join+regex framer.
+
+Feeds the same synthetic stream, cut into recv-sized chunks, through
+both implementations and prints lines/sec and MB/sec for each.
+"""
+import argparse
+import logging
+import time
+from otp22logbot import protocol
+
+
+def legacy_message_iterator(logger):
+    """The framer message_iterator used before LineFramer."""
+    messages = []
+    old_data = b''
+    while True:
+        new_data = yield messages
+        if new_data:
+            all_data = b"".join([old_data, new_data])
+            messages, old_data = protocol.parse_messages(all_data, logger)
+
+
+def make_stream(count):
+    lines = []
+    for i in range(count):
+        if i % 50 == 0:
+            # NAMES burst style reply, close to the size limit
+            lines.append(
+                b":irc.example.net 353 otp22logbot = #ircugm :" +
+                b" ".join(b"nick" + str(n).encode() for n in range(60)))
+        else:
+            lines.append(
+                b":nick" + str(i % 300).encode() +
+                b"!~user@host.example.net PRIVMSG #ircugm :message number " +
+                str(i).encode())
+    return b"\r\n".join(lines) + b"\r\n"
+
+
+def chunks(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def run(factory, pieces, logger):
+    it = factory(logger)
+    it.send(None)
+    count = 0
+    start = time.perf_counter()
+    for piece in pieces:
+        count += len(it.send(piece))
+    return count, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--lines', type=int, default=200000)
+    parser.add_argument('--chunk', type=int, action='append',
+                        help='bytes per simulated recv (repeatable)')
+    args = parser.parse_args()
+    logger = logging.getLogger("bench")
+    data = make_stream(args.lines)
+    megabytes = len(data) / 1e6
+    for size in args.chunk or [256, 1024, 4096, 65536]:
+        pieces = chunks(data, size)
+        for name, factory in [('legacy', legacy_message_iterator),
+                              ('framer', protocol.message_iterator)]:
+            count, elapsed = run(factory, pieces, logger)
+            print("chunk {0:6d} {1:8s} {2:8d} lines {3:10.0f} lines/s "
+                  "{4:8.1f} MB/s"
+                  .format(size, name, count, count / elapsed,
+                          megabytes / elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/python3
+"""Compare handling PRIVMSGs as plain tuples against Message objects.
+
+The legacy path decodes the prefix, targets and text separately for
+logging, the archive, the binary log and command lookup, the way
+Bot.handle used to. The Message path decodes each part once and
+shares it. Prints decode calls per PRIVMSG, time per message and the
+tracemalloc peak for each.
+"""
+import argparse
+import time
+import tracemalloc
+from otp22logbot import protocol
+
+
+class Counter(object):
+    """Wraps a decode function, counting calls.
+    """
+
+    def __init__(self, function):
+        self.function = function
+        self.calls = 0
+
+    def __call__(self, *args):
+        self.calls += 1
+        return self.function(*args)
+
+
+def make_lines(count, tagged):
+    lines = []
+    for i in range(count):
+        line = (b":nick" + str(i % 300).encode() +
+                b"!~user@host.example.net PRIVMSG #ircugm :message number " +
+                str(i).encode() + b"\r\n")
+        if tagged:
+            line = (b"@time=2013-03-07T18:02:11.123Z;account=nick" +
+                    str(i % 300).encode() + b" " + line)
+        lines.append(line)
+    return lines
+
+
+def legacy(lines, decode):
+    """Roughly what Bot.handle did per PRIVMSG before Message.
+    """
+    for line in lines:
+        prefix, command, params = protocol.parse_message(line)
+        targets, text = protocol.parse_privmsg(params)
+        requester = decode(prefix.split(b"!", 1)[0], "ascii")
+        # format_message
+        logged = (decode(b",".join(targets), "utf-8"),
+                  decode(text, "utf-8"))
+        # binary log
+        segment = ([decode(target, "utf-8") for target in targets],
+                   decode(text, "utf-8"))
+        # archive
+        archive = (decode(b",".join(targets), "utf-8"),
+                   decode(text, "utf-8"))
+        # channel list for sharding
+        channels = [decode(target, "ascii") for target in targets
+                    if target[:1] == b"#"]
+        # resolve
+        prefix = decode(prefix, "ascii")
+        command_targets = [decode(target, "ascii") for target in targets]
+        args = [decode(arg, "ascii") for arg in text.split(b" ", 1)]
+        (requester, logged, segment, archive, channels, prefix,
+         command_targets, args)
+
+
+def with_message(lines):
+    for line in lines:
+        message = protocol.Message.parse(line)
+        requester = message.nick
+        targets = message.targets
+        text = message.text
+        when = message.time
+        channels = [target for target in targets if target[:1] == "#"]
+        args = text.split(" ", 1)
+        (requester, when, channels, args)
+
+
+def measure(run):
+    start = time.perf_counter()
+    run()
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--tagged', action='store_true',
+                        help='prefix each line with server-time tags')
+    args = parser.parse_args()
+    lines = make_lines(args.messages, args.tagged)
+    if args.tagged:
+        # The old parse_message had no idea about tags
+        untagged = [protocol.split_tags(line)[1] for line in lines]
+    else:
+        untagged = lines
+
+    counter = Counter(lambda data, encoding: data.decode(encoding))
+    legacy(untagged[:1000], counter)
+    legacy_calls = counter.calls / 1000.0
+
+    real = protocol.decode
+    counter = Counter(real)
+    protocol.decode = counter
+    try:
+        with_message(lines[:1000])
+    finally:
+        protocol.decode = real
+    message_calls = counter.calls / 1000.0
+
+    plain = Counter(lambda data, encoding: data.decode(encoding))
+    for name, run, calls in [
+            ('legacy', lambda: legacy(untagged, plain), legacy_calls),
+            ('message', lambda: with_message(lines), message_calls)]:
+        elapsed, peak = measure(run)
+        print("{0:8s} {1:5.1f} decodes/msg {2:8.2f} us/msg "
+              "{3:10d} bytes peak"
+              .format(name, calls, elapsed / args.messages * 1e6, peak))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+#!/usr/bin/python3
+"""Replay IRC traffic through the whole ingest pipeline at full speed.
+
+Feeds synthetic (or recorded, with --replay) server traffic through a
+Connection on a fake socket into Bot: framing, Bot.handle,
+format_message, file_send, dispatch and the user registry. Reports
+messages/sec for an uninstrumented Bot.loop run, then time per stage
+and p50/p99 latency per message from an instrumented run, and can
+write everything as JSON (--json) for comparing runs.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from otp22logbot import metrics
+from otp22logbot.bot import Bot
+from otp22logbot.connection import Connection
+from otp22logbot.main import make_parser
+
+WORDS = ("the a to of and is it that you in for on this with be not "
+         "have are was just but what so like can do all if get").split()
+
+
+def make_traffic(count, seed=22):
+    """Bytes of server traffic with count lines of mixed messages.
+    """
+    rng = random.Random(seed)
+    nicks = ['user{0}'.format(i) for i in range(500)]
+    lines = []
+    while len(lines) < count:
+        nick = rng.choice(nicks)
+        prefix = ':{0}!~{0}@host-{1}.example.net'.format(
+            nick, rng.randint(0, 999))
+        roll = rng.random()
+        if roll < 0.70:
+            text = " ".join(rng.choice(WORDS)
+                            for _ in range(rng.randint(1, 20)))
+            lines.append('{0} PRIVMSG #ircugm :{1}'.format(prefix, text))
+        elif roll < 0.78:
+            lines.append('{0} JOIN #ircugm'.format(prefix))
+        elif roll < 0.86:
+            lines.append('{0} PART #ircugm :bye'.format(prefix))
+        elif roll < 0.88:
+            # NAMES burst, as after a join or netsplit
+            for _ in range(20):
+                names = " ".join(rng.sample(nicks, 40))
+                lines.append(':irc.example.net 353 otp22logbot = #ircugm :'
+                             + names)
+            lines.append(':irc.example.net 366 otp22logbot #ircugm '
+                         ':End of /NAMES list.')
+        elif roll < 0.93:
+            command = rng.choice(['.version', '.last', '.user',
+                                  '.last ' + rng.choice(nicks), '.help'])
+            lines.append('{0} PRIVMSG #ircugm :{1}'.format(prefix, command))
+        elif roll < 0.95:
+            lines.append('PING :irc.example.net')
+        elif roll < 0.97:
+            lines.append('{0} PRIVMSG #ircugm :{1}'.format(
+                prefix, 'x' * 600))
+        else:
+            lines.append(':malformed-prefix-without-command')
+    return ('\r\n'.join(lines[:count]) + '\r\n').encode('utf-8')
+
+
+class FakeSocket(object):
+    """Hands out the traffic like a socket would, size bytes at a time.
+    """
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.pos = 0
+        self.sent = 0
+
+    def recv(self, size):
+        chunk = self.data[self.pos:self.pos + size].tobytes()
+        self.pos += len(chunk)
+        return chunk
+
+    def sendall(self, data):
+        self.sent += len(data)
+
+    def shutdown(self, how):
+        pass
+
+    def close(self):
+        pass
+
+
+class Timer(object):
+    """Wraps a callable and accumulates the time spent in it.
+    """
+    def __init__(self, function):
+        self.function = function
+        self.elapsed = 0.0
+        self.calls = 0
+
+    def __call__(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self.function(*args, **kwargs)
+        finally:
+            self.elapsed += time.perf_counter() - start
+            self.calls += 1
+
+
+def make_bot(directory, logger):
+    app_args = make_parser().parse_args([
+        '-o', os.path.join(directory, 'bench.log'), '--flood-rate', '0'])
+    bot = Bot(app_args, logger)
+    bot.writer.start()
+    return bot
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def run_loop(data, directory, logger):
+    """Plain Bot.loop over the traffic; the number to watch.
+
+    Bot.loop always reads 1024 bytes at a time.
+    """
+    bot = make_bot(directory, logger)
+    conn = Connection(FakeSocket(data), logger)
+    start = time.perf_counter()
+    bot.loop(conn)
+    if bot.pool:
+        bot.pool.close()
+    bot.writer.close()
+    return time.perf_counter() - start
+
+
+def run_instrumented(data, directory, logger, recv_size):
+    bot = make_bot(directory, logger)
+    stages = {
+        'format_message': Timer(bot.format_message),
+        'file_send': Timer(bot.file_send),
+        'dispatch': Timer(bot.dispatch),
+        'users.touch': Timer(bot.users.touch),
+    }
+    bot.format_message = stages['format_message']
+    bot.file_send = stages['file_send']
+    bot.dispatch = stages['dispatch']
+    bot.users.touch = stages['users.touch']
+    sock = FakeSocket(data)
+    conn = Connection(sock, logger)
+    it = bot.message_iterator()
+    framing = 0.0
+    handling = 0.0
+    latencies = []
+    clock = time.perf_counter
+    while True:
+        chunk = conn.recv(recv_size)
+        if not chunk:
+            break
+        start = clock()
+        messages = it.send(chunk)
+        framing += clock() - start
+        for message in messages:
+            start = clock()
+            bot.handle(conn, message)
+            elapsed = clock() - start
+            handling += elapsed
+            latencies.append(elapsed)
+    start = clock()
+    if bot.pool:
+        bot.pool.close()
+    bot.writer.close()
+    drain = clock() - start
+    latencies.sort()
+    result = {
+        'messages': len(latencies),
+        'stages_s': dict(
+            [('framing', framing), ('handle', handling),
+             ('writer_drain', drain)] +
+            [(name, timer.elapsed) for name, timer in stages.items()]),
+        'latency_us': {
+            'p50': percentile(latencies, 0.50) * 1e6,
+            'p99': percentile(latencies, 0.99) * 1e6,
+            'max': (latencies[-1] if latencies else 0.0) * 1e6,
+        },
+        'bytes_sent': sock.sent,
+    }
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--lines', type=int, default=200000,
+                        help='lines of synthetic traffic')
+    parser.add_argument('--replay', type=argparse.FileType('rb'),
+                        help='raw server traffic to replay instead')
+    parser.add_argument('--recv-size', type=int, default=1024,
+                        help='bytes per read in the instrumented run')
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('--metrics', action='store_true',
+                        help='run with metrics collection enabled')
+    args = parser.parse_args()
+    if args.metrics:
+        metrics.enable()
+    data = args.replay.read() if args.replay else make_traffic(args.lines)
+    logger = logging.getLogger("bench")
+    logger.setLevel(logging.CRITICAL)
+    logger.propagate = False
+    directory = tempfile.mkdtemp(prefix='otp22bench')
+    try:
+        loop_time = run_loop(data, directory, logger)
+        result = run_instrumented(data, directory, logger, args.recv_size)
+    finally:
+        shutil.rmtree(directory)
+    result.update({
+        'bytes': len(data),
+        'loop_s': loop_time,
+        'msgs_per_s': result['messages'] / loop_time,
+        'metrics': metrics.enabled,
+        'python': platform.python_version(),
+        'time': time.time(),
+    })
+    print("{0} messages, {1:.0f} msgs/s through Bot.loop".format(
+        result['messages'], result['msgs_per_s']))
+    for name, elapsed in sorted(result['stages_s'].items(),
+                                key=lambda item: -item[1]):
+        print("  {0:15s} {1:8.3f} s".format(name, elapsed))
+    print("  latency p50 {p50:.1f} us, p99 {p99:.1f} us, max {max:.1f} us"
+          .format(**result['latency_us']))
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump(result, out, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
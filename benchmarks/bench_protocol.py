@@ -0,0 +1,199 @@
+#!/usr/bin/python3
+"""Micro-benchmarks for the protocol module, checked against a baseline.
+
+Times parse_message, parse_messages, parse_privmsg, Message.parse and
+message_iterator on synthetic traffic, over several rounds each, and
+compares throughput with the stored baseline. Exits with status 1 if
+any of them is more than --threshold slower, so it can gate a change.
+
+Throughput is recorded relative to a fixed pure Python workload timed
+in the same run, which takes most of the difference between machines
+out of the comparison; the baseline still only means much on the
+Python version it was made with. Use --save to record a new one.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import time
+from otp22logbot import protocol
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'baselines', 'protocol.json')
+
+
+def make_lines(count):
+    lines = []
+    for i in range(count):
+        if i % 50 == 0:
+            lines.append(
+                b":irc.example.net 353 otp22logbot = #ircugm :" +
+                b" ".join(b"nick" + str(n).encode() for n in range(60)) +
+                b"\r\n")
+        else:
+            lines.append(
+                b":nick" + str(i % 300).encode() +
+                b"!~user@host.example.net PRIVMSG #ircugm :message number " +
+                str(i).encode() + b" with a few more words in it\r\n")
+    return lines
+
+
+def calibration(count):
+    """Plain interpreter work: the yardstick for everything else.
+    """
+    total = 0
+    table = {}
+    for i in range(count):
+        key = i & 255
+        table[key] = table.get(key, 0) + i
+        total += len(str(key))
+    return total
+
+
+def cases(lines, logger):
+    """(name, function, operations per call) to time.
+    """
+    line = lines[1]
+    params = protocol.parse_message(line)[2]
+    blob = b"".join(lines[:100])
+    stream = b"".join(lines)
+    chunks = [stream[i:i + 1024] for i in range(0, len(stream), 1024)]
+
+    def parse_message():
+        for _ in range(1000):
+            protocol.parse_message(line)
+
+    def parse_messages():
+        protocol.parse_messages(blob, logger)
+
+    def parse_privmsg():
+        for _ in range(1000):
+            protocol.parse_privmsg(params)
+
+    def message_parse():
+        for _ in range(1000):
+            protocol.Message.parse(line)
+
+    def message_iterator():
+        it = protocol.message_iterator(logger)
+        it.send(None)
+        for chunk in chunks:
+            it.send(chunk)
+
+    return [
+        ('calibration', lambda: calibration(10000), 10000),
+        ('parse_message', parse_message, 1000),
+        ('parse_messages', parse_messages, 100),
+        ('parse_privmsg', parse_privmsg, 1000),
+        ('Message.parse', message_parse, 1000),
+        ('message_iterator', message_iterator, len(lines)),
+    ]
+
+
+def repeats(function, min_time=0.05):
+    """How many calls in a row take at least min_time.
+    """
+    repeat = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            function()
+        if time.perf_counter() - start >= min_time:
+            return repeat
+        repeat *= 2
+
+
+def rate(function, operations, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return operations * repeat / (time.perf_counter() - start)
+
+
+def run(rounds):
+    """{name: {'per_s': rate, 'relative': rate / yardstick}}, medians.
+
+    Each timing is paired with a timing of the yardstick just before
+    it, so a machine that slows down for a moment slows both, and the
+    median of the rounds is kept, so one lucky or unlucky round can't
+    set the baseline.
+    """
+    logger = logging.getLogger("bench")
+    logger.disabled = True
+    measured = cases(make_lines(2000), logger)
+    _, yardstick, yardstick_operations = measured.pop(0)
+    yardstick_repeat = repeats(yardstick)
+    results = {}
+    for name, function, operations in measured:
+        repeat = repeats(function)
+        rates = []
+        relatives = []
+        for _ in range(rounds):
+            base = rate(yardstick, yardstick_operations, yardstick_repeat)
+            rates.append(rate(function, operations, repeat))
+            relatives.append(rates[-1] / base)
+        results[name] = {'per_s': statistics.median(rates),
+                         'relative': statistics.median(relatives)}
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Print each result against the baseline; True if none regressed.
+    """
+    ok = True
+    for name, result in sorted(results.items()):
+        line = "{0:18s} {1:12.0f} ops/s".format(name, result['per_s'])
+        expected = baseline.get('results', {}).get(name)
+        if expected:
+            change = result['relative'] / expected['relative'] - 1
+            line += "  {0:+6.1%} vs baseline".format(change)
+            if change < -threshold:
+                line += "  REGRESSED"
+                ok = False
+        print(line)
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rounds', type=int, default=9,
+                        help='timings per benchmark; the median is kept')
+    parser.add_argument('--baseline', default=BASELINE,
+                        help='baseline file to compare with or save to')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='fraction slower than the baseline that '
+                             'counts as a regression')
+    parser.add_argument('--save', action='store_true',
+                        help='record these results as the new baseline')
+    args = parser.parse_args()
+    results = run(args.rounds)
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as source:
+            baseline = json.load(source)
+        if baseline.get('python') != platform.python_version():
+            print("note: baseline is from Python {0}, this is {1}".format(
+                baseline.get('python'), platform.python_version()))
+    ok = compare(results, baseline, args.threshold)
+    if args.save:
+        directory = os.path.dirname(args.baseline)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(args.baseline, 'w') as out:
+            json.dump({'python': platform.python_version(),
+                       'time': time.time(), 'results': results},
+                      out, indent=2, sort_keys=True)
+            out.write('\n')
+        return 0
+    if not ok:
+        print("throughput regressed by more than {0:.0%}"
+              .format(args.threshold))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+"""Compare blocking recv(1024) against selector driven recv_into.
+
+Pushes synthetic server traffic through a socket pair in bursts and
+reads it back the way Bot.loop does (Connection.recv, 1024 bytes at a
+time) and the way Bot.select_loop does (a selector, then recv_into a
+ReceiveBuffer until the socket is drained), framing and parsing it in
+both cases. Prints system calls on the reading side, reads per
+kilobyte, MB/s and lines/s for each.
+"""
+import argparse
+import logging
+import socket
+import threading
+import time
+from bench_pipeline import make_traffic
+from otp22logbot import protocol
+from otp22logbot.connection import Connection
+from otp22logbot.reactor import Reactor
+
+
+def send_bursts(sock, data, burst, pause):
+    view = memoryview(data)
+    for start in range(0, len(data), burst):
+        sock.sendall(view[start:start + burst])
+        if pause:
+            time.sleep(pause)
+    sock.close()
+
+
+def read_blocking(conn, it):
+    calls = lines = 0
+    while True:
+        calls += 1
+        received = conn.recv(1024)
+        if not received:
+            return calls, lines
+        lines += len(it.send(received))
+
+
+def read_selector(conn, it):
+    counts = {'calls': 0, 'lines': 0, 'done': False}
+    reactor = Reactor()
+
+    def readable():
+        while True:
+            counts['calls'] += 1
+            received = conn.recv_into()
+            if received is None:
+                return
+            if not received:
+                counts['done'] = True
+                return
+            counts['lines'] += len(it.send(received))
+
+    conn.set_nonblocking()
+    reactor.register(conn.sock, readable)
+    while not counts['done']:
+        # One select per wakeup.
+        counts['calls'] += 1
+        reactor.run_once()
+    reactor.close()
+    return counts['calls'], counts['lines']
+
+
+def run(read, data, burst, pause, logger):
+    ours, theirs = socket.socketpair()
+    sender = threading.Thread(
+        target=send_bursts, args=(theirs, data, burst, pause))
+    conn = Connection(ours, logger)
+    it = protocol.message_iterator(logger)
+    it.send(None)
+    start = time.perf_counter()
+    sender.start()
+    calls, lines = read(conn, it)
+    elapsed = time.perf_counter() - start
+    sender.join()
+    ours.close()
+    return calls, lines, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--lines', type=int, default=200000,
+                        help='lines of synthetic traffic')
+    parser.add_argument('--burst', type=int, action='append',
+                        help='bytes sent at once (repeatable)')
+    parser.add_argument('--pause', type=float, default=0.0,
+                        help='seconds between bursts')
+    args = parser.parse_args()
+    logger = logging.getLogger("bench")
+    logger.setLevel(logging.CRITICAL)
+    logger.propagate = False
+    data = make_traffic(args.lines)
+    megabytes = len(data) / 1e6
+    for burst in args.burst or [4096, 100 * 1024]:
+        for name, read in [('recv', read_blocking),
+                           ('recv_into', read_selector)]:
+            calls, lines, elapsed = run(read, data, burst, args.pause,
+                                        logger)
+            print("burst {0:7d} {1:10s} {2:8d} syscalls {3:6.2f}/KB "
+                  "{4:8.1f} MB/s {5:10.0f} lines/s".format(
+                      burst, name, calls, calls * 1000.0 / len(data),
+                      megabytes / elapsed, lines / elapsed))
+
+
+if __name__ == "__main__":
+    main()
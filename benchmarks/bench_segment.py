@@ -0,0 +1,78 @@
+#!/usr/bin/python3
+"""Compare the binary segment format with the text log.
+
+Reports bytes per message and write/read throughput for a synthetic
+day of channel traffic.
+"""
+import argparse
+import datetime
+import io
+import random
+import time
+from otp22logbot.segment import (
+    SegmentWriter, format_record, parse_text, read_segment)
+
+
+WORDS = ("the a to of and is it that you in for on this with be not "
+         "have are was just but what so like can do all if get").split()
+
+
+def make_records(count, seed=22):
+    rng = random.Random(seed)
+    nicks = ['user{0}'.format(i) for i in range(200)]
+    channels = ['#ircugm', '#otp22', '#crypto']
+    when = 86400.0 * 16000
+    records = []
+    for _ in range(count):
+        when += rng.expovariate(1 / 0.8)
+        text = " ".join(rng.choice(WORDS)
+                        for _ in range(rng.randint(1, 15)))
+        records.append((round(when, 3), rng.choice(nicks),
+                        [rng.choice(channels)], text))
+    return records
+
+
+def timed(function):
+    start = time.perf_counter()
+    result = function()
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=200000)
+    args = parser.parse_args()
+    records = make_records(args.messages)
+    count = float(len(records))
+
+    def write_text():
+        out = io.StringIO()
+        for record in records:
+            out.write(format_record(*record) + '\n')
+        return out.getvalue().encode('utf-8')
+
+    def write_binary():
+        out = io.BytesIO()
+        writer = SegmentWriter(out.write)
+        for record in records:
+            writer.append(*record)
+        writer.close()
+        return out.getvalue()
+
+    text, text_write = timed(write_text)
+    binary, binary_write = timed(write_binary)
+    date = datetime.datetime.utcfromtimestamp(records[0][0]).date()
+    _, text_read = timed(lambda: sum(
+        1 for _ in parse_text(io.StringIO(text.decode('utf-8')), date)))
+    _, binary_read = timed(lambda: sum(1 for _ in read_segment(binary)))
+
+    for name, data, write, read in [
+            ('text', text, text_write, text_read),
+            ('binary', binary, binary_write, binary_read)]:
+        print("{0:7s} {1:6.1f} bytes/msg  write {2:9.0f} msg/s  "
+              "read {3:9.0f} msg/s".format(
+                  name, len(data) / count, count / write, count / read))
+
+
+if __name__ == "__main__":
+    main()
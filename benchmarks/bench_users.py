@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+"""Measure memory per user for the old and the slotted User records.
+
+Builds a registry of synthetic users the way Bot does on PRIVMSG and
+reports traced bytes per user, using tracemalloc.
+"""
+import argparse
+import time
+import tracemalloc
+from datetime import datetime as Datetime
+from otp22logbot.user import UserRegistry
+
+
+class LegacyUser(object):
+    """User as it was before __slots__ and interning."""
+    def __init__(self, nick):
+        self.nicks = set([nick])
+        self.channels = set()
+        self.message = None
+        self.seen = None
+        self.time = None
+
+    def update(self, channels=None, message=None, now=None):
+        now = now or Datetime.utcnow()
+        if channels:
+            self.channels |= set(channels)
+        if message:
+            self.message = message
+        self.seen = now
+        self.time = now
+
+
+def channel_names(count):
+    # Decoded from the wire each time, so equal but distinct strings.
+    return [b"#channel".decode("ascii") + str(i % 20) for i in range(count)]
+
+
+def build_legacy(count, message):
+    users = {}
+    channels = channel_names(count)
+    for i in range(count):
+        nick = b"user".decode("ascii") + str(i)
+        user = users.get(nick) or LegacyUser(nick)
+        users[nick] = user
+        user.update(channels=[channels[i]], message=message,
+                    now=Datetime.utcnow())
+    return users
+
+
+def build_slotted(count, message):
+    users = UserRegistry()
+    channels = channel_names(count)
+    for i in range(count):
+        nick = b"user".decode("ascii") + str(i)
+        users.touch(nick).update(channels=[channels[i]], message=message,
+                                 now=time.time())
+    return users
+
+
+def measure(build, count):
+    # The message is shared: both versions keep a reference to the same
+    # formatted line, which isn't what we are measuring.
+    message = '<00:00:00> someone (#channel): hello'
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    users = build(count, message)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    assert len(users) == count
+    return (after - before) / float(count)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=100000)
+    args = parser.parse_args()
+    for name, build in [('legacy', build_legacy),
+                        ('slotted', build_slotted)]:
+        print("{0:8s} {1:8.1f} bytes/user".format(
+            name, measure(build, args.users)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+"""Live channel statistics for .top: who talks, how much, and when.
+
+Every channel message is counted as it arrives, at a constant cost: in
+the current bucket of two rings of time buckets (five minutes wide for
+the last hour, an hour wide for the last day and week), in the
+speaker's running totals, and in the channel's messages per hour of
+the day. A windowed query adds up the buckets the window covers and
+never looks at a message again.
+
+Memory is bounded per channel. Each bucket counts at most max_nicks
+nicks, lumping any more together as OTHERS, and running totals are kept
+for at most max_nicks nicks, the least recently active forgotten first.
+
+Everything can be saved to a JSON file and loaded back, so a restart
+doesn't empty the rankings.
+"""
+import collections
+import json
+import os
+import threading
+
+# Seconds each .top window covers, to bucket precision.
+WINDOWS = collections.OrderedDict(
+    [('hour', 3600), ('day', 86400), ('week', 7 * 86400)])
+# Nicks past max_nicks in a bucket; not a valid nick.
+OTHERS = '*'
+SNAPSHOT_VERSION = 1
+
+
+class Ring(object):
+    """Message and word counts per nick, in count buckets width seconds
+    wide.
+
+    Bucket i holds period stamps[i], a period being now // width. A
+    bucket from a period that has gone round is cleared when next
+    written and skipped when read.
+
+    Messages can arrive out of order, as in a bouncer's playback with
+    server-time; one from before the ring's span (which would otherwise
+    clear a bucket still in use) is not counted.
+    """
+    def __init__(self, width, count, max_nicks):
+        self.width = width
+        self.count = count
+        self.max_nicks = max_nicks
+        self.stamps = [None] * count
+        self.buckets = [None] * count
+        # Newest period added.
+        self.latest = None
+
+    def add(self, nick, words, now):
+        """Count a message; returns False if it is too old to count.
+        """
+        period = int(now // self.width)
+        if self.latest is not None:
+            if period <= self.latest - self.count:
+                return False
+            self.latest = max(self.latest, period)
+        else:
+            self.latest = period
+        slot = period % self.count
+        bucket = self.buckets[slot]
+        if self.stamps[slot] != period:
+            bucket = self.buckets[slot] = {}
+            self.stamps[slot] = period
+        counts = bucket.get(nick)
+        if counts is None:
+            if len(bucket) >= self.max_nicks:
+                nick = OTHERS
+                counts = bucket.get(nick)
+            if counts is None:
+                counts = bucket[nick] = [0, 0]
+        counts[0] += 1
+        counts[1] += words
+        return True
+
+    def totals(self, seconds, now):
+        """{nick: [messages, words]} over the last seconds.
+        """
+        period = int(now // self.width)
+        first = period - max(1, -(-seconds // self.width)) + 1
+        totals = {}
+        for stamp, bucket in zip(self.stamps, self.buckets):
+            if stamp is None or not first <= stamp <= period:
+                continue
+            for nick, (messages, words) in bucket.items():
+                counts = totals.get(nick)
+                if counts is None:
+                    totals[nick] = [messages, words]
+                else:
+                    counts[0] += messages
+                    counts[1] += words
+        return totals
+
+    def snapshot(self):
+        return {'stamps': self.stamps, 'buckets': self.buckets}
+
+    def restore(self, data):
+        if len(data['stamps']) == self.count:
+            self.stamps = list(data['stamps'])
+            self.buckets = list(data['buckets'])
+            self.latest = max((stamp for stamp in self.stamps
+                               if stamp is not None), default=None)
+
+
+class ChannelStats(object):
+    """Counts for one channel.
+    """
+    def __init__(self, max_nicks=1000):
+        self.max_nicks = max_nicks
+        self.recent = Ring(300, 12, max_nicks)
+        self.week = Ring(3600, 7 * 24, max_nicks)
+        # nick: [messages, words], least recently active first
+        self.users = collections.OrderedDict()
+        self.hours = [0] * 24
+        self.messages = 0
+
+    def add(self, nick, words, now):
+        self.recent.add(nick, words, now)
+        # Something too old for the week is too old for the hours too.
+        if self.week.add(nick, words, now):
+            self.hours[int(now // 3600) % 24] += 1
+            self.messages += 1
+        users = self.users
+        counts = users.get(nick)
+        if counts is None:
+            counts = users[nick] = [0, 0]
+            if len(users) > self.max_nicks:
+                users.popitem(last=False)
+        else:
+            users.move_to_end(nick)
+        counts[0] += 1
+        counts[1] += words
+
+    def totals(self, window, now):
+        seconds = WINDOWS[window]
+        ring = self.recent if seconds <= 3600 else self.week
+        return ring.totals(seconds, now)
+
+    def snapshot(self):
+        return {
+            'recent': self.recent.snapshot(),
+            'week': self.week.snapshot(),
+            'users': [[nick, messages, words] for nick, (messages, words)
+                      in self.users.items()],
+            'hours': self.hours,
+            'messages': self.messages,
+        }
+
+    def restore(self, data):
+        self.recent.restore(data['recent'])
+        self.week.restore(data['week'])
+        for nick, messages, words in data['users'][-self.max_nicks:]:
+            self.users[nick] = [messages, words]
+        self.hours = list(data['hours'])
+        self.messages = data['messages']
+
+
+class Activity(object):
+    """ChannelStats for every channel, by lowercased name.
+
+    Messages are added on the receive thread and queries come from
+    command workers, so everything goes through one lock.
+    """
+    def __init__(self, max_nicks=1000):
+        self.max_nicks = max_nicks
+        self.channels = {}
+        self.lock = threading.Lock()
+
+    def channel(self, name):
+        key = name.lower()
+        stats = self.channels.get(key)
+        if stats is None:
+            stats = self.channels[key] = ChannelStats(self.max_nicks)
+        return stats
+
+    def add(self, nick, channels, text, now):
+        words = len(text.split())
+        with self.lock:
+            for channel in channels:
+                self.channel(channel).add(nick, words, now)
+
+    def top(self, channel, window, now, count=5):
+        """[(nick, messages, words)] for the busiest nicks in window.
+        """
+        with self.lock:
+            stats = self.channels.get(channel.lower())
+            if stats is None:
+                return []
+            totals = stats.totals(window, now)
+        ranked = sorted(totals.items(),
+                        key=lambda item: (-item[1][0], item[0]))
+        return [(nick, messages, words)
+                for nick, (messages, words) in ranked[:count]]
+
+    def busiest_hours(self, channel, count=3):
+        """[(hour of day, messages)], UTC, busiest first.
+        """
+        with self.lock:
+            stats = self.channels.get(channel.lower())
+            if stats is None or not stats.messages:
+                return []
+            counts = list(stats.hours)
+        hours = sorted(range(24), key=lambda hour: -counts[hour])
+        return [(hour, counts[hour]) for hour in hours[:count]
+                if counts[hour]]
+
+    def user(self, channel, nick):
+        """[messages, words] from nick in channel, or None.
+        """
+        with self.lock:
+            stats = self.channels.get(channel.lower())
+            counts = stats and stats.users.get(nick)
+            return counts and list(counts)
+
+    def snapshot(self):
+        """Everything, as plain data that json can write.
+
+        Copied, so it can be written out on another thread.
+        """
+        with self.lock:
+            return json.loads(json.dumps({
+                'version': SNAPSHOT_VERSION,
+                'channels': dict((name, stats.snapshot())
+                                 for name, stats in self.channels.items()),
+            }))
+
+    def restore(self, data):
+        if data.get('version') != SNAPSHOT_VERSION:
+            return
+        with self.lock:
+            for name, channel in data['channels'].items():
+                self.channel(name).restore(channel)
+
+
+def save(data, path):
+    """Write a snapshot() to path, replacing it atomically.
+    """
+    partial = path + '.part'
+    with open(partial, 'w') as out:
+        json.dump(data, out)
+    os.replace(partial, path)
+
+
+def load(activity, path):
+    """Restore activity from a file written by save(), if there is one.
+    """
+    try:
+        with open(path) as source:
+            data = json.load(source)
+    except FileNotFoundError:
+        return False
+    activity.restore(data)
+    return True
@@ -0,0 +1,177 @@
+"""asyncio counterparts of Connection and Bot.loop.
+
+The synchronous Connection and Bot.loop stay as they are; this module
+reuses their message handling and only changes how bytes come and go.
+Commands run on Bot's command pool, as with the synchronous loop, or
+with --command-workers 0 on the event loop's default executor; either
+way, a slow command can't hold up reading, PONGs or logging.
+"""
+import asyncio
+import logging
+import threading
+import time
+from otp22logbot import metrics
+from otp22logbot.bot import Bot
+from otp22logbot.connection import Connection
+
+
+class AsyncConnection(Connection):
+    """Connection over an asyncio stream pair.
+
+    send() and the IRC helpers stay synchronous: lines go straight into
+    the transport's buffer, and can be called from worker threads too.
+    """
+    def __init__(self, reader, writer, logger, loop=None):
+        Connection.__init__(self, None, logger)
+        self.reader = reader
+        self.writer = writer
+        self.loop = loop or asyncio.get_event_loop()
+        self.thread = threading.current_thread()
+        self.last_received = time.time()
+        self.timed_out = False
+
+    @classmethod
+    async def open(cls, host, port, logger=None):
+        logger = logger or logging.getLogger(__name__)
+        try:
+            reader, writer = await asyncio.open_connection(host, port)
+        except OSError:
+            return None
+        return cls(reader, writer, logger)
+
+    def write(self, message):
+        if self.writer.is_closing():
+            return 0
+        if threading.current_thread() is self.thread:
+            self.writer.write(message)
+        else:
+            self.loop.call_soon_threadsafe(self.writer.write, message)
+        if metrics.enabled:
+            metrics.BYTES_SENT.inc(len(message))
+            metrics.LINES_SENT.inc(message.count(b'\n'))
+        return len(message)
+
+    async def recv(self, size=1024):
+        try:
+            buf = await self.reader.read(size)
+        except OSError as error:
+            self.logger.error("connection error: {0}".format(error))
+            return b''
+        self.last_received = time.time()
+        if metrics.enabled:
+            metrics.BYTES_RECEIVED.inc(len(buf))
+        return buf
+
+    async def drain(self):
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            pass
+
+    def close(self):
+        self.logger.debug("closing connection")
+        self.close_outbound()
+        # After any writes the send queue scheduled from its thread.
+        self.loop.call_soon(self.writer.close)
+
+
+class AsyncBot(Bot):
+    """Bot that runs its connection on an asyncio event loop.
+    """
+    def __init__(self, app_args, logger):
+        Bot.__init__(self, app_args, logger)
+        self.keepalive_interval = app_args.keepalive
+
+    async def connect_async(self):
+        self.logger.info("connecting to {0} {1}"
+                         .format(self.app_args.server,
+                                 self.app_args.port))
+        conn = await AsyncConnection.open(
+            self.app_args.server, self.app_args.port,
+            logger=self.logger.getChild("connection"))
+        if conn and self.app_args.flood_rate:
+            conn.enable_flood_control(
+                self.app_args.flood_rate, self.app_args.flood_burst)
+        return conn
+
+    def command_done(self, conn):
+        if self.should_die:
+            conn.loop.call_soon_threadsafe(conn.close)
+
+    def run_unpooled(self, function, conn, requester, target, args):
+        # Inline would be on the event loop itself.
+        conn.loop.run_in_executor(
+            None, self.run_in_executor, function, conn, requester, target,
+            args)
+
+    def run_in_executor(self, function, conn, requester, target, args):
+        try:
+            Bot.run_unpooled(self, function, conn, requester, target, args)
+        except Exception:
+            self.logger.exception("error in {0}".format(function.__name__))
+
+    async def keepalive(self, conn):
+        """PING the server when it goes quiet; give up if it stays quiet.
+        """
+        interval = self.keepalive_interval
+        while True:
+            await asyncio.sleep(interval / 2.0)
+            idle = time.time() - conn.last_received
+            if idle >= interval * 2:
+                self.logger.info("no data for {0:.0f}s, closing".format(idle))
+                conn.timed_out = True
+                conn.close()
+                return
+            if idle >= interval:
+                conn.send('PING :{0}'.format(self.app_args.server))
+
+    async def loop_async(self, conn):
+        """Returns why the loop ended, like Bot.loop.
+        """
+        it = self.message_iterator()
+        timer = None
+        if self.keepalive_interval:
+            timer = asyncio.ensure_future(self.keepalive(conn))
+        reason = 'killed'
+        try:
+            while not self.should_die:
+                self.profiler.poll()
+                received = await conn.recv(1024)
+                if received == b'':
+                    self.file_send("connection closed")
+                    reason = 'keepalive' if conn.timed_out else 'closed'
+                    break
+                self.logger.debug('received {0}'.format(received))
+                messages = it.send(received)
+                if not self.handle_batch(conn, messages):
+                    reason = 'throttled'
+                    break
+                await conn.drain()
+            await conn.drain()
+        finally:
+            if timer:
+                timer.cancel()
+            conn.close()
+        return reason
+
+    async def main_async(self):
+        """Connect and loop, reconnecting with backoff, as Bot.run.
+        """
+        while True:
+            conn = await self.connect_async()
+            reason = 'connect failed'
+            if conn:
+                self.connected(conn)
+                reason = await self.loop_async(conn)
+            else:
+                self.logger.error("could not connect")
+            delay = self.reconnect_delay(conn, reason)
+            if delay is None:
+                return
+            await asyncio.sleep(delay)
+
+    def run(self):
+        try:
+            asyncio.run(self.main_async())
+        except KeyboardInterrupt:
+            self.file_send("received KeyboardInterrupt")
@@ -0,0 +1,153 @@
+import sqlite3
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    time REAL NOT NULL,
+    nick TEXT NOT NULL COLLATE NOCASE,
+    targets TEXT NOT NULL,
+    text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_nick_time ON messages (nick, time);
+"""
+
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts
+USING fts5(text, content='messages', content_rowid='id');
+"""
+
+
+def quote_terms(terms):
+    """Make user input safe to use as an FTS5 query: all terms, literally.
+    """
+    return " ".join('"{0}"'.format(term.replace('"', '""'))
+                    for term in terms)
+
+
+class Archive(object):
+    """Searchable SQLite archive of PRIVMSGs.
+
+    add() only queues the row; a background thread inserts rows in
+    batched transactions, so archiving doesn't slow down the receive
+    loop. The database is in WAL mode so searches can run while the
+    writer is busy. Without FTS5 in the local SQLite, search falls back
+    to LIKE.
+    """
+    def __init__(self, path, logger, batch_size=500, batch_interval=1.0,
+                 queue_size=50000):
+        self.path = path
+        self.logger = logger
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self.local = threading.local()
+        db = self.connect()
+        db.executescript(SCHEMA)
+        try:
+            db.executescript(FTS_SCHEMA)
+            self.fts = True
+        except sqlite3.OperationalError:
+            self.logger.info("FTS5 unavailable, searching with LIKE")
+            self.fts = False
+        self.thread = threading.Thread(
+            target=self.run, name="otp22logbot-archive")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def connect(self):
+        """One SQLite connection per thread.
+        """
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.local.db = db
+        return db
+
+    def add(self, when, nick, targets, text):
+        try:
+            self.queue.put_nowait((when, nick, targets, text))
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.dropped:
+            self.logger.info("archive dropped {0} message(s)"
+                             .format(self.dropped))
+
+    def insert(self, db, rows):
+        with db:
+            for row in rows:
+                cursor = db.execute(
+                    "INSERT INTO messages (time, nick, targets, text) "
+                    "VALUES (?, ?, ?, ?)", row)
+                if self.fts:
+                    db.execute(
+                        "INSERT INTO messages_fts (rowid, text) "
+                        "VALUES (?, ?)", (cursor.lastrowid, row[3]))
+
+    def run(self):
+        db = self.connect()
+        done = False
+        while not done:
+            rows = []
+            deadline = None
+            while len(rows) < self.batch_size:
+                timeout = None
+                if deadline:
+                    timeout = max(0, deadline - time.time())
+                try:
+                    row = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if row is None:
+                    done = True
+                    break
+                rows.append(row)
+                deadline = deadline or time.time() + self.batch_interval
+            if rows:
+                try:
+                    self.insert(db, rows)
+                except sqlite3.Error:
+                    self.logger.exception("error archiving {0} row(s)"
+                                          .format(len(rows)))
+        db.close()
+
+    def search(self, terms, nick=None, page=1, per_page=5):
+        """Newest first. Returns (total matches, list of rows).
+        """
+        db = self.connect()
+        where = []
+        params = []
+        if terms and self.fts:
+            where.append("messages.id IN (SELECT rowid FROM messages_fts "
+                         "WHERE messages_fts MATCH ?)")
+            params.append(quote_terms(terms))
+        else:
+            for term in terms:
+                where.append("messages.text LIKE ? ESCAPE '\\'")
+                escaped = (term.replace('\\', '\\\\').replace('%', '\\%')
+                           .replace('_', '\\_'))
+                params.append('%' + escaped + '%')
+        if nick:
+            where.append("messages.nick = ?")
+            params.append(nick)
+        clause = " WHERE " + " AND ".join(where) if where else ""
+        total, = db.execute(
+            "SELECT COUNT(*) FROM messages" + clause, params).fetchone()
+        rows = db.execute(
+            "SELECT time, nick, targets, text FROM messages" + clause +
+            " ORDER BY time DESC, id DESC LIMIT ? OFFSET ?",
+            params + [per_page, (page - 1) * per_page]).fetchall()
+        return total, rows
@@ -0,0 +1,27 @@
+import random
+
+
+class Backoff(object):
+    """Delays between reconnect attempts.
+
+    Each delay is picked at random from the upper half of a ceiling
+    that starts at initial and is multiplied by factor per attempt, up
+    to maximum. The randomness keeps bots dropped at the same moment
+    from all coming back at once. reset() after a connection that
+    worked.
+    """
+    def __init__(self, initial=1.0, maximum=300.0, factor=2.0,
+                 random=random.random):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.random = random
+        self.ceiling = initial
+
+    def next(self):
+        ceiling = min(self.ceiling, self.maximum)
+        self.ceiling = ceiling * self.factor
+        return ceiling / 2.0 + self.random() * ceiling / 2.0
+
+    def reset(self):
+        self.ceiling = self.initial
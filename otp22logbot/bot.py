@@ -1,41 +1,215 @@
+import codecs
+import functools
+import os
+import socket
+import time
 from datetime import datetime as Datetime
+from otp22logbot import activity
 from otp22logbot.app_data import APP_DATA
+from otp22logbot.archive import Archive
+from otp22logbot.backoff import Backoff
 from otp22logbot.connection import Connection
-from otp22logbot.user import User
+from otp22logbot.history import History, chunks
+from otp22logbot.logfile import RotatingLog, ShardedLog, shard_filename
+from otp22logbot.overload import FloodDetector, Overload
+from otp22logbot.profiling import Profiler
+from otp22logbot.reactor import Reactor
+from otp22logbot.segment import SegmentWriter, repair
+from otp22logbot.sendqueue import TokenBucket
+from otp22logbot.state import StateStore
+from otp22logbot.user import UserRegistry
+from otp22logbot.workers import CommandPool
+from otp22logbot.writer import LogWriter, QueueFull
+from otp22logbot import metrics
 from otp22logbot import protocol
 
 
+# Seconds between snapshots of channel statistics, with --state-dir.
+ACTIVITY_SAVE_INTERVAL = 300
+# Reads select_loop makes each time the socket is readable before it
+# lets timers and should_die have a turn.
+READS_PER_WAKEUP = 16
+
+
 class Bot(object):
     def __init__(self, app_args, logger):
         self.app_data = APP_DATA.copy()
         self.app_args = app_args
         self.logger = logger
         self.should_die = False
-        self.users = {}
+        self.users = UserRegistry(max_size=app_args.max_users)
         self.commands = {
             '.flush': self.flush,
             '.help': self.help,
             '.version': self.version,
             '.kill': self.kill,
+            '.history': self.history,
             '.last': self.last,
             '.user': self.user,
+            '.profile': self.profile,
+            '.search': self.search,
+            '.stats': self.stats,
+            '.top': self.top,
             '\x01VERSION\x01': self.version_query,
         }
         self.helps = {
             'flush': ".flush: flush and rotate logfiles",
             'help': ".help <command>: lists help for a specific command",
             'kill': ".kill: attempts to kill this bot (good luck)",
-            'last': ".last [user]: displays last message received. if [user] is specified, displays last message sent by user",
+            'history': ".history [N] [#channel|nick]: sends you the last N channel messages, from this channel if asked in one, or only those in #channel or from nick",
+            'last': ".last [user|N]: displays last message received. if [user] is specified, displays last message sent by user. .last N is .history N",
+            'profile': ".profile start|stop <password> [cpu|sample]: profiles the bot and writes reports to files (overlord only)",
+            'search': ".search [@nick] [+page] <terms>: searches the message archive, results are sent privately",
+            'stats': ".stats: displays runtime counters (if metrics are enabled)",
+            'top': ".top [hour|day|week] [#channel] [nick]: displays who talked most, with message and word counts, and the channel's busiest hours; or, given a nick, their counts so far",
             'user': ".user [user]: displays information about user. if unspecified, defaults to command requester",
             'version': ".version: displays version information",
         }
-        self.channel = '#' + self.app_args.channel
+        # -c takes a comma separated list; the first channel is the one
+        # the bot greets and says goodbye to.
+        names = [name.strip().lstrip('#')
+                 for name in self.app_args.channel.split(',')]
+        self.channels_joined = ['#' + name for name in names if name]
+        self.channel = self.channels_joined[0]
+        # Lowercased, since IRC channel names are case insensitive.
+        self.channels = set(
+            channel.lower() for channel in self.channels_joined)
         self.nick = self.app_args.nick
+        # Tried in order on everything received; the last one should
+        # not be able to fail.
+        self.encodings = tuple(
+            codecs.lookup(name).name
+            for name in self.app_args.encodings.split(','))
+        self.output = RotatingLog(
+            self.app_args.output, self.logger.getChild("logfile"),
+            max_bytes=self.app_args.rotate_size,
+            interval=self.app_args.rotate_interval,
+            compress=self.app_args.compress)
+        self.sharded = bool(self.app_args.shard_dir)
+        if self.sharded:
+            self.output = ShardedLog(
+                self.output, self.app_args.shard_dir,
+                self.logger.getChild("logfile"),
+                max_open=self.app_args.max_open_files,
+                max_bytes=self.app_args.rotate_size,
+                interval=self.app_args.rotate_interval,
+                compress=self.app_args.compress)
+        self.writer = LogWriter(
+            self.output, self.logger.getChild("writer"),
+            flush_lines=self.app_args.flush_lines,
+            flush_interval=self.app_args.flush_interval / 1000.0,
+            fsync=self.app_args.fsync,
+            queue_size=self.app_args.queue_size,
+            overflow=self.app_args.overflow)
+        # Set while lines are being dropped for want of queue room.
+        self.log_full = False
+        self.backlog = History(size=self.app_args.history_size,
+                               depth=self.app_args.history_max)
+        self.last_message = None
+        self.state = None
+        self.activity = activity.Activity(self.app_args.stats_max_nicks)
+        self.activity_saved = time.monotonic()
+        if self.app_args.state_dir:
+            self.state = StateStore(
+                self.app_args.state_dir, self.logger.getChild("state"))
+            self.last_message = self.state.load(self.users)
+            activity.load(self.activity, self.activity_path)
+        self.pool = None
+        if self.app_args.command_workers:
+            self.pool = CommandPool(
+                self.logger.getChild("commands"),
+                workers=self.app_args.command_workers,
+                queue_size=self.app_args.command_queue,
+                timeout=self.app_args.command_timeout,
+                per_requester=self.app_args.commands_per_user)
+        self.profiler = Profiler(
+            self.app_args.profile_dir, self.logger.getChild("profiler"))
+        self.segment = None
+        if self.app_args.binary_log:
+            torn = repair(self.app_args.binary_log)
+            if torn:
+                self.logger.warning(
+                    "dropped {0} bytes of an unfinished block from {1}"
+                    .format(torn, self.app_args.binary_log))
+            self.segment_file = open(self.app_args.binary_log, 'ab')
+            # Blocks are encoded here but written on the log writer's
+            # thread, in order with everything else it writes, and no
+            # later than the text log is flushed.
+            self.segment = SegmentWriter(
+                lambda block: self.writer.call(
+                    functools.partial(self.write_segment, block)),
+                max_delay=self.app_args.flush_interval / 1000.0)
+        self.archive = None
+        if self.app_args.archive:
+            self.archive = Archive(
+                self.app_args.archive, self.logger.getChild("archive"))
+        self.backoff = Backoff(self.app_args.reconnect_delay,
+                               self.app_args.reconnect_max_delay)
+        self.floods = None
+        if self.app_args.user_flood_limit:
+            self.floods = FloodDetector(self.app_args.user_flood_limit,
+                                        self.app_args.user_flood_window)
+        self.overload = Overload()
+        # Commands let through while overloaded; None lets none through.
+        self.overload_commands = None
+        if self.app_args.overload_command_rate:
+            self.overload_commands = TokenBucket(
+                self.app_args.overload_command_rate, 1)
+        # When the connection was lost, while we're without one.
+        self.lost_at = None
+        self.greeted = False
+
+    @property
+    def activity_path(self):
+        return os.path.join(self.app_args.state_dir, 'activity.json')
+
+    def save_activity(self):
+        """Snapshot channel statistics; written on the log writer thread.
+        """
+        self.activity_saved = time.monotonic()
+        data = self.activity.snapshot()
+        path = self.activity_path
+
+        def write():
+            try:
+                activity.save(data, path)
+            except (IOError, OSError):
+                self.logger.exception("error saving channel statistics")
+        self.writer.call(write)
 
-    def file_send(self, data):
+    def write_segment(self, block):
+        self.segment_file.write(block)
+        self.segment_file.flush()
+
+    def file_send(self, data, channels=None):
+        """Log a line, to each channel's own file if sharding.
+        """
         self.logger.debug('=WRITING=>[{0}]'.format(data))
-        self.app_args.output.write(data + '\n')
-        self.app_args.output.flush()
+        start = metrics.timer()
+        try:
+            if self.sharded and channels:
+                written = all([self.writer.write(data + '\n', key=channel)
+                               for channel in channels])
+            else:
+                written = self.writer.write(data + '\n')
+        except QueueFull:
+            # --overflow error: losing lines is bad, losing the
+            # connection over it is worse.
+            self.writer.stats.dropped += 1
+            written = False
+        if not written:
+            if metrics.enabled:
+                metrics.LOG_DROPPED.inc()
+            if not self.log_full:
+                self.logger.error("log queue full, dropping lines")
+                self.log_full = True
+        elif self.log_full:
+            self.logger.warning("log queue has room again; {0} line(s) "
+                                "dropped so far".format(
+                                    self.writer.stats.dropped))
+            self.log_full = False
+        if start is not None:
+            metrics.LOG_WRITE_SECONDS.observe(time.perf_counter() - start)
 
     def startup(self):
         info = self.logger.info
@@ -44,11 +218,16 @@ class Bot(object):
         now = Datetime.utcnow().strftime(APP_DATA['timeformat'])
         info("started at {0}".format(now))
 
-        config_path = self.app_args.init.name if self.app_args.init else None
+        # A file from -i, or just its name in a supervised worker.
+        config_path = getattr(self.app_args.init, 'name',
+                              self.app_args.init) or None
         info("using configuration file: {0}".format(config_path))
 
-        output_name = self.app_args.output.name
+        output_name = self.output.name
         info("using output logfile {0}".format(output_name))
+        if self.sharded:
+            info("logging {0} channel(s) to files in {1}"
+                 .format(len(self.channels), self.app_args.shard_dir))
 
         server = self.app_args.server
         port = self.app_args.port
@@ -57,21 +236,146 @@ class Bot(object):
         timeformat = self.app_data["timeformat"]
         info("using timestamp format {0}".format(timeformat))
 
+        info("flushing log every {0} lines or {1} ms{2}"
+             .format(self.writer.flush_lines, self.app_args.flush_interval,
+                     ", with fsync" if self.writer.fsync else ""))
+        self.writer.start()
+        self.start_metrics()
+        if self.app_args.profile:
+            self.profiler.request('start', self.app_args.profile)
+        if self.state:
+            self.state.start()
+
+    def start_metrics(self):
+        self.metrics_exporter = self.metrics_server = None
+        args = self.app_args
+        if not (args.metrics or args.metrics_file or args.metrics_port):
+            return
+        metrics.enable()
+        logger = self.logger.getChild("metrics")
+        if args.metrics_file:
+            self.metrics_exporter = metrics.TextfileExporter(
+                args.metrics_file, logger)
+            self.logger.info("writing metrics to {0}"
+                             .format(args.metrics_file))
+        if args.metrics_port:
+            self.metrics_server = metrics.serve_http(
+                args.metrics_port, logger)
+            self.logger.info("serving metrics on 127.0.0.1:{0}/metrics"
+                             .format(args.metrics_port))
+
+    def stop_metrics(self):
+        if getattr(self, 'metrics_exporter', None):
+            self.metrics_exporter.close()
+        if getattr(self, 'metrics_server', None):
+            self.metrics_server.shutdown()
+
+    def log_gap(self, line, now=None):
+        """Mark a stretch of missing history in every log we keep.
+        """
+        self.file_send(line)
+        if self.sharded:
+            self.file_send(line, channels=self.channels_joined)
+        if self.segment:
+            self.segment.append(now or time.time(), '', [], line)
+
+    def connected(self, conn):
+        """Start using a new connection, closing any gap in the log.
+        """
+        if self.lost_at is not None:
+            now = time.time()
+            outage = now - self.lost_at
+            if metrics.enabled:
+                metrics.RECONNECT_SECONDS.observe(outage)
+            timeformat = self.app_data['timeformat']
+            self.log_gap(
+                '-- reconnected after {0:.1f}s; nothing was logged from '
+                '{1} to {2} --'.format(
+                    outage,
+                    Datetime.utcfromtimestamp(self.lost_at)
+                    .strftime(timeformat),
+                    Datetime.utcfromtimestamp(now).strftime(timeformat)),
+                now)
+            self.lost_at = None
+        self.handshake(conn)
+
+    def reconnect_delay(self, conn, reason):
+        """Called when a connection ends, or could not be made.
+
+        Returns the seconds to wait before connecting again, or None
+        to stop. The log writer, users, archive and open log files are
+        all kept as they are across reconnects.
+        """
+        if (self.should_die or reason == 'interrupted' or
+                not self.app_args.reconnect):
+            return None
+        if conn is not None and conn.registered:
+            # It worked for a while; start over from short delays.
+            self.backoff.reset()
+        if self.lost_at is None:
+            now = self.lost_at = time.time()
+            self.log_gap('-- connection lost ({0}) at {1}; reconnecting --'
+                         .format(reason, Datetime.utcfromtimestamp(now)
+                                 .strftime(self.app_data['timeformat'])),
+                         now)
+        if metrics.enabled:
+            metrics.RECONNECTS.inc(label=reason)
+        delay = self.backoff.next()
+        self.logger.info("{0}; reconnecting in {1:.1f}s"
+                         .format(reason, delay))
+        return delay
+
+    def run(self):
+        """Connect and loop, reconnecting with backoff until told to stop.
+        """
+        while True:
+            conn = self.connect()
+            reason = 'connect failed'
+            if conn:
+                self.connected(conn)
+                if self.app_args.selector:
+                    reason = self.select_loop(conn)
+                else:
+                    reason = self.loop(conn)
+            delay = self.reconnect_delay(conn, reason)
+            if delay is None:
+                return
+            try:
+                time.sleep(delay)
+            except KeyboardInterrupt:
+                self.file_send("received KeyboardInterrupt")
+                return
+
     def connect(self):
         self.logger.info("connecting to {0} {1}"
                          .format(self.app_args.server,
                                  self.app_args.port))
-        return Connection.new(
+        conn = Connection.new(
             self.app_args.server, self.app_args.port,
             logger=self.logger.getChild("connection"))
+        if conn and self.app_args.flood_rate:
+            conn.enable_flood_control(
+                self.app_args.flood_rate, self.app_args.flood_burst)
+        if conn and self.app_args.keepalive:
+            # recv raises socket.timeout when idle this long; see loop.
+            conn.sock.settimeout(self.app_args.keepalive)
+        return conn
 
     def handshake(self, conn):
+        conn.last_message = conn.last_message or self.last_message
         # RFC 1459 4.1.1, RFC 2812 3.1.1 - PASS before NICK, USER
         if self.app_args.password:
             conn.password(self.app_args.password)
-        conn.nick(self.app_args.nick)
+        if self.app_args.server_time:
+            conn.cap_request(['server-time'])
+        self.nick = self.app_args.nick
+        conn.nick(self.nick)
         conn.user(self.app_args.user, self.app_args.real)
-        conn.join(['#' + self.app_args.channel])
+        conn.join(self.channels_joined)
+        # Greet once per run, not on every reconnect.
+        if self.greeted:
+            return
+        self.greeted = True
         conn.privmsg_user(
             self.app_data['overlord'], 'Greetings, overlord. I am for you.')
         conn.privmsg_channel(
@@ -83,13 +387,17 @@ class Bot(object):
         if parameter:
             line = self.helps.get(parameter)
         if not parameter or not line:
-            line = 'Available commands (use .help <command> for more help): flush, help, kill, last, user, version'
+            line = ('Available commands (use .help <command> for more help): '
+                    + ', '.join(sorted(self.helps)))
         if target == self.nick:
             conn.privmsg_user(requester, line)
         else:
             conn.privmsg_channel(target, line)
 
     def flush(self, conn, requester, target, args):
+        # Rotation happens on the writer thread, after every line
+        # queued before this one, so the receive loop doesn't wait.
+        self.writer.call(self.output.rotate)
         line = 'Flushing and rotating logfiles...'
         if target == self.nick:
             conn.privmsg_user(requester, line)
@@ -114,6 +422,21 @@ class Bot(object):
             conn.privmsg_channel(self.channel, 'Goodbye!')
             conn.quit('killed by {0}'.format(requester))
 
+    def profile(self, conn, requester, target, args):
+        words = args[0].split() if args else []
+        action = words[0] if words else None
+        password = words[1] if len(words) > 1 else None
+        mode = words[2] if len(words) > 2 else 'cpu'
+        # Same gate as .kill: without the right password, stay quiet.
+        if not (self.app_args.kill and password == self.app_args.kill):
+            return
+        if action not in ('start', 'stop') or mode not in Profiler.modes:
+            conn.privmsg_user(requester, self.helps['profile'])
+            return
+        self.profiler.request(
+            action, mode,
+            callback=lambda line: conn.privmsg_user(requester, line))
+
     def version_query(self, conn, requester, channel, args):
         line = (
             '\x01VERSION OTP22LogBot '
@@ -123,6 +446,8 @@ class Bot(object):
 
     def last(self, conn, requester, target, args):
         parameter = args[0] if args else None
+        if parameter and parameter.split()[0].isdigit():
+            return self.history(conn, requester, target, args)
         if parameter:
             user = self.get_user(parameter)
             if not user:
@@ -137,34 +462,198 @@ class Bot(object):
         else:
             conn.privmsg_channel(target, line)
 
-    def format_message(self, requester, targets, content):
-        now = Datetime.utcnow()
-        # Ugh, encoding ambiguity
-        encoding = "utf-8"
-        targets = b",".join(targets).decode(encoding)
+    def history(self, conn, requester, target, args):
+        words = args[0].split() if args else []
+        count = 10
+        if words and words[0].isdigit():
+            count = int(words.pop(0))
+        count = max(1, min(count, self.app_args.history_max))
+        channel = nick = None
+        if words and words[0].startswith('#'):
+            channel = words[0]
+        elif words:
+            nick = words[0]
+        if not channel and target != self.nick:
+            channel = target
+        if self.sharded:
+            # Each channel is in its own file.
+            channel = channel or self.channel
+            path = os.path.join(self.app_args.shard_dir,
+                                shard_filename(channel))
+        else:
+            path = self.app_args.output
+        if channel and channel.lower() not in self.channels:
+            lines = ['{0} is not logged here'.format(channel)]
+        else:
+            lines = self.backlog.lines(
+                path, count, channel, nick,
+                sync=functools.partial(self.writer.sync, 5.0))
+            lines = lines or ['no history']
+        # Private, through the flood controlled queue, and in pieces
+        # that fit a line however long the message was.
+        for line in lines:
+            for chunk in chunks(line):
+                conn.privmsg_user(requester, chunk)
+
+    def search(self, conn, requester, target, args):
+        words = args[0].split() if args else []
+        nick = None
+        page = 1
+        if words and words[0].startswith('@'):
+            nick = words.pop(0)[1:]
+        if words and words[0].startswith('+') and words[0][1:].isdigit():
+            page = max(1, int(words.pop(0)[1:]))
+        if not self.archive:
+            lines = ['the message archive is not enabled']
+        elif not words and not nick:
+            lines = [self.helps['search']]
+        else:
+            per_page = 5
+            total, rows = self.archive.search(
+                words, nick=nick, page=page, per_page=per_page)
+            pages = (total + per_page - 1) // per_page
+            lines = ['{0} match(es), page {1} of {2}'
+                     .format(total, page, max(pages, 1))]
+            timeformat = self.app_data['timeformat_extended']
+            for when, speaker, targets, text in rows:
+                # Archived lines can be as long as IRC allows, which
+                # with the time and targets added no longer fits.
+                lines.extend(chunks('<{0}> {1} ({2}): {3}'.format(
+                    Datetime.utcfromtimestamp(when).strftime(timeformat),
+                    speaker, targets, text)))
+            if page < pages:
+                lines.append('use .search {0}+{1} {2} for more'.format(
+                    '@' + nick + ' ' if nick else '', page + 1,
+                    ' '.join(words)))
+        for line in lines:
+            conn.privmsg_user(requester, line)
+
+    def stats(self, conn, requester, target, args):
+        if not metrics.enabled:
+            lines = ['metrics are disabled (start with --metrics)']
+        else:
+            errors = ', '.join(
+                '{0} {1}'.format(name, count) for name, count in
+                sorted(metrics.PARSE_ERRORS.copy().items())) or 'none'
+            dropped = metrics.SEND_DROPPED.total()
+            lines = [
+                'parsed {0} lines (errors: {1}); received {2} bytes, '
+                'sent {3} lines/{4} bytes, refused {5}'.format(
+                    metrics.LINES_PARSED.total(), errors,
+                    metrics.BYTES_RECEIVED.total(),
+                    metrics.LINES_SENT.total(), metrics.BYTES_SENT.total(),
+                    dropped),
+                'log: {0} lines queued, mean {1:.1f} us, {2} batches, '
+                'mean batch write {3:.2f} ms; {4} users known'.format(
+                    metrics.LOG_WRITE_SECONDS.count(),
+                    metrics.LOG_WRITE_SECONDS.mean() * 1e6,
+                    metrics.LOG_BATCH_SECONDS.count(),
+                    metrics.LOG_BATCH_SECONDS.mean() * 1e3,
+                    len(self.users)),
+                'send queue: {0} waiting; {1} sent, mean wait {2:.1f} ms, '
+                '99% within {3:g} s'.format(
+                    metrics.SEND_QUEUE_DEPTH.value(),
+                    metrics.SEND_QUEUE_WAIT_SECONDS.count(),
+                    metrics.SEND_QUEUE_WAIT_SECONDS.mean() * 1e3,
+                    metrics.SEND_QUEUE_WAIT_SECONDS.quantile(0.99)),
+                'commands: ' + (', '.join(
+                    '{0} {1} ({2:.1f} ms)'.format(
+                        name, count,
+                        metrics.COMMAND_SECONDS.mean(name) * 1e3)
+                    for name, count in
+                    sorted(metrics.COMMANDS.copy().items())) or 'none'),
+                'overload: {0} ({1:.0%} busy), {2} time(s); shed {3} '
+                'commands, {4} user updates; {5} flood messages'.format(
+                    'on' if self.overload.active else 'off',
+                    self.overload.share, metrics.OVERLOADS.total(),
+                    metrics.SHED.value('command'),
+                    metrics.SHED.value('user_update'),
+                    metrics.FLOOD_MESSAGES.total()),
+            ]
+        for line in lines:
+            if target == self.nick:
+                conn.privmsg_user(requester, line)
+            else:
+                conn.privmsg_channel(target, line)
+
+    def top(self, conn, requester, target, args):
+        words = args[0].split() if args else []
+        window = 'day'
+        channel = target if target != self.nick else self.channel
+        nick = None
+        for word in words:
+            if word.lower() in activity.WINDOWS:
+                window = word.lower()
+            elif word.startswith('#'):
+                channel = word
+            else:
+                nick = word
+        if channel.lower() not in self.channels:
+            lines = ['{0} is not logged here'.format(channel)]
+        elif nick:
+            counts = self.activity.user(channel, nick)
+            if counts:
+                lines = ['{0} in {1}: {2} msgs/{3} words'.format(
+                    nick, channel, *counts)]
+            else:
+                lines = ['nothing counted from {0} in {1}'.format(
+                    nick, channel)]
+        else:
+            lines = self.top_lines(channel, window)
+        for line in lines:
+            if target == self.nick:
+                conn.privmsg_user(requester, line)
+            else:
+                conn.privmsg_channel(target, line)
+
+    def top_lines(self, channel, window):
+        ranked = self.activity.top(channel, window, time.time())
+        if not ranked:
+            return ['nobody has said anything in {0} in the last {1}'
+                    .format(channel, window)]
+        hours = self.activity.busiest_hours(channel)
+        return [
+            'top in {0}, last {1}: {2}'.format(
+                channel, window, ', '.join(
+                    '{0} {1} msgs/{2} words'.format(
+                        'others' if nick == activity.OTHERS else nick,
+                        messages, count)
+                    for nick, messages, count in ranked)),
+            'busiest hours (UTC): ' + ', '.join(
+                '{0:02d}:00 ({1})'.format(hour, messages)
+                for hour, messages in hours),
+        ]
+
+    def format_message(self, requester, targets, content, when=None):
+        """Log line for a PRIVMSG; targets and content already decoded.
+
+        when is seconds since the epoch, defaulting to now.
+        """
+        if when is None:
+            now = Datetime.utcnow()
+        else:
+            now = Datetime.utcfromtimestamp(when)
         formatted_message = '<{0}> {1} ({2}): {3}'.format(
             now.strftime(self.app_data['timeformat']),
             requester,
-            targets,
-            content.decode(encoding))
+            ",".join(targets),
+            content)
         return formatted_message
 
     def get_user(self, nick):
         user = self.users.get(nick)
         return user
 
-    def new_user(self, nick):
-        user = User(nick)
-        self.users[nick] = user
-        return user
-
     def user(self, conn, requester, target, args):
         parameter = args[0] if args else requester
-        if parameter in self.users:
-            user = self.users[requester]
+        user = self.get_user(parameter)
+        if user:
             timeformat = self.app_data['timeformat_extended']
-            this_time = user.seen.strftime(timeformat)
-            user_lastmsg = user.time.strftime(timeformat)
+            this_time = Datetime.utcfromtimestamp(user.seen).strftime(
+                timeformat)
+            user_lastmsg = (
+                Datetime.utcfromtimestamp(user.time).strftime(timeformat)
+                if user.time else 'never')
             line = ('User {0} (last seen {1}), (last message {2} -- {3})'
                     .format(parameter, this_time, user_lastmsg, user.message))
         else:
@@ -174,83 +663,323 @@ class Bot(object):
         else:
             conn.privmsg_channel(target, line)
 
-    def dispatch(self, conn, prefix, targets, text):
-        encoding = "ascii"  # TODO
-        prefix = prefix.decode(encoding)
-        requester = prefix.split("!", 1)[0]
-        targets = [target.decode(encoding) for target in targets]
-        args = [arg.decode(encoding) for arg in text.split(b" ", 1)]
+    def resolve(self, message):
+        """Work out which command, if any, a PRIVMSG is asking for.
 
+        Returns (function, requester, target, args) or None.
+        """
+        args = message.text.split(" ", 1)
         command, args = args[0], args[1:] if len(args) > 1 else []
         function = self.commands.get(command)
-        target = (
-            self.channel if self.channel in targets
-            else self.nick if self.nick in targets else None)
-        if function and target:
+        if not function:
+            return None
+        target = self.resolve_target(message.targets)
+        if target:
+            requester = message.nick
             self.logger.info("{0} is running {1} {2}"
-                             .format(prefix, command, args))
+                             .format(message.source, command, args))
             # TODO: ensure downstream commands understand args,
             # possibly prechew it here - unicode, lists...
-            function(conn, requester, target, args)
+            return function, requester, target, args
+        return None
+
+    def resolve_target(self, targets):
+        """Pick where a reply goes: one of our channels, or our nick.
+        """
+        for target in targets:
+            if target.lower() in self.channels:
+                return target
+        return self.nick if self.nick in targets else None
+
+    def dispatch(self, conn, message, flooding=False):
+        resolved = self.resolve(message)
+        if not resolved:
+            return False
+        function, requester, target, args = resolved
+        if self.shed_command(flooding):
+            self.logger.debug("shed {0} from {1}".format(
+                function.__name__, requester))
+            if metrics.enabled:
+                metrics.SHED.inc(label='command')
+            return True
+        if not self.pool:
+            self.run_unpooled(function, conn, requester, target, args)
+            return True
+
+        def run(gated):
+            self.run_timed(function, gated, requester, target, args)
+            self.command_done(conn)
+
+        def timed_out():
+            conn.privmsg_user(requester, 'sorry, {0} timed out'.format(
+                function.__name__))
+
+        refused = self.pool.submit(requester, function.__name__, run, conn,
+                                   on_timeout=timed_out)
+        if refused == 'busy':
+            conn.privmsg_user(requester, 'too busy, try again later')
+        elif refused:
+            conn.privmsg_user(
+                requester, 'please wait for your other commands to finish')
+        return True
+
+    def shed_command(self, flooding):
+        """Whether to skip a command rather than run it.
+
+        Commands from a flooding nick are always skipped. While
+        overloaded, only --overload-command-rate of them get through.
+        """
+        if flooding:
+            return True
+        if not self.overload.active:
+            return False
+        return not self.overload_commands or bool(
+            self.overload_commands.take())
+
+    def command_done(self, conn):
+        """Called after each command, on the thread that ran it.
+        """
+
+    def run_unpooled(self, function, conn, requester, target, args):
+        """Run a command without the pool (--command-workers 0): inline.
+        """
+        self.run_timed(function, conn, requester, target, args)
+        self.command_done(conn)
+
+    def run_timed(self, function, conn, requester, target, args):
+        """Run a command, counting and timing it if metrics are on.
+        """
+        start = metrics.timer()
+        if start is None:
+            return function(conn, requester, target, args)
+        try:
+            return function(conn, requester, target, args)
+        finally:
+            name = function.__name__
+            metrics.COMMANDS.inc(label=name)
+            metrics.COMMAND_SECONDS.observe(
+                time.perf_counter() - start, label=name)
+
+    ignored = frozenset([
+        b'372',  # response to MOTD at login
+        b'042',  # RPL_YOURID
+        b'375',  # MOTD
+    ])
+
+    def message_iterator(self):
+        """Primed generator turning received bytes into Messages.
+        """
+        it = protocol.message_iterator(
+            self.logger,
+            parse=functools.partial(
+                protocol.Message.parse, encodings=self.encodings),
+            limit=512 + protocol.TAGS_LIMIT + 1)
+        it.send(None)
+        return it
+
+    def handle(self, conn, message):
+        """Act on one parsed Message.
+
+        Returns False if the connection should not be used any more.
+        """
+        command = message.command
+        if command in self.ignored:
             return True
-        return False
+        if command == b"PING":
+            conn.pong(message.params.decode("ascii", "replace"))
+        elif command == b"001":
+            conn.registered = True
+        elif command == b"433" and not conn.registered:
+            # ERR_NICKNAMEINUSE; after a reconnect, often our own ghost
+            # that the server hasn't timed out yet.
+            self.nick = self.nick + '_'
+            conn.nick(self.nick)
+        elif command == b"ERROR":
+            if b"connect too fast" in message.params:
+                self.logger.info("connection throttled")
+                return False
+        elif command == b"PRIVMSG":
+            # server-time, when the server sends it, is right even for
+            # messages played back from a bouncer's backlog.
+            now = message.time or time.time()
+            requester = message.nick
+            targets = message.targets
+            text = message.text
+            flooding = False
+            if self.floods:
+                flooding = self.floods.hit(requester, time.monotonic())
+                if flooding and metrics.enabled:
+                    metrics.FLOOD_MESSAGES.inc()
+            formatted = self.format_message(requester, targets, text, now)
+            if self.segment:
+                self.segment.append(now, requester, targets, text)
+            if self.archive:
+                self.archive.add(now, requester, ",".join(targets), text)
+            channels = [target for target in targets if target[:1] == '#']
+            self.file_send(formatted, channels=channels)
+            self.backlog.add(requester, channels, formatted)
+            dispatched = self.dispatch(conn, message, flooding)
+            if not dispatched:
+                conn.last_message = self.last_message = formatted
+            if flooding or self.overload.active:
+                # Logged above; who said what last can wait.
+                if metrics.enabled:
+                    metrics.SHED.inc(label='user_update')
+                return True
+            user = self.users.touch(requester)
+            if dispatched:
+                user.update(now=now)
+            else:
+                user.update(channels=channels, message=formatted,
+                            now=now)
+                if channels:
+                    self.activity.add(requester, channels, text, now)
+            if self.state:
+                self.state.record(user)
+                if not dispatched:
+                    self.state.record_last(formatted)
+                self.state.maybe_compact(self.users, self.last_message)
+                if (time.monotonic() - self.activity_saved >=
+                        ACTIVITY_SAVE_INTERVAL):
+                    self.save_activity()
+        return True
+
+    def handle_batch(self, conn, messages):
+        """handle() what one read brought in, PINGs first.
+
+        The time it takes feeds overload detection. Returns False if
+        the connection should not be used any more.
+        """
+        start = time.perf_counter()
+        # A PING left waiting behind a flood gets us dropped.
+        for message in messages:
+            if message.command == b"PING":
+                self.handle(conn, message)
+        result = all(self.handle(conn, message) for message in messages
+                     if message.command != b"PING")
+        if self.segment:
+            self.segment.flush_due()
+        if self.overload.busy(time.perf_counter() - start):
+            if self.overload.active:
+                self.logger.warning(
+                    "falling behind ({0:.0%} busy); shedding commands and "
+                    "user updates".format(self.overload.share))
+                if metrics.enabled:
+                    metrics.OVERLOADS.inc()
+            else:
+                self.logger.warning("caught up; no longer shedding")
+        return result
 
     def loop(self, conn):
         """
         This takes conn for two reasons.
         1. We may want a Bot instance to loop on an existing socket.
         2. We may want the same instance of Bot to serve multiple sockets.
+
+        Returns why the loop ended: 'killed', 'interrupted', 'closed',
+        'keepalive' or 'throttled'.
         """
-        encoding = "ascii"
-        ignored = set([
-            b'372',  # response to MOTD at login
-            b'042',  # RPL_YOURID
-            b'375',  # MOTD
-
-        ])
-        it = protocol.message_iterator(self.logger)
-        it.send(None)
-        formatted = ''
+        it = self.message_iterator()
+        keepalive = self.app_args.keepalive
+        idle = False
+        reason = 'killed'
         with conn:
             while not self.should_die:
+                self.profiler.poll()
                 try:
                     received = conn.recv(1024)
                 except KeyboardInterrupt:
                     self.file_send("received KeyboardInterrupt")
                     conn.quit("Shutting down")
+                    reason = 'interrupted'
                     break
+                except socket.timeout:
+                    if idle:
+                        self.logger.info("no data for {0}s, closing"
+                                         .format(keepalive * 2))
+                        reason = 'keepalive'
+                        break
+                    idle = True
+                    conn.send('PING :{0}'.format(self.app_args.server))
+                    continue
+                idle = False
                 if received == b'':
                     self.file_send("connection closed")
+                    reason = 'closed'
                     break
                 self.logger.debug('received {0}'.format(received))
                 messages = it.send(received)
-                for prefix, command, params in messages:
-                    if command in ignored:
-                        continue
-                    now = Datetime.utcnow()
-                    requester = prefix.split(b"!", 1)[0].decode(encoding)
-                    if command == b"PING":
-                        conn.pong(params.decode(encoding))
-                    elif command == b"ERROR":
-                        if b"connect too fast" in params:
-                            self.logger.info("connection throttled")
-                            break
-                    elif command == b"PRIVMSG":
-                        targets, text = protocol.parse_privmsg(params)
-                        formatted = self.format_message(requester, targets, text)
-                        self.file_send(formatted)
-                        dispatched = self.dispatch(conn, prefix, targets, text)
-                        if not dispatched:
-                            print("setting conn.last_message", formatted)
-                            conn.last_message = formatted
-                        user = self.get_user(requester) or self.new_user(requester)
-                        if dispatched:
-                            user.update(now=now)
-                        else:
-                            channels = [target for target in targets
-                                        if target and target[0] == '#']
-                            user.update(channels=channels, message=formatted,
-                                        now=now)
+                if not self.handle_batch(conn, messages):
+                    reason = 'throttled'
+                    break
+        return reason
+
+    def select_loop(self, conn):
+        """loop, driven by a selector instead of blocking reads.
+
+        The socket is made non-blocking and, whenever it is readable,
+        read into the connection's ReceiveBuffer, up to READS_PER_WAKEUP
+        times, and the framer is fed views of that (it copies what it
+        keeps). Keepalive is a timer, so it works the same whether or
+        not anything arrives. Returns a reason like loop.
+        """
+        it = self.message_iterator()
+        keepalive = self.app_args.keepalive
+        reactor = Reactor()
+        reason = None
+        last_received = reactor.clock()
+        pinged = False
+
+        def readable():
+            nonlocal reason, last_received, pinged
+            # Draining a server that never pauses would starve the
+            # timers; the socket stays readable, so we'll be back.
+            for _ in range(READS_PER_WAKEUP):
+                received = conn.recv_into()
+                if received is None:
+                    return
+                if not received:
+                    self.file_send("connection closed")
+                    reason = 'closed'
+                    return
+                last_received = reactor.clock()
+                pinged = False
+                if not self.handle_batch(conn, it.send(received)):
+                    reason = 'throttled'
+                    return
+
+        def check_idle():
+            nonlocal reason, pinged
+            idle = reactor.clock() - last_received
+            if idle < keepalive:
+                reactor.call_later(keepalive - idle, check_idle)
+            elif pinged:
+                self.logger.info("no data for {0}s, closing"
+                                 .format(keepalive * 2))
+                reason = 'keepalive'
+            else:
+                pinged = True
+                conn.send('PING :{0}'.format(self.app_args.server))
+                reactor.call_later(keepalive, check_idle)
+
+        conn.set_nonblocking()
+        reactor.register(conn.sock, readable)
+        if keepalive:
+            reactor.call_later(keepalive, check_idle)
+        with conn:
+            try:
+                while reason is None and not self.should_die:
+                    self.profiler.poll()
+                    # Wake up now and then to notice should_die set by
+                    # a command on another thread.
+                    reactor.run_once(limit=1.0)
+            except KeyboardInterrupt:
+                self.file_send("received KeyboardInterrupt")
+                conn.quit("Shutting down")
+                reason = 'interrupted'
+            finally:
+                reactor.close()
+        return reason or 'killed'
 
     def shutdown(self):
         now = Datetime.utcnow()
@@ -258,4 +987,21 @@ class Bot(object):
         end_message = 'shutdown at {0}'.format(timestamp)
         self.file_send(end_message)
         self.logger.info(end_message)
-        self.app_args.output.close()
+        if self.segment:
+            self.segment.close()
+        if self.pool:
+            self.pool.close()
+            self.logger.info("commands: {0}".format(dict(self.pool.stats)))
+        if self.state:
+            self.save_activity()
+        self.writer.close()
+        if self.segment:
+            self.segment_file.close()
+        if self.archive:
+            self.archive.close()
+        if self.state:
+            self.state.close(self.users, self.last_message)
+        self.stop_metrics()
+        if self.profiler.running:
+            self.profiler.stop()
+        self.logger.info("log writer: {0}".format(self.writer.stats.as_dict()))
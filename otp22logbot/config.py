@@ -0,0 +1,116 @@
+"""Configuration files for -i/--init.
+
+The file is INI. Keys are long command line options without the
+leading dashes, like flood-rate = 2 or async = yes. [DEFAULT] applies
+everywhere; each [network:NAME] section runs one bot, in its own
+process, with its own options on top of [DEFAULT]. Options given on
+the command line win over the file. %(network)s expands to the
+network's name, so each network can get its own files:
+
+    [DEFAULT]
+    nick = otp22logbot
+    output = logs/%(network)s.log
+    state-dir = state/%(network)s
+
+    [network:freenode]
+    server = irc.freenode.net
+    channel = ircugm,otp22
+
+    [network:oftc]
+    server = irc.oftc.net
+    channel = otp22
+
+Without network sections, [DEFAULT] just sets options for the one bot.
+"""
+import configparser
+
+NETWORK_PREFIX = 'network:'
+# Options that would mean nothing in a file.
+NOT_CONFIGURABLE = frozenset(['help', 'init'])
+# Options that can't be shared between networks running at once.
+PER_NETWORK = ('output', 'shard_dir', 'binary_log', 'state_dir', 'archive')
+
+
+class ConfigError(Exception):
+    """The configuration file can't be used.
+    """
+
+
+def load(config_file):
+    """Read an open config file.
+
+    Returns (default options, [(network name, options)]), with options
+    as dicts of option name to string value.
+    """
+    parser = configparser.ConfigParser(defaults={'network': 'otp22logbot'})
+    try:
+        parser.read_file(config_file)
+    except configparser.Error as error:
+        raise ConfigError(str(error))
+    networks = []
+    for section in parser.sections():
+        if not section.startswith(NETWORK_PREFIX):
+            raise ConfigError("unknown section [{0}]; expected "
+                              "[{1}NAME]".format(section, NETWORK_PREFIX))
+        name = section[len(NETWORK_PREFIX):].strip()
+        if not name:
+            raise ConfigError("[{0}] needs a network name".format(section))
+        parser.set(section, 'network', name)
+        networks.append((name, options(parser, section)))
+    return options(parser, parser.default_section), networks
+
+
+def options(parser, section):
+    try:
+        return dict((key, value) for key, value in parser.items(section)
+                    if key != 'network')
+    except configparser.Error as error:
+        raise ConfigError(str(error))
+
+
+def apply(parser, options):
+    """Make options the defaults of an argparse parser from main.
+
+    Values are converted by argparse, as if typed on the command line.
+    """
+    actions = {}
+    for action in parser._actions:
+        for option in action.option_strings:
+            if option.startswith('--'):
+                actions[option[2:]] = action
+    defaults = {}
+    for key, value in options.items():
+        action = actions.get(key.replace('_', '-'))
+        if action is None or key in NOT_CONFIGURABLE:
+            raise ConfigError("unknown option {0!r}".format(key))
+        if action.nargs == 0:
+            # store_true, or store_false for --no-* options
+            flag = configparser.ConfigParser.BOOLEAN_STATES.get(
+                value.lower())
+            if flag is None:
+                raise ConfigError("{0} must be yes or no, not {1!r}"
+                                  .format(key, value))
+            defaults[action.dest] = action.const if flag else not action.const
+        else:
+            defaults[action.dest] = value
+    parser.set_defaults(**defaults)
+    return parser
+
+
+def check_networks(networks):
+    """Refuse networks that would write to the same files.
+
+    networks is [(name, parsed args)].
+    """
+    for option in PER_NETWORK:
+        seen = {}
+        for name, app_args in networks:
+            value = getattr(app_args, option)
+            if not value:
+                continue
+            if value in seen:
+                raise ConfigError(
+                    "networks {0} and {1} both use {2} {3}; try "
+                    "%(network)s in it".format(
+                        seen[value], name, option.replace('_', '-'), value))
+            seen[value] = name
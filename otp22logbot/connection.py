@@ -1,6 +1,53 @@
 import logging
+import selectors
 import socket
+import threading
 from socket import socket as Socket
+from otp22logbot import metrics
+from otp22logbot.sendqueue import SendQueue, URGENT, NORMAL, REPLY
+
+
+class ReceiveBuffer(object):
+    """Reusable buffer for recv_into that follows the traffic.
+
+    Doubles, up to maximum, when a read fills it, as during a NAMES
+    burst or a bouncer's playback, so bursts take few reads. Halves,
+    down to minimum, after shrink_after reads in a row that used less
+    than a quarter of it, so an idle channel doesn't pin a big buffer.
+    """
+    def __init__(self, size=4096, minimum=1024, maximum=65536,
+                 shrink_after=64):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.shrink_after = shrink_after
+        self.small = 0
+        self.allocate(max(minimum, min(size, maximum)))
+
+    def allocate(self, size):
+        # A new buffer rather than a resize: views of the old one may
+        # still be in use.
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+
+    def filled(self, count):
+        """Note a read of count bytes and return a view of them.
+
+        The view is only good until the next read into the buffer.
+        """
+        data = self.view[:count]
+        size = len(self.buffer)
+        if count == size:
+            self.small = 0
+            if size < self.maximum:
+                self.allocate(min(size * 2, self.maximum))
+        elif count < size // 4 and size > self.minimum:
+            self.small += 1
+            if self.small >= self.shrink_after:
+                self.small = 0
+                self.allocate(max(size // 2, self.minimum))
+        else:
+            self.small = 0
+        return data
 
 
 class Connection(object):
@@ -14,7 +61,14 @@ class Connection(object):
         self.sock = sock
         self.logger = logger
         self.last_message = None
-        self.encoding = "ascii"
+        # Set once the server welcomes us (001).
+        self.registered = False
+        self.encoding = "utf-8"
+        self.outbound = None
+        self.nonblocking = False
+        self.buffer = None
+        # Commands may send from worker threads.
+        self.write_lock = threading.Lock()
 
     @classmethod
     def new(cls, host, port, logger=None):
@@ -22,42 +76,126 @@ class Connection(object):
         sock = Socket()
         try:
             sock.connect((host, port))
-        except socket.error:
+        except socket.error as error:
+            logger.error("could not connect: {0}".format(error))
+            sock.close()
             return None
         return Connection(sock, logger)
 
-    def send(self, data):
+    def enable_flood_control(self, rate, burst):
+        """Queue outgoing lines and send them at most rate per second,
+        after an initial burst. PONG and QUIT skip the queue's limits.
+        """
+        self.outbound = SendQueue(
+            self.write, self.logger.getChild("sendqueue"),
+            rate=rate, burst=burst)
+
+    def send(self, data, priority=NORMAL):
         # IRC encoding seems dodgy. UTF-8 could be okay, or ISO 8859-1,
-        # but we just don't know. So punt and make it configurable -
-        # but default to enforcing ASCII.
+        # but we just don't know. Replies quote logged text, though,
+        # which is mostly UTF-8 and would vanish if we enforced ASCII;
+        # and history.chunks splits on UTF-8 lengths. So default to it.
         try:
             encoded = data.encode(self.encoding)
         except UnicodeEncodeError:
+            if metrics.enabled:
+                metrics.SEND_DROPPED.inc(label='unencodable')
             self.logger.debug('cannot safely encode data: {0!r}'
                               .format(data))
             return
         # This especially sucks with UTF-8.
         if len(encoded) > 510:
+            if metrics.enabled:
+                metrics.SEND_DROPPED.inc(label='overlong')
             self.logger.debug("cannot safely send overlong data: {0!r}"
                               .format(data[:520]))
             return
         self.logger.debug('=SENDING=>[{0}]'.format(data))
-        message = encoded + b'\r\n'
+        if self.outbound:
+            return self.outbound.put(encoded + b'\r\n', priority)
+        return self.write(encoded + b'\r\n')
+
+    def write(self, message):
+        """Put one already encoded and terminated line on the wire.
+        """
         try:
-            self.sock.sendall(message)
-        except BrokenPipeError:
+            with self.write_lock:
+                if self.nonblocking:
+                    self.write_nonblocking(message)
+                else:
+                    self.sock.sendall(message)
+        except OSError as error:
+            # Timed out (socket.timeout is an OSError), reset, broken
+            # pipe: the receive loop finds out it's over and reconnects.
+            self.logger.error("error sending: {0}".format(error))
             return 0
+        if metrics.enabled:
+            metrics.BYTES_SENT.inc(len(message))
+            metrics.LINES_SENT.inc(message.count(b'\n'))
         return len(message)
 
+    def write_nonblocking(self, message, timeout=60.0):
+        """sendall for a non-blocking socket: wait for room as needed.
+        """
+        view = memoryview(message)
+        while view:
+            try:
+                sent = self.sock.send(view)
+            except (BlockingIOError, InterruptedError):
+                with selectors.DefaultSelector() as selector:
+                    selector.register(self.sock, selectors.EVENT_WRITE)
+                    if not selector.select(timeout):
+                        raise socket.timeout("send timed out")
+                continue
+            view = view[sent:]
+
+    def set_nonblocking(self):
+        """Make reads return at once; see recv_into.
+
+        Writes still wait for room in the socket's buffer, on whichever
+        thread makes them.
+        """
+        self.sock.setblocking(False)
+        self.nonblocking = True
+        if self.buffer is None:
+            self.buffer = ReceiveBuffer()
+
+    def recv_into(self):
+        """Read what is waiting into the connection's ReceiveBuffer.
+
+        Returns a memoryview of the bytes read, good until the next
+        call: empty if the connection is closed, None if a non-blocking
+        socket has nothing more for now.
+        """
+        if self.buffer is None:
+            self.buffer = ReceiveBuffer()
+        try:
+            count = self.sock.recv_into(self.buffer.view)
+        except (BlockingIOError, InterruptedError):
+            return None
+        except socket.timeout:
+            raise
+        except OSError as error:
+            self.logger.error("connection error: {0}".format(error))
+            return memoryview(b'')
+        if metrics.enabled:
+            metrics.BYTES_RECEIVED.inc(count)
+        return self.buffer.filled(count)
+
     def recv(self, size=1024):
         # Totally ignore encoding. We can't guarantee anything about
         # what the server might be sending us, and pretty much have to
         # take whatever. Because IRC.
         try:
             buf = self.sock.recv(size)
-        except ConnectionResetError:
-            self.logger.error("Connection reset by peer")
+        except socket.timeout:
+            raise
+        except OSError as error:
+            # Reset, timed out, unreachable: all end the connection.
+            self.logger.error("connection error: {0}".format(error))
             return b''
+        if metrics.enabled:
+            metrics.BYTES_RECEIVED.inc(len(buf))
         return buf
 
     def __enter__(self):
@@ -66,13 +204,21 @@ class Connection(object):
     def __exit__(self, exc_type, exc_value, traceback):
         self.close()
 
+    def close_outbound(self):
+        if self.outbound:
+            self.outbound.close()
+            self.logger.info("send queue: {0}".format(
+                self.outbound.stats.as_dict(self.outbound.depth)))
+
     def close(self):
         self.logger.debug("closing connection")
+        self.close_outbound()
         try:
             self.sock.shutdown(socket.SHUT_RDWR)
-        except OSError:
-            self.logger.exception("OSError during sock.shutdown")
-            return
+        except OSError as error:
+            # Usually the other end is gone already.
+            self.logger.debug("during sock.shutdown: {0}".format(error))
+        # Always close, or every reconnect would leak a descriptor.
         self.sock.close()
 
     def nick(self, nickname):
@@ -92,12 +238,50 @@ class Connection(object):
         # RFC 1459 4.1.1, RFC 2812 3.1.1 - PASS before NICK, USER
         self.send('PASS {0}'.format(password))
 
+    def cap_request(self, capabilities):
+        """Ask for IRCv3 capabilities before registering.
+
+        Servers that don't know CAP just answer with an error, and
+        registration goes ahead either way after CAP END.
+        """
+        # IRCv3 capability negotiation: CAP REQ, then CAP END
+        self.send('CAP REQ :{0}'.format(' '.join(capabilities)))
+        self.send('CAP END')
+
     def join(self, channels, keys=None):
-        keys = (" " + ",".join(keys)) if keys else ''
-        # RFC 1459 4.2.1, RFC 2812 3.2.1
-        for channel in channels:
+        """Join channels using as few JOIN lines as fit in 510 bytes.
+
+        keys, if given, pair up with the first len(keys) channels.
+        """
+        # RFC 1459 4.2.1, RFC 2812 3.2.1 - JOIN <channel>{,<channel>}
+        # [<key>{,<key>}], where keys go with the leading channels.
+        keys = list(keys or [])
+        pairs = [(channel, keys[index] if index < len(keys) else None)
+                 for index, channel in enumerate(channels)]
+        # Keyed channels must come first in each line; stable sort keeps
+        # the caller's order otherwise.
+        pairs.sort(key=lambda pair: pair[1] is None)
+        batch = []
+        length = len('JOIN ')
+        for channel, key in pairs:
             assert channel.startswith('#'), channel
-            self.send('JOIN {0}{1}'.format(channel, keys))
+            # Comma plus channel, and comma plus key (or the space).
+            extra = len(channel.encode(self.encoding)) + 1
+            if key is not None:
+                extra += len(key.encode(self.encoding)) + 1
+            if batch and length + extra > 510:
+                self.send_join(batch)
+                batch = []
+                length = len('JOIN ')
+            batch.append((channel, key))
+            length += extra
+        if batch:
+            self.send_join(batch)
+
+    def send_join(self, pairs):
+        channels = ",".join(channel for channel, _ in pairs)
+        keys = ",".join(key for _, key in pairs if key is not None)
+        self.send('JOIN {0}{1}'.format(channels, " " + keys if keys else ''))
 
     def _privmsg_any(self, targets, text):
         """Just put together and send a PRIVMSG message.
@@ -111,7 +295,7 @@ class Connection(object):
         for target in targets:
             if not target:
                 continue
-            self.send('PRIVMSG {0} :{1}'.format(target, text))
+            self.send('PRIVMSG {0} :{1}'.format(target, text), REPLY)
 
     def privmsg_user(self, nickname, text):
         """Send a PRIVMSG to the named user.
@@ -140,12 +324,12 @@ class Connection(object):
         # RFC 1459 4.4.2, RFC 2812 3.3.2
         assert target
         assert text
-        self.send('NOTICE {0} :{1}'.format(target, text))
+        self.send('NOTICE {0} :{1}'.format(target, text), REPLY)
 
     def pong(self, server):
         # RFC 1459 4.6.3, RFC 2812 3.7.3
-        self.send('PONG {0}'.format(server))
+        self.send('PONG {0}'.format(server), URGENT)
 
     def quit(self, quit_message):
         # RFC 1459 4.1.6, RFC 2812 3.1.7
-        self.send('QUIT :{0}'.format(quit_message))
+        self.send('QUIT :{0}'.format(quit_message), URGENT)
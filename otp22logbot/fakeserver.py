@@ -0,0 +1,295 @@
+"""Local stand-in for an IRC server, for soak testing the bot.
+
+Accepts the bot's PASS/NICK/USER/JOIN handshake, then has a crowd of
+virtual users send PRIVMSGs to the joined channel at a set rate, cut
+into random fragments across TCP writes. It PINGs periodically and
+times the PONGs. When the run is over it closes the link (after
+asking the bot to .kill itself, with --kill) and checks that every
+message it sent shows up in the bot's log.
+
+    otp22logbot-fakeserver --port 6668 --rate 2000 --duration 3600 \\
+        --log otp22logbot.log &
+    otp22logbot -s 127.0.0.1 -p 6668 -o otp22logbot.log --no-reconnect
+"""
+import argparse
+import asyncio
+import glob
+import gzip
+import itertools
+import json
+import logging
+import random
+import re
+import socket
+import sys
+import time
+
+MESSAGE_ID = re.compile(r'soak-(\d+)-(\d+)')
+NAME = 'irc.fake.example'
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1,
+                       int(round(fraction * (len(ordered) - 1))))]
+
+
+class Session(object):
+    """One connected client and what was sent to it.
+    """
+    ids = itertools.count()
+
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.id = next(self.ids)
+        self.nick = None
+        self.channels = []
+        self.registered = asyncio.Event()
+        self.joined = asyncio.Event()
+        self.sent = 0
+        self.pings = {}
+        self.pong_latencies = []
+        self.rng = random.Random(server.seed + self.id)
+
+    def write(self, line):
+        self.writer.write(line.encode('utf-8') + b'\r\n')
+
+    async def read_loop(self):
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                return
+            parts = line.decode('utf-8', 'replace').rstrip('\r\n').split(' ')
+            command = parts[0].upper()
+            if command == 'NICK' and len(parts) > 1:
+                self.nick = parts[1]
+            elif command == 'USER' and self.nick:
+                self.write(':{0} 001 {1} :Welcome to the fake network'
+                           .format(NAME, self.nick))
+                self.registered.set()
+            elif command == 'JOIN' and len(parts) > 1:
+                for channel in parts[1].split(','):
+                    self.channels.append(channel)
+                    self.write(':{0}!bot@localhost JOIN {1}'
+                               .format(self.nick, channel))
+                self.joined.set()
+            elif command == 'PONG' and len(parts) > 1:
+                sent = self.pings.pop(parts[-1].lstrip(':'), None)
+                if sent is not None:
+                    self.pong_latencies.append(time.time() - sent)
+            elif command == 'QUIT':
+                return
+
+    async def send_fragmented(self, data):
+        """Write data in random pieces, each its own TCP write.
+        """
+        pos = 0
+        limit = self.server.fragment
+        while pos < len(data):
+            size = self.rng.randint(1, limit)
+            self.writer.write(data[pos:pos + size])
+            pos += size
+            await self.writer.drain()
+
+    async def blast(self, deadline):
+        server = self.server
+        channel = self.channels[0]
+        tick = 0.01
+        due = 0.0
+        start = time.time()
+        while time.time() < deadline:
+            due += server.rate * tick
+            lines = []
+            while due >= 1:
+                due -= 1
+                nick = 'user{0}'.format(self.rng.randrange(server.users))
+                lines.append(
+                    ':{0}!~{0}@virtual.example PRIVMSG {1} :soak-{2}-{3} {4}'
+                    .format(nick, channel, self.id, self.sent,
+                            'x' * self.rng.randint(0, 200)))
+                self.sent += 1
+            if lines:
+                await self.send_fragmented(
+                    ('\r\n'.join(lines) + '\r\n').encode('utf-8'))
+            # Keep to the schedule even when writing took a while.
+            next_tick = start + tick * (
+                int((time.time() - start) / tick) + 1)
+            await asyncio.sleep(max(0, next_tick - time.time()))
+
+    async def ping_loop(self, deadline):
+        token = itertools.count()
+        while time.time() < deadline:
+            await asyncio.sleep(self.server.ping_interval)
+            name = 'fake{0}'.format(next(token))
+            self.pings[name] = time.time()
+            self.write('PING :{0}'.format(name))
+
+    async def run(self):
+        reader = asyncio.ensure_future(self.read_loop())
+        try:
+            await asyncio.wait_for(self.joined.wait(), self.server.timeout)
+        except asyncio.TimeoutError:
+            logging.getLogger(__name__).error("client never joined")
+            reader.cancel()
+            self.writer.close()
+            return
+        deadline = time.time() + self.server.duration
+        pinger = asyncio.ensure_future(self.ping_loop(deadline))
+        await self.blast(deadline)
+        pinger.cancel()
+        # Let the last PONGs come back before hanging up.
+        await asyncio.sleep(min(1.0, self.server.ping_interval))
+        if self.server.kill:
+            self.write(':admin!~admin@virtual.example PRIVMSG {0} :.kill {1}'
+                       .format(self.nick, self.server.kill))
+            try:
+                # Until the bot QUITs.
+                await asyncio.wait_for(reader, self.server.timeout)
+            except asyncio.TimeoutError:
+                logging.getLogger(__name__).error("client ignored .kill")
+        self.write('ERROR :Closing Link: soak test over')
+        await self.writer.drain()
+        self.writer.close()
+        reader.cancel()
+
+    def report(self):
+        latencies = sorted(self.pong_latencies)
+        return {
+            'sent': self.sent,
+            'pongs': len(latencies),
+            'missed_pongs': len(self.pings),
+            'pong_p50_ms': (percentile(latencies, 0.5) or 0) * 1000,
+            'pong_p99_ms': (percentile(latencies, 0.99) or 0) * 1000,
+            'pong_max_ms': (latencies[-1] if latencies else 0) * 1000,
+        }
+
+
+class FakeServer(object):
+    def __init__(self, users=100, rate=100.0, duration=60.0,
+                 ping_interval=5.0, fragment=700, timeout=30.0, seed=22,
+                 kill=None):
+        self.users = users
+        self.rate = rate
+        self.duration = duration
+        self.ping_interval = ping_interval
+        self.fragment = fragment
+        self.timeout = timeout
+        self.seed = seed
+        self.kill = kill
+        self.sessions = []
+        self.done = asyncio.Event()
+
+    async def handle(self, reader, writer):
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        session = Session(self, reader, writer)
+        self.sessions.append(session)
+        try:
+            await session.run()
+        finally:
+            self.done.set()
+
+    async def serve(self, host, port, sessions=1, sock=None):
+        """Serve until sessions clients are done; on sock, if given.
+        """
+        if sock is not None:
+            server = await asyncio.start_server(self.handle, sock=sock)
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+        try:
+            while len([s for s in self.sessions
+                       if s.writer.is_closing()]) < sessions:
+                self.done.clear()
+                await self.done.wait()
+        finally:
+            server.close()
+
+    def report(self):
+        return [session.report() for session in self.sessions]
+
+
+def read_logs(patterns):
+    """Yield lines from the logs, including rotated and gzipped ones.
+    """
+    for pattern in patterns:
+        for path in sorted(set(glob.glob(pattern) +
+                               glob.glob(pattern + '.*'))):
+            opener = gzip.open if path.endswith('.gz') else open
+            with opener(path, 'rt', encoding='utf-8',
+                        errors='replace') as log:
+                for line in log:
+                    yield line
+
+
+def verify(sessions, patterns):
+    """Count the sent messages that are missing from the logs.
+    """
+    seen = dict((session.id, set()) for session in sessions)
+    for line in read_logs(patterns):
+        for match in MESSAGE_ID.finditer(line):
+            ids = seen.get(int(match.group(1)))
+            if ids is not None:
+                ids.add(int(match.group(2)))
+    missing = 0
+    for session in sessions:
+        missing += sum(1 for number in range(session.sent)
+                       if number not in seen[session.id])
+    return missing
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        description="Fake IRC server for soak testing otp22logbot.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6668)
+    parser.add_argument('--users', type=int, default=100,
+                        help='number of virtual users talking')
+    parser.add_argument('--rate', type=float, default=100.0,
+                        help='PRIVMSGs per second, over all users')
+    parser.add_argument('--duration', type=float, default=60.0,
+                        help='seconds to send traffic for')
+    parser.add_argument('--ping-interval', type=float, default=5.0)
+    parser.add_argument('--fragment', type=int, default=700,
+                        help='largest piece of the stream per TCP write')
+    parser.add_argument('--clients', type=int, default=1,
+                        help='exit after this many clients are done')
+    parser.add_argument('--kill', metavar='PASSWORD',
+                        help="finish by sending the bot .kill PASSWORD")
+    parser.add_argument('--log', action='append', default=[],
+                        help="bot log file to check for every message sent "
+                             "(repeatable; rotated segments are included)")
+    parser.add_argument('--grace', type=float, default=5.0,
+                        help='seconds to let the bot finish writing its log')
+    return parser
+
+
+def main(argv=None):
+    args = make_parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="[+] %(message)s")
+
+    async def run():
+        server = FakeServer(
+            users=args.users, rate=args.rate, duration=args.duration,
+            ping_interval=args.ping_interval, fragment=args.fragment,
+            kill=args.kill)
+        await server.serve(args.host, args.port, sessions=args.clients)
+        return server
+
+    server = asyncio.run(run())
+    report = {'sessions': server.report()}
+    status = 0
+    if args.log:
+        time.sleep(args.grace)
+        missing = verify(server.sessions, args.log)
+        report['missing'] = missing
+        status = 1 if missing else 0
+    print(json.dumps(report, indent=2, sort_keys=True))
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,204 @@
+"""Scrollback for .history, served from the text log.
+
+The most recent channel messages are kept in a small ring in memory,
+so most requests never touch the disk. Older ones are found by
+memory-mapping the log and scanning it backwards from the end, a line
+at a time, so only as much of the file is read as the answer needs.
+
+Where the matches for each filter were found is remembered in a sparse
+index of their offsets. Asking again, or for more, reads those lines
+straight out of the map and only scans what was written since and
+what lies before the oldest match already known.
+
+Only lines with a channel among their targets are history; private
+messages to the bot are never played back.
+"""
+import collections
+import mmap
+import os
+import re
+import threading
+
+MESSAGE_LINE = re.compile(br'^<[^>]*> (\S+) \(([^)]*)\): ')
+# Bytes of a line sent per PRIVMSG, leaving room for the command, a
+# long nick and the server's prefix on the way out.
+CHUNK_SIZE = 400
+
+
+def parse(line):
+    """(nick, [channels]) for a message line as bytes, or None.
+    """
+    match = MESSAGE_LINE.match(line)
+    if not match:
+        return None
+    nick, targets = match.groups()
+    channels = [target for target in targets.split(b',')
+                if target[:1] == b'#']
+    if not channels:
+        return None
+    return (nick.decode('utf-8', 'replace'),
+            [channel.decode('utf-8', 'replace') for channel in channels])
+
+
+def matcher(channel=None, nick=None):
+    """Test for (nick, channels) picking the lines a request wants.
+    """
+    channel = channel.lower() if channel else None
+    nick = nick.lower() if nick else None
+
+    def match(speaker, channels):
+        if nick and speaker.lower() != nick:
+            return False
+        if channel:
+            return any(name.lower() == channel for name in channels)
+        return True
+    return match
+
+
+def scan(data, start, end, match, wanted):
+    """Find up to wanted matching lines in data[start:end], newest first.
+
+    start and end are line boundaries. Returns (offsets of the lines
+    found, where the scan stopped); everything from there to end has
+    been looked at.
+    """
+    found = []
+    position = end
+    while position > start and len(found) < wanted:
+        # position is just past a newline.
+        head = max(data.rfind(b'\n', start, position - 1) + 1, start)
+        parsed = parse(data[head:position - 1])
+        if parsed and match(*parsed):
+            found.append(head)
+        position = head
+    return found, position
+
+
+def line_at(data, offset):
+    end = data.find(b'\n', offset)
+    return data[offset:end].decode('utf-8', 'replace')
+
+
+def chunks(text, size=CHUNK_SIZE):
+    """Split text into pieces of at most size bytes of UTF-8, without
+    cutting a character in two.
+    """
+    data = text.encode('utf-8')
+    pieces = []
+    while data:
+        cut = min(size, len(data))
+        # Back up off continuation bytes, 10xxxxxx.
+        while cut < len(data) and cut > 1 and data[cut] & 0xC0 == 0x80:
+            cut -= 1
+        pieces.append(data[:cut].decode('utf-8', 'replace'))
+        data = data[cut:]
+    return pieces
+
+
+class Index(object):
+    """Offsets of the newest matches for one filter in one file.
+
+    offsets holds every match between floor and end, newest first.
+    """
+    def __init__(self, identity, end, floor, offsets):
+        self.identity = identity
+        self.end = end
+        self.floor = floor
+        self.offsets = offsets
+
+
+class History(object):
+    """Recent lines in memory, older ones from the log file.
+
+    add() is called with every channel message as it is logged; lines()
+    answers requests, from any thread. Up to max_indexes filters are
+    indexed, the least recently asked for being forgotten first, each
+    keeping the offsets of its newest depth matches.
+    """
+    def __init__(self, size=500, depth=100, max_indexes=64):
+        self.ring = collections.deque(maxlen=max(1, size))
+        self.depth = depth
+        self.max_indexes = max_indexes
+        self.indexes = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, nick, channels, line):
+        if channels:
+            self.ring.append((nick, channels, line))
+
+    def recent(self, match, count):
+        """The newest count matching lines from the ring, newest first,
+        or None if the ring doesn't have that many.
+        """
+        # Copying a deque is atomic, so add() needn't take a lock.
+        entries = list(self.ring)
+        found = []
+        for nick, channels, line in reversed(entries):
+            if match(nick, channels):
+                found.append(line)
+                if len(found) == count:
+                    return found
+        return None
+
+    def lines(self, path, count, channel=None, nick=None, sync=None):
+        """The last count lines matching channel and nick, oldest first.
+
+        The ring answers if it can. Otherwise sync, if given, is called
+        to get everything logged so far onto the disk, and path is
+        scanned.
+        """
+        match = matcher(channel, nick)
+        found = self.recent(match, count)
+        if found is None:
+            if sync:
+                sync()
+            with self.lock:
+                found = self.search(path, count, match, (
+                    channel.lower() if channel else None,
+                    nick.lower() if nick else None))
+        found.reverse()
+        return found
+
+    def search(self, path, count, match, key):
+        try:
+            log = open(path, 'rb')
+        except (IOError, OSError):
+            return []
+        with log:
+            stat = os.fstat(log.fileno())
+            if not stat.st_size:
+                return []
+            data = mmap.mmap(log.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return self.search_map(data, (path, key), count, match,
+                                   (stat.st_dev, stat.st_ino))
+        finally:
+            data.close()
+
+    def search_map(self, data, key, count, match, identity):
+        # A partly flushed last line isn't there yet.
+        end = data.rfind(b'\n') + 1
+        index = self.indexes.pop(key, None)
+        if index and (index.identity != identity or index.end > end):
+            # Rotated or truncated under us.
+            index = None
+        if index:
+            offsets, floor = scan(data, index.end, end, match, count)
+            if floor == index.end:
+                # All that's new has been looked at; what the index
+                # knows carries on from there.
+                offsets.extend(index.offsets)
+                floor = index.floor
+        else:
+            offsets, floor = [], end
+        if len(offsets) < count:
+            older, floor = scan(data, 0, floor, match, count - len(offsets))
+            offsets.extend(older)
+        kept = offsets[:max(count, self.depth)]
+        if len(kept) < len(offsets):
+            floor = kept[-1]
+        self.indexes[key] = Index(identity, end, floor, kept)
+        while len(self.indexes) > self.max_indexes:
+            self.indexes.popitem(last=False)
+        offsets = offsets[:count]
+        return [line_at(data, offset) for offset in offsets]
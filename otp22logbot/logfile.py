@@ -0,0 +1,228 @@
+import collections
+import gzip
+import os
+import re
+import shutil
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class Compressor(object):
+    """Gzip closed log segments on a background thread.
+    """
+    def __init__(self, logger):
+        self.logger = logger
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(
+            target=self.run, name="otp22logbot-compressor")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, path):
+        self.queue.put(path)
+
+    def close(self):
+        """Finish compressing everything already submitted.
+        """
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        while True:
+            path = self.queue.get()
+            if path is None:
+                return
+            try:
+                self.compress(path)
+            except (IOError, OSError):
+                self.logger.exception("error compressing {0}".format(path))
+
+    def compress(self, path):
+        partial = path + '.gz.part'
+        with open(path, 'rb') as source:
+            with gzip.open(partial, 'wb') as dest:
+                shutil.copyfileobj(source, dest, 1 << 20)
+        os.rename(partial, path + '.gz')
+        os.remove(path)
+        self.logger.info("compressed {0}".format(path))
+
+
+class RotatingLog(object):
+    """Text log file that rolls over to a new segment.
+
+    Rolls over when the current segment reaches max_bytes, when
+    interval seconds have passed since it was opened, or when rotate()
+    is called. The closed segment is renamed with a timestamp suffix
+    and, if compress is set, gzipped in the background.
+
+    Not thread safe: everything is expected to be called from one
+    thread, which is the log writer's, so a rotation always falls
+    between two whole batches of lines and nothing is lost or
+    reordered around it.
+
+    If a rotation fails, writing carries on to the same file, and the
+    size and age limits aren't tried again for retry_delay seconds.
+    """
+    def __init__(self, name, logger, max_bytes=0, interval=0,
+                 compress=False, compressor=None, retry_delay=60.0):
+        self.name = name
+        self.logger = logger
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.retry_delay = retry_delay
+        self.retry_after = 0
+        # A compressor passed in is shared, and closed by its owner.
+        self.owns_compressor = compress and not compressor
+        if self.owns_compressor:
+            compressor = Compressor(logger)
+        self.compressor = compressor
+        self.file = None
+        self.open()
+
+    def open(self):
+        self.file = open(self.name, 'a')
+        self.size = self.file.tell()
+        self.opened = time.time()
+
+    def write(self, data):
+        self.file.write(data)
+        # Characters, not bytes, but close enough for a size limit.
+        self.size += len(data)
+        if ((self.max_bytes and self.size >= self.max_bytes) or
+                (self.interval and
+                 time.time() - self.opened >= self.interval)):
+            if time.time() >= self.retry_after:
+                self.rotate()
+
+    def flush(self):
+        self.file.flush()
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def fsync(self):
+        os.fsync(self.file.fileno())
+
+    def segment_name(self):
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.gmtime())
+        base = '{0}.{1}'.format(self.name, stamp)
+        candidate = base
+        count = 0
+        while (os.path.exists(candidate) or
+               os.path.exists(candidate + '.gz')):
+            count += 1
+            candidate = '{0}.{1}'.format(base, count)
+        return candidate
+
+    def rotate(self):
+        """Close the current segment and start a new one.
+        """
+        if not self.size:
+            return None
+        self.file.close()
+        segment = self.segment_name()
+        try:
+            os.rename(self.name, segment)
+        except OSError:
+            self.logger.exception("error rotating log to {0}".format(segment))
+            self.retry_after = time.time() + self.retry_delay
+            return None
+        finally:
+            # Renamed or not, there has to be a file to write to.
+            self.open()
+        self.logger.info("rotated log to {0}".format(segment))
+        if self.compressor:
+            self.compressor.submit(segment)
+        return segment
+
+    def close(self):
+        self.file.close()
+        if self.owns_compressor:
+            self.compressor.close()
+
+
+def shard_filename(key):
+    """Make a channel name safe to use as a file name.
+    """
+    # Channel names are case insensitive and may contain almost
+    # anything but spaces, commas and BEL. Escaping UTF-8 bytes rather
+    # than code points keeps every escape the same width, so no two
+    # names share a file.
+    return re.sub(
+        rb'[^a-z0-9#_.-]',
+        lambda match: '%{0:02x}'.format(ord(match.group(0))).encode(),
+        key.lower().encode('utf-8')).decode('ascii').lstrip('.') + '.log'
+
+
+class ShardedLog(object):
+    """Main log plus one RotatingLog per channel in a directory.
+
+    Only max_open channel files are kept open at a time; the least
+    recently written one is closed to make room, and is simply reopened
+    for append when its channel speaks again. Like RotatingLog, this is
+    meant to be used from the log writer's thread only.
+    """
+    def __init__(self, main, directory, logger, max_open=64, max_bytes=0,
+                 interval=0, compress=False):
+        self.main = main
+        self.name = main.name
+        self.directory = directory
+        self.logger = logger
+        self.max_open = max(1, max_open)
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.compressor = Compressor(logger) if compress else None
+        self.shards = collections.OrderedDict()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def shard(self, key):
+        key = key.lower()
+        log = self.shards.get(key)
+        if log:
+            self.shards.move_to_end(key)
+            return log
+        while len(self.shards) >= self.max_open:
+            _, idle = self.shards.popitem(last=False)
+            idle.close()
+        log = RotatingLog(
+            os.path.join(self.directory, shard_filename(key)), self.logger,
+            max_bytes=self.max_bytes, interval=self.interval,
+            compressor=self.compressor)
+        self.shards[key] = log
+        return log
+
+    def write(self, data):
+        self.main.write(data)
+
+    def write_shard(self, key, data):
+        self.shard(key).write(data)
+
+    def flush(self):
+        self.main.flush()
+        for log in self.shards.values():
+            log.flush()
+
+    def fsync(self):
+        self.main.fsync()
+        for log in self.shards.values():
+            log.fsync()
+
+    def rotate(self):
+        """Rotate the main log and every channel log currently open.
+        """
+        self.main.rotate()
+        for log in self.shards.values():
+            log.rotate()
+
+    def close(self):
+        for log in self.shards.values():
+            log.close()
+        self.shards.clear()
+        self.main.close()
+        if self.compressor:
+            self.compressor.close()
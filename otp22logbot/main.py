@@ -13,7 +13,18 @@ This is the primary application driver file.
 import sys
 import logging
 import argparse
+from otp22logbot import config
 from otp22logbot.bot import Bot
+from otp22logbot.writer import LogWriter
+
+
+def channel_list(value):
+    """-c: comma separated channel names, at least one of them.
+    """
+    if not any(name.strip().lstrip('#') for name in value.split(',')):
+        raise argparse.ArgumentTypeError(
+            "no channel name in {0!r}".format(value))
+    return value
 
 
 def make_parser():
@@ -22,13 +33,14 @@ def make_parser():
     )
     parser.add_argument(
         '-c', '--channel',
-        help='IRC channel to join.',
+        help='IRC channel to join, or a comma separated list of them.',
         default='ircugm',
-        type=str
+        type=channel_list
     )
     parser.add_argument(
         '-i', '--init',
-        help='Specify initialization/configuration file for logbot',
+        help='Configuration file: options, and optionally several '
+             'networks to run at once (see otp22logbot/config.py).',
         default=False,
         type=argparse.FileType('r')
     )
@@ -48,7 +60,7 @@ def make_parser():
         '-o', '--output',
         help='Output log filename.',
         default='otp22logbot.log',
-        type=argparse.FileType('w')
+        type=str
     )
     parser.add_argument(
         '-p', '--port',
@@ -79,6 +91,257 @@ def make_parser():
         action="store",
         help="password to give to server in PASS command"
     )
+    parser.add_argument(
+        '--flush-lines',
+        help='Flush the output log after this many lines.',
+        default=100,
+        type=int
+    )
+    parser.add_argument(
+        '--flush-interval',
+        help='Flush the output log at least this often, in milliseconds.',
+        default=200,
+        type=int
+    )
+    parser.add_argument(
+        '--fsync',
+        action="store_true",
+        help="fsync the output log on every flush"
+    )
+    parser.add_argument(
+        '--queue-size',
+        help='Maximum number of log lines waiting to be written.',
+        default=10000,
+        type=int
+    )
+    parser.add_argument(
+        '--overflow',
+        help='What to do with a log line when the queue is full.',
+        default='block',
+        choices=LogWriter.overflows
+    )
+    parser.add_argument(
+        '--rotate-size',
+        help='Rotate the output log when it reaches this many bytes '
+             '(0 to disable).',
+        default=0,
+        type=int
+    )
+    parser.add_argument(
+        '--rotate-interval',
+        help='Rotate the output log after this many seconds '
+             '(0 to disable).',
+        default=0,
+        type=int
+    )
+    parser.add_argument(
+        '--compress',
+        action="store_true",
+        help="gzip rotated log segments in the background"
+    )
+    parser.add_argument(
+        '--shard-dir',
+        help='Log each channel to its own file in this directory.',
+        default=None,
+        type=str
+    )
+    parser.add_argument(
+        '--max-open-files',
+        help='With --shard-dir, how many channel logs to keep open.',
+        default=64,
+        type=int
+    )
+    parser.add_argument(
+        '--encodings',
+        help='Comma separated encodings to try, in order, on received '
+             'text.',
+        default='utf-8,latin-1',
+        type=str
+    )
+    parser.add_argument(
+        '--server-time',
+        action="store_true",
+        help="ask the server for IRCv3 server-time tags, so logged times "
+             "are right during backlog playback"
+    )
+    parser.add_argument(
+        '--max-users',
+        help='Forget the least recently active users past this many '
+             '(0 for no limit).',
+        default=100000,
+        type=int
+    )
+    parser.add_argument(
+        '--history-size',
+        help='Recent channel messages kept in memory for .history; '
+             'older ones are read from the log.',
+        default=500,
+        type=int
+    )
+    parser.add_argument(
+        '--history-max',
+        help='Most lines one .history request may ask for.',
+        default=50,
+        type=int
+    )
+    parser.add_argument(
+        '--binary-log',
+        help='Also log messages to this file in the compact binary '
+             'segment format (see otp22logbot-segment).',
+        default=None,
+        type=str
+    )
+    parser.add_argument(
+        '--state-dir',
+        help='Keep user state in this directory across restarts.',
+        default=None,
+        type=str
+    )
+    parser.add_argument(
+        '--stats-max-nicks',
+        help='Nicks counted separately per channel for .top; past this, '
+             'the quietest are forgotten or lumped together.',
+        default=1000,
+        type=int
+    )
+    parser.add_argument(
+        '--archive',
+        help='Also store messages in this SQLite database for .search.',
+        default=None,
+        type=str
+    )
+    parser.add_argument(
+        '--flood-rate',
+        help='Lines per second to send once the burst is used up '
+             '(0 disables flood control).',
+        default=1.0,
+        type=float
+    )
+    parser.add_argument(
+        '--flood-burst',
+        help='Lines that may be sent at once before --flood-rate applies.',
+        default=5,
+        type=int
+    )
+    parser.add_argument(
+        '--user-flood-limit',
+        help='Messages one nick may send per --user-flood-window before '
+             'their commands and user updates are skipped (0 for no '
+             'limit).',
+        default=20,
+        type=int
+    )
+    parser.add_argument(
+        '--user-flood-window',
+        help='Seconds over which --user-flood-limit is counted.',
+        default=10.0,
+        type=float
+    )
+    parser.add_argument(
+        '--overload-command-rate',
+        help='Commands per second still run while the bot is falling '
+             'behind (0 to run none).',
+        default=0.5,
+        type=float
+    )
+    parser.add_argument(
+        '--command-workers',
+        help="Threads running commands (0 runs them inline in the "
+             "receive loop, or with --async on asyncio's default "
+             "executor).",
+        default=4,
+        type=int
+    )
+    parser.add_argument(
+        '--command-queue',
+        help='Commands that may wait for a free worker before new ones '
+             'are refused.',
+        default=32,
+        type=int
+    )
+    parser.add_argument(
+        '--command-timeout',
+        help='Seconds before a running command is reported as timed out.',
+        default=10.0,
+        type=float
+    )
+    parser.add_argument(
+        '--commands-per-user',
+        help='Commands one nick may have running or waiting at once.',
+        default=2,
+        type=int
+    )
+    parser.add_argument(
+        '--metrics',
+        action="store_true",
+        help="collect runtime metrics (see .stats)"
+    )
+    parser.add_argument(
+        '--metrics-port',
+        help='Serve metrics for Prometheus on 127.0.0.1 at this port '
+             '(implies --metrics).',
+        default=None,
+        type=int
+    )
+    parser.add_argument(
+        '--metrics-file',
+        help='Write metrics in Prometheus text format to this file every '
+             '15 seconds (implies --metrics).',
+        default=None,
+        type=str
+    )
+    parser.add_argument(
+        '--profile',
+        nargs='?',
+        const='cpu',
+        choices=['cpu', 'sample'],
+        default=None,
+        help="profile the receive loop from startup until shutdown"
+    )
+    parser.add_argument(
+        '--profile-dir',
+        help='Directory for profiling reports (see also .profile).',
+        default='.',
+        type=str
+    )
+    parser.add_argument(
+        '--async',
+        dest='use_async',
+        action="store_true",
+        help="run the connection on an asyncio event loop"
+    )
+    parser.add_argument(
+        '--selector',
+        action="store_true",
+        help="read the connection with a selector: non-blocking reads "
+             "into a buffer sized to the traffic, keepalive on a timer"
+    )
+    parser.add_argument(
+        '--keepalive',
+        help='PING the server after this many idle seconds and drop the '
+             'connection after twice that (0 to disable).',
+        default=120,
+        type=int
+    )
+    parser.add_argument(
+        '--no-reconnect',
+        dest='reconnect',
+        action="store_false",
+        help="exit when the connection is lost instead of reconnecting"
+    )
+    parser.add_argument(
+        '--reconnect-delay',
+        help='Seconds to wait before the first reconnect attempt; it '
+             'doubles, with jitter, on each failed attempt.',
+        default=1.0,
+        type=float
+    )
+    parser.add_argument(
+        '--reconnect-max-delay',
+        help='Longest wait between reconnect attempts, in seconds.',
+        default=300.0,
+        type=float
+    )
     parser.add_argument(
         '--debug',
         action="store_true",
@@ -87,14 +350,15 @@ def make_parser():
     return parser
 
 
-def configure_logging(app_args):
+def configure_logging(app_args, network=None):
     logger = logging.getLogger(__name__)
     if app_args.debug:
         logger.setLevel(logging.DEBUG)
     else:
         logger.setLevel(logging.INFO)
+    prefix = "[{0}] ".format(network) if network else ""
     console_formatter = logging.Formatter(
-        fmt="[+] %(message)s",
+        fmt="[+] " + prefix.replace('%', '%%') + "%(message)s",
     )
     console_handler = logging.StreamHandler(sys.stdout)
     console_handler.setFormatter(console_formatter)
@@ -103,19 +367,62 @@ def configure_logging(app_args):
     return logger
 
 
-def main():
-    parser = make_parser()
-    app_args = parser.parse_args()
-    logger = configure_logging(app_args)
+def run_bot(app_args, logger):
+    if app_args.use_async:
+        from otp22logbot.aio import AsyncBot
+        bot = AsyncBot(app_args, logger.getChild("bot"))
+        bot.startup()
+        try:
+            bot.run()
+        finally:
+            bot.shutdown()
+        return
     bot = Bot(app_args, logger.getChild("bot"))
     bot.startup()
     try:
-        sock = bot.connect()
-        bot.handshake(sock)
-        bot.loop(sock)
+        bot.run()
     finally:
         bot.shutdown()
 
 
+def network_args(argv, defaults, options):
+    """Parse argv for one network of a config file.
+
+    Metrics are collected in the worker but exported by the supervisor.
+    """
+    parser = make_parser()
+    config.apply(parser, dict(defaults, **options))
+    app_args = parser.parse_args(argv)
+    # Workers get the name; an open file can't go to another process.
+    app_args.init.close()
+    app_args.init = app_args.init.name
+    app_args.metrics = bool(app_args.metrics or app_args.metrics_port or
+                            app_args.metrics_file)
+    app_args.metrics_port = app_args.metrics_file = None
+    return app_args
+
+
+def main(argv=None):
+    parser = make_parser()
+    app_args = parser.parse_args(argv)
+    if app_args.init:
+        try:
+            with app_args.init:
+                defaults, networks = config.load(app_args.init)
+            app_args = config.apply(make_parser(), defaults).parse_args(argv)
+            app_args.init.close()
+            networks = [(name, network_args(argv, defaults, options))
+                        for name, options in networks]
+            config.check_networks(networks)
+        except config.ConfigError as error:
+            parser.error("{0}: {1}".format(app_args.init.name, error))
+        if networks:
+            from otp22logbot import supervisor
+            logger = configure_logging(app_args)
+            return supervisor.run(networks, app_args, logger)
+    logger = configure_logging(app_args)
+    run_bot(app_args, logger)
+
+
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
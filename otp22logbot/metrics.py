@@ -0,0 +1,366 @@
+"""Process-wide counters and histograms.
+
+Collection is off until enable() is called, and every instrumented spot
+checks metrics.enabled first, so a bot without metrics only pays for
+that check. Each metric has its own lock, taken for every update and
+whenever its values are copied for rendering, so the exporter threads
+see a consistent view and concurrent increments are not lost.
+
+The registry can be rendered in the Prometheus text exposition format,
+served over HTTP or written to a textfile for node_exporter. Other
+processes' registries can be shipped over as snapshots and rendered
+together, labelled by network; see Aggregate.
+"""
+import bisect
+import copy
+import itertools
+import os
+import threading
+import time
+
+enabled = False
+
+
+class Counter(object):
+    """Monotonic count, optionally split by one label.
+    """
+    kind = 'counter'
+
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, label=None):
+        with self.lock:
+            self.values[label] = self.values.get(label, 0) + amount
+
+    def value(self, label=None):
+        return self.values.get(label, 0)
+
+    def total(self):
+        with self.lock:
+            return sum(self.values.values())
+
+    def copy(self):
+        """A copy of the values, safe to iterate while others update.
+        """
+        with self.lock:
+            return copy.deepcopy(self.values)
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+    def samples(self, values=None, extra=()):
+        """(name, label pairs, value) for each sample, from values (as
+        in a snapshot) or this metric's own, with extra label pairs.
+        """
+        values = self.copy() if values is None else values
+        for label, value in sorted(values.items(),
+                                   key=lambda item: str(item[0])):
+            yield self.name, self.labelled(label, *extra), value
+
+    def labelled(self, label, *extra):
+        pairs = []
+        if self.label and label is not None:
+            pairs.append((self.label, label))
+        pairs.extend(extra)
+        return pairs
+
+
+class Gauge(Counter):
+    """Current level of something, optionally split by one label.
+    """
+    kind = 'gauge'
+
+    def set(self, value, label=None):
+        with self.lock:
+            self.values[label] = value
+
+
+class Histogram(Counter):
+    """Distribution of observations (seconds, by default buckets).
+    """
+    kind = 'histogram'
+    default_buckets = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005,
+                       0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+    def __init__(self, name, help, label=None, buckets=None):
+        Counter.__init__(self, name, help, label)
+        self.buckets = tuple(buckets or self.default_buckets)
+
+    def observe(self, value, label=None):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(label)
+            if entry is None:
+                # counts per bucket (last one is +Inf), then sum
+                entry = self.values[label] = [
+                    [0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def count(self, label=None):
+        entry = self.values.get(label)
+        return sum(entry[0]) if entry else 0
+
+    def mean(self, label=None):
+        entry = self.values.get(label)
+        return entry[1] / sum(entry[0]) if entry else 0.0
+
+    def quantile(self, fraction, label=None):
+        """Upper bound of the bucket holding the given quantile.
+        """
+        entry = self.values.get(label)
+        if not entry:
+            return 0.0
+        wanted = fraction * sum(entry[0])
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), entry[0]):
+            seen += count
+            if seen >= wanted:
+                return bound
+        return float('inf')
+
+    def samples(self, values=None, extra=()):
+        values = self.copy() if values is None else values
+        for label, (counts, total) in sorted(values.items(),
+                                             key=lambda item: str(item[0])):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                yield (self.name + '_bucket',
+                       self.labelled(label, *(extra + (('le', le),))),
+                       cumulative)
+            yield self.name + '_sum', self.labelled(label, *extra), total
+            yield (self.name + '_count', self.labelled(label, *extra),
+                   cumulative)
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, label=None):
+        return self.add(Counter(name, help, label))
+
+    def gauge(self, name, help, label=None):
+        return self.add(Gauge(name, help, label))
+
+    def histogram(self, name, help, label=None, buckets=None):
+        return self.add(Histogram(name, help, label, buckets))
+
+    def reset(self):
+        for metric in self.metrics:
+            metric.clear()
+
+    def snapshot(self):
+        """Every metric's values, as plain picklable data.
+        """
+        return dict((metric.name, metric.copy())
+                    for metric in self.metrics)
+
+    def exposition(self, snapshots=None):
+        """Everything in the Prometheus text format.
+
+        snapshots, if given, maps network names to snapshot()s taken in
+        other processes; those are rendered, with a network label,
+        instead of this registry's own values.
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP {0} {1}'.format(metric.name, metric.help))
+            lines.append('# TYPE {0} {1}'.format(metric.name, metric.kind))
+            if snapshots is None:
+                samples = metric.samples()
+            else:
+                samples = itertools.chain.from_iterable(
+                    metric.samples(snapshot.get(metric.name, {}),
+                                   (('network', network),))
+                    for network, snapshot in sorted(snapshots.items()))
+            for name, labels, value in samples:
+                if labels:
+                    name += '{' + ','.join(
+                        '{0}="{1}"'.format(key, escape(str(val)))
+                        for key, val in labels) + '}'
+                lines.append('{0} {1}'.format(name, value))
+        return '\n'.join(lines) + '\n'
+
+
+def escape(value):
+    return (value.replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+REGISTRY = Registry()
+
+LINES_PARSED = REGISTRY.counter(
+    'otp22logbot_lines_parsed_total', 'IRC lines parsed into messages.')
+PARSE_ERRORS = REGISTRY.counter(
+    'otp22logbot_parse_errors_total', 'Lines that failed to parse.',
+    label='type')
+BYTES_RECEIVED = REGISTRY.counter(
+    'otp22logbot_received_bytes_total', 'Bytes read from the server.')
+BYTES_SENT = REGISTRY.counter(
+    'otp22logbot_sent_bytes_total', 'Bytes sent to the server.')
+LINES_SENT = REGISTRY.counter(
+    'otp22logbot_sent_lines_total', 'Lines sent to the server.')
+SEND_DROPPED = REGISTRY.counter(
+    'otp22logbot_send_dropped_total', 'Outgoing lines refused.',
+    label='reason')
+SEND_QUEUE_DEPTH = REGISTRY.gauge(
+    'otp22logbot_send_queue_depth',
+    'Outgoing lines waiting for flood control.')
+SEND_QUEUE_WAIT_SECONDS = REGISTRY.histogram(
+    'otp22logbot_send_queue_wait_seconds',
+    'Time outgoing lines wait for flood control.',
+    buckets=(0.001, 0.01, 0.1, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0))
+LOG_DROPPED = REGISTRY.counter(
+    'otp22logbot_log_dropped_total',
+    'Log lines dropped because the writer queue was full.')
+LOG_WRITE_SECONDS = REGISTRY.histogram(
+    'otp22logbot_log_write_seconds',
+    'Time to hand one line to the log writer (file_send).')
+LOG_BATCH_SECONDS = REGISTRY.histogram(
+    'otp22logbot_log_batch_write_seconds',
+    'Time the log writer thread spends writing one batch.')
+COMMANDS = REGISTRY.counter(
+    'otp22logbot_commands_total', 'Commands run.', label='command')
+COMMAND_SECONDS = REGISTRY.histogram(
+    'otp22logbot_command_seconds', 'Time spent running commands.',
+    label='command')
+RECONNECTS = REGISTRY.counter(
+    'otp22logbot_reconnects_total', 'Reconnect attempts, by what ended '
+    'the previous connection.', label='reason')
+RECONNECT_SECONDS = REGISTRY.histogram(
+    'otp22logbot_reconnect_seconds',
+    'Time from losing the connection to being connected again.',
+    buckets=(0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0))
+
+OVERLOADS = REGISTRY.counter(
+    'otp22logbot_overloads_total',
+    'Times the receive loop fell behind and started shedding work.')
+SHED = REGISTRY.counter(
+    'otp22logbot_shed_total', 'Work skipped to keep up with a flood.',
+    label='what')
+FLOOD_MESSAGES = REGISTRY.counter(
+    'otp22logbot_flood_messages_total',
+    'Messages from nicks over --user-flood-limit.')
+
+
+class Aggregate(object):
+    """Latest snapshot from each network's process, rendered together.
+
+    Has exposition(), so it can stand in for a Registry with
+    TextfileExporter and serve_http.
+    """
+    def __init__(self, registry=REGISTRY):
+        self.registry = registry
+        self.snapshots = {}
+        self.lock = threading.Lock()
+
+    def update(self, network, snapshot):
+        with self.lock:
+            self.snapshots[network] = snapshot
+
+    def total(self, network, name):
+        """Sum of a counter's values in one network's snapshot.
+        """
+        with self.lock:
+            values = self.snapshots.get(network, {}).get(name, {})
+        return sum(values.values())
+
+    def exposition(self):
+        with self.lock:
+            snapshots = dict(self.snapshots)
+        return self.registry.exposition(snapshots)
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+class TextfileExporter(object):
+    """Write the exposition to a file every interval seconds.
+
+    The file is replaced atomically, so a reader never sees half of it.
+    """
+    def __init__(self, path, logger, interval=15.0, registry=REGISTRY):
+        self.path = path
+        self.logger = logger
+        self.interval = interval
+        self.registry = registry
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(
+            target=self.run, name="otp22logbot-metrics")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self):
+        partial = self.path + '.part'
+        try:
+            with open(partial, 'w') as out:
+                out.write(self.registry.exposition())
+            os.replace(partial, self.path)
+        except (IOError, OSError):
+            self.logger.exception("error writing metrics")
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        self.write()
+
+
+def serve_http(port, logger, host='127.0.0.1', registry=REGISTRY):
+    """Serve the exposition at /metrics from a daemon thread.
+
+    Returns the server; call shutdown() on it to stop.
+    """
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.exposition().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type',
+                             'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    server = HTTPServer((host, port), Handler)
+    thread = threading.Thread(
+        target=server.serve_forever, name="otp22logbot-metrics-http")
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def timer():
+    """Start time for an observation, or None when disabled.
+    """
+    return time.perf_counter() if enabled else None
@@ -0,0 +1,94 @@
+"""Noticing floods, so the bot can shed work instead of falling behind.
+
+Logging and answering PINGs always happen. What can wait, commands
+and user statistics, is skipped for nicks flooding the channel, and
+for everyone while the receive loop can't keep up (see Bot.handle and
+Bot.dispatch).
+"""
+import time
+
+
+class FloodDetector(object):
+    """Per-nick message rates over a sliding window.
+
+    Each nick costs one small list: when its current fixed window
+    started, and the counts in that window and the one before. The
+    count over the last window seconds is estimated by weighting the
+    previous window's count by how much of it still overlaps, which is
+    close enough to tell a flood from a conversation at a constant cost
+    per message. Nicks quiet for two windows are forgotten by a sweep
+    every two windows.
+    """
+    def __init__(self, limit=20, window=10.0):
+        self.limit = limit
+        self.window = float(window)
+        self.nicks = {}
+        self.swept = None
+
+    def hit(self, nick, now):
+        """Count a message from nick; True if nick is over the limit.
+        """
+        window = self.window
+        entry = self.nicks.get(nick)
+        if entry is None:
+            # start, previous count, current count
+            entry = self.nicks[nick] = [now, 0, 0]
+        elapsed = now - entry[0]
+        if elapsed >= window:
+            periods = int(elapsed // window)
+            entry[0] += periods * window
+            elapsed -= periods * window
+            entry[1] = entry[2] if periods == 1 else 0
+            entry[2] = 0
+        entry[2] += 1
+        if self.swept is None:
+            self.swept = now
+        elif now - self.swept >= 2 * window:
+            self.sweep(now)
+        return entry[1] * (1 - elapsed / window) + entry[2] > self.limit
+
+    def sweep(self, now):
+        self.swept = now
+        stale = [nick for nick, entry in self.nicks.items()
+                 if now - entry[0] >= 2 * self.window]
+        for nick in stale:
+            del self.nicks[nick]
+
+
+class Overload(object):
+    """Notices when the receive loop can't keep up with the server.
+
+    The loop reports the time it spends handling each batch of
+    messages with busy(). Over each interval, the share of wall time
+    spent busy says how close it is to falling behind: near 1, there is
+    data waiting every time it reads, and the backlog in the socket,
+    and the lag behind the server, can only grow. Overload starts when
+    the share reaches enter and ends once it drops below leave.
+    """
+    def __init__(self, enter=0.9, leave=0.5, interval=1.0,
+                 clock=time.monotonic):
+        self.enter = enter
+        self.leave = leave
+        self.interval = interval
+        self.clock = clock
+        self.active = False
+        self.share = 0.0
+        self.started = clock()
+        self.spent = 0.0
+
+    def busy(self, seconds):
+        """Add seconds of work; returns True if active just changed.
+        """
+        self.spent += seconds
+        now = self.clock()
+        elapsed = now - self.started
+        if elapsed < self.interval:
+            return False
+        self.share = self.spent / elapsed
+        self.started = now
+        self.spent = 0.0
+        if self.active:
+            self.active = self.share >= self.leave
+            return not self.active
+        self.active = self.share >= self.enter
+        return self.active
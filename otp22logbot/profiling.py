@@ -0,0 +1,195 @@
+"""On-demand CPU profiling and allocation tracing.
+
+Requests to start or stop can come from any thread (a command handler,
+say), but are carried out by the receive loop calling poll(), since
+cProfile only sees the thread that enables it. Reports go to files in
+a directory: a .pstats dump and a text summary of the hottest
+functions, and a text summary of the top allocation sites, both in
+total and grown since profiling started.
+"""
+import collections
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+
+class Sampler(object):
+    """Poor man's sampling profiler for one thread.
+
+    Much cheaper than cProfile on a busy loop: a daemon thread looks at
+    the target thread's stack every interval seconds.
+    """
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.own = collections.Counter()
+        self.total = collections.Counter()
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(
+            target=self.run, name="otp22logbot-sampler")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            self.samples += 1
+            seen = set()
+            first = True
+            while frame is not None:
+                code = frame.f_code
+                key = (code.co_filename, code.co_firstlineno, code.co_name)
+                if first:
+                    self.own[key] += 1
+                    first = False
+                if key not in seen:
+                    self.total[key] += 1
+                    seen.add(key)
+                frame = frame.f_back
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def report(self, top):
+        out = io.StringIO()
+        samples = float(self.samples or 1)
+        out.write("{0} samples every {1:.1f} ms\n".format(
+            self.samples, self.interval * 1000))
+        for title, counter in [('self', self.own), ('inclusive', self.total)]:
+            out.write("\ntop {0} by {1} samples:\n".format(top, title))
+            for (filename, line, name), count in counter.most_common(top):
+                out.write("{0:6.1f}% {1} ({2}:{3})\n".format(
+                    100 * count / samples, name, filename, line))
+        return out.getvalue()
+
+
+class Profiler(object):
+    """Start and stop profiling of the receive loop on request.
+    """
+    modes = ('cpu', 'sample')
+
+    def __init__(self, directory, logger, top=25):
+        self.directory = directory
+        self.logger = logger
+        self.top = top
+        self.requests = collections.deque()
+        self.profile = None
+        self.sampler = None
+        self.baseline = None
+        self.started = None
+        # Whether tracemalloc was started here, and so is ours to stop.
+        self.tracing = False
+
+    @property
+    def running(self):
+        return self.started is not None
+
+    def request(self, action, mode='cpu', callback=None):
+        """Ask the loop thread to 'start' or 'stop' at its next poll().
+
+        callback, if given, is called with a status line once done.
+        """
+        self.requests.append((action, mode, callback))
+
+    def poll(self):
+        while self.requests:
+            action, mode, callback = self.requests.popleft()
+            if action == 'start':
+                result = self.start(mode)
+            else:
+                result = self.stop()
+            if callback:
+                callback(result)
+
+    def start(self, mode='cpu'):
+        if self.running:
+            return 'already profiling'
+        if mode == 'sample':
+            self.sampler = Sampler(threading.get_ident())
+        else:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.tracing = True
+        self.baseline = tracemalloc.take_snapshot()
+        self.started = time.time()
+        self.logger.info("profiling started ({0})".format(mode))
+        return 'profiling started ({0})'.format(mode)
+
+    def stop(self):
+        if not self.running:
+            return 'not profiling'
+        elapsed = time.time() - self.started
+        profile, sampler, baseline = self.profile, self.sampler, self.baseline
+        # Stop everything first, so a failure to write the reports
+        # doesn't leave profiling running.
+        if profile:
+            profile.disable()
+        if sampler:
+            sampler.stop()
+        snapshot = tracemalloc.take_snapshot()
+        if self.tracing:
+            tracemalloc.stop()
+        self.profile = self.sampler = self.baseline = self.started = None
+        self.tracing = False
+        try:
+            paths = self.write_reports(profile, sampler, baseline, snapshot)
+        except (IOError, OSError) as error:
+            self.logger.exception("error writing profile reports")
+            return ('profiling stopped, but the reports could not be '
+                    'written: {0}'.format(error))
+        line = 'profiled {0:.0f}s, wrote {1}'.format(
+            elapsed, ', '.join(paths))
+        self.logger.info(line)
+        return line
+
+    def write_reports(self, profile, sampler, baseline, snapshot):
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.gmtime())
+        base = os.path.join(self.directory, 'profile-' + stamp)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        paths = []
+        if profile:
+            profile.dump_stats(base + '.pstats')
+            paths.append(base + '.pstats')
+            out = io.StringIO()
+            stats = pstats.Stats(profile, stream=out)
+            stats.sort_stats('cumulative').print_stats(self.top)
+            stats.sort_stats('tottime').print_stats(self.top)
+            self.write(base + '.cpu.txt', out.getvalue())
+            paths.append(base + '.cpu.txt')
+        if sampler:
+            self.write(base + '.cpu.txt', sampler.report(self.top))
+            paths.append(base + '.cpu.txt')
+        self.write(base + '.alloc.txt', self.allocations(snapshot, baseline))
+        paths.append(base + '.alloc.txt')
+        return paths
+
+    def allocations(self, snapshot, baseline):
+        snapshot = snapshot.filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ])
+        out = io.StringIO()
+        out.write("top {0} allocation sites by size:\n".format(self.top))
+        for stat in snapshot.statistics('lineno')[:self.top]:
+            out.write("{0}\n".format(stat))
+        out.write("\ntop {0} by growth while profiling:\n".format(self.top))
+        for stat in snapshot.compare_to(baseline, 'lineno')[:self.top]:
+            out.write("{0}\n".format(stat))
+        return out.getvalue()
+
+    @staticmethod
+    def write(path, text):
+        with open(path, 'w') as out:
+            out.write(text)
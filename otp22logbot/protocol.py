@@ -1,4 +1,10 @@
+import calendar
 import re
+from otp22logbot import metrics
+
+# IRCv3 message-tags: the tags section may take up to 8191 bytes on
+# top of the usual 512 for the rest of the line.
+TAGS_LIMIT = 8191
 
 
 class ParseError(Exception):
@@ -33,6 +39,9 @@ def parse_message(data):
     # If we get a falsy value, just skip this.
     if not data:
         return None
+    # IRCv3 tags don't count towards the 512; see Message for using them.
+    if data[0:1] == b"@":
+        data = split_tags(data)[1]
     # RFC2812 2.3 IRC messages are always lines of characters terminated
     # with a CR-LF (Carriage Return - Line Feed) pair, and these
     # messages SHALL NOT exceed 512 characters in length, counting all
@@ -67,11 +76,181 @@ def parse_message(data):
     if len(result) > 1:
         command, params = result
     else:
-        command, params = result, b""
+        command, params = result[0], b""
 
     return prefix, command, params
 
 
+def split_tags(data):
+    """Split an IRCv3 tags section off a line: (tags, rest of line).
+
+    tags is None if the line has none, else the bytes between the
+    leading @ and the first space.
+    """
+    if data[0:1] != b"@":
+        return None, data
+    pos = data.find(b" ")
+    if pos == -1 or pos - 1 > TAGS_LIMIT:
+        raise Malformed(data=data)
+    return data[1:pos], data[pos + 1:].lstrip(b" ")
+
+
+TAG_ESCAPES = {':': ';', 's': ' ', '\\': '\\', 'r': '\r', 'n': '\n'}
+
+
+def unescape_tag(value):
+    """Undo IRCv3 tag value escaping.
+    """
+    if '\\' not in value:
+        return value
+    out = []
+    chars = iter(value)
+    for char in chars:
+        if char == '\\':
+            escaped = next(chars, '')
+            out.append(TAG_ESCAPES.get(escaped, escaped))
+        else:
+            out.append(char)
+    return ''.join(out)
+
+
+def parse_tags(raw):
+    """Parse the bytes of a tags section into a dict of str to str.
+
+    Tags without a value map to ''.
+    """
+    tags = {}
+    for item in raw.decode('utf-8', 'replace').split(';'):
+        if not item:
+            continue
+        key, _, value = item.partition('=')
+        tags[key] = unescape_tag(value)
+    return tags
+
+
+SERVER_TIME = re.compile(
+    r'^(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(\.\d+)?Z$')
+
+
+def parse_server_time(value):
+    """Seconds since the epoch from an IRCv3 server-time value, or None.
+    """
+    match = SERVER_TIME.match(value)
+    if not match:
+        return None
+    fields = [int(field) for field in match.groups()[:6]]
+    fraction = float(match.group(7)) if match.group(7) else 0.0
+    return calendar.timegm(fields) + fraction
+
+
+def decode(data, encodings):
+    """Decode with the first encoding that works; the last should be one
+    that can't fail, like latin-1.
+    """
+    for encoding in encodings[:-1]:
+        try:
+            return data.decode(encoding)
+        except UnicodeDecodeError:
+            pass
+    return data.decode(encodings[-1], 'replace')
+
+
+class Message(object):
+    """One parsed IRC message, decoding its parts only when asked.
+
+    Unpacks like the (prefix, command, params) tuple from
+    parse_message. nick, targets and text (the last two for PRIVMSG
+    and NOTICE) are decoded at most once each, trying encodings in
+    order. tags holds IRCv3 message tags, and time the server-time tag
+    as seconds since the epoch, or None.
+    """
+    __slots__ = ('raw_tags', 'prefix', 'command', 'params', 'encodings',
+                 '_tags', '_source', '_nick', '_privmsg', '_targets',
+                 '_text')
+
+    default_encodings = ('utf-8', 'latin-1')
+
+    def __init__(self, prefix, command, params, raw_tags=None,
+                 encodings=None):
+        self.prefix = prefix
+        self.command = command
+        self.params = params
+        self.raw_tags = raw_tags
+        self.encodings = encodings or self.default_encodings
+        self._tags = None
+        self._source = None
+        self._nick = None
+        self._privmsg = None
+        self._targets = None
+        self._text = None
+
+    @classmethod
+    def parse(cls, data, encodings=None):
+        raw_tags, rest = split_tags(data)
+        parsed = parse_message(rest)
+        if parsed is None:
+            return None
+        prefix, command, params = parsed
+        return cls(prefix, command, params, raw_tags, encodings)
+
+    def __iter__(self):
+        return iter((self.prefix, self.command, self.params))
+
+    def __repr__(self):
+        return 'Message({0!r}, {1!r}, {2!r}, raw_tags={3!r})'.format(
+            self.prefix, self.command, self.params, self.raw_tags)
+
+    @property
+    def tags(self):
+        if self._tags is None:
+            self._tags = parse_tags(self.raw_tags) if self.raw_tags else {}
+        return self._tags
+
+    @property
+    def time(self):
+        if not self.raw_tags:
+            return None
+        value = self.tags.get('time')
+        return parse_server_time(value) if value else None
+
+    @property
+    def source(self):
+        """The whole prefix, decoded.
+        """
+        if self._source is None:
+            self._source = decode(self.prefix, self.encodings)
+        return self._source
+
+    @property
+    def nick(self):
+        if self._nick is None:
+            self._nick = decode(self.prefix.split(b"!", 1)[0],
+                                self.encodings)
+        return self._nick
+
+    @property
+    def privmsg(self):
+        """(targets, text) as bytes; see parse_privmsg.
+        """
+        if self._privmsg is None:
+            self._privmsg = parse_privmsg(self.params)
+        return self._privmsg
+
+    @property
+    def targets(self):
+        if self._targets is None:
+            encodings = self.encodings
+            self._targets = [decode(target, encodings)
+                             for target in self.privmsg[0]]
+        return self._targets
+
+    @property
+    def text(self):
+        if self._text is None:
+            self._text = decode(self.privmsg[1], self.encodings)
+        return self._text
+
+
 def parse_messages(data, logger):
     """Find possible IRC messages and trailing data in given bytes.
     """
@@ -89,23 +268,110 @@ def parse_messages(data, logger):
         # So we end up logging the exceptions, which seems a bit messy,
         # but it allows the error to be highlighted or silenced by user
         # according to situations.
-        except ParseError:
+        except ParseError as error:
+            if metrics.enabled:
+                metrics.PARSE_ERRORS.inc(label=type(error).__name__)
             logger.exception("Caught error during message parse")
         end = match.end()
     unconsumed = data[end:]
+    if metrics.enabled:
+        metrics.LINES_PARSED.inc(len(messages))
     return messages, unconsumed
 
 
-def message_iterator(logger):
-    """Handle fragments and call parse_messages for consumers.
+class LineFramer(object):
+    """Split a stream of received bytes into CR LF terminated lines.
+
+    Each call joins the new bytes to the unterminated tail of the last
+    one, which is never longer than limit, and searches only what
+    hasn't been searched before: a burst of small reads doesn't rescan
+    or re-join what is already buffered, and a big read is scanned once
+    and not copied again. Lines are bytes, including the trailing CR
+    LF, which is what parse_message expects.
+    """
+    def __init__(self, logger, limit=512):
+        self.logger = logger
+        self.limit = limit
+        # The unterminated tail of what was fed so far.
+        self.buffer = b""
+        # Set while dropping the rest of a line that was too big.
+        self.discarding = False
+
+    def feed(self, data):
+        """Add received bytes, return any complete lines.
+        """
+        if not data:
+            return []
+        buf = self.buffer
+        # Searched already, except a CR that may end it.
+        scanned = len(buf) - 1
+        if buf:
+            buf += data
+        else:
+            # No copy if data is bytes already.
+            buf = bytes(data)
+        lines = []
+        find = buf.find
+        start = 0
+        limit = self.limit
+        end = find(b"\r\n", max(scanned, 0))
+        while end != -1:
+            end += 2
+            if self.discarding:
+                self.discarding = False
+            elif end - start > limit:
+                self.overlong(buf, start, end)
+            else:
+                lines.append(buf[start:end])
+            start = end
+            end = find(b"\r\n", end)
+        if len(buf) - start > limit:
+            # No terminator in sight and already too big to be a valid
+            # line, so don't keep buffering it.
+            if not self.discarding:
+                self.overlong(buf, start, len(buf))
+                self.discarding = True
+            # Keep the last byte in case it is the CR of the terminator.
+            start = len(buf) - 1
+        self.buffer = buf[start:] if start else buf
+        return lines
+
+    def overlong(self, buf, start, end):
+        if metrics.enabled:
+            metrics.PARSE_ERRORS.inc(label='TooBig')
+        data = bytes(buf[start:min(end, start + 520)])
+        try:
+            raise TooBig(data=data)
+        except TooBig:
+            self.logger.exception("Caught error during message parse")
+
+    @property
+    def unconsumed(self):
+        return self.buffer
+
+
+def message_iterator(logger, parse=parse_message, limit=512):
+    """Handle fragments and parse complete messages for consumers.
+
+    parse turns each line into a message; pass Message.parse, with a
+    limit raised by TAGS_LIMIT + 1, to get Message objects with tags.
     """
+    framer = LineFramer(logger, limit=limit)
     messages = []
-    old_data = b''
     while True:
         new_data = yield messages
-        if new_data:
-            all_data = b"".join([old_data, new_data])
-            messages, old_data = parse_messages(all_data, logger)
+        messages = []
+        for line in framer.feed(new_data):
+            # Same policy as parse_messages: log the bad line and keep
+            # going with the rest of the batch.
+            try:
+                messages.append(parse(line))
+            except ParseError as error:
+                if metrics.enabled:
+                    metrics.PARSE_ERRORS.inc(label=type(error).__name__)
+                logger.exception("Caught error during message parse")
+        if metrics.enabled:
+            metrics.LINES_PARSED.inc(len(messages))
 
 
 def parse_privmsg(params):
@@ -0,0 +1,72 @@
+import heapq
+import selectors
+import time
+
+
+class Timer(object):
+    """A callback due at a time on the reactor's clock.
+    """
+    def __init__(self, when, callback):
+        self.when = when
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def __lt__(self, other):
+        return self.when < other.when
+
+
+class Reactor(object):
+    """Wait for sockets to become readable and for timers, together.
+
+    Callbacks run on the thread calling run_once(), one at a time: a
+    socket's callback once per select that finds it readable, and each
+    timer once when its time has come.
+    """
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.selector = selectors.DefaultSelector()
+        self.timers = []
+
+    def register(self, fileobj, callback):
+        self.selector.register(fileobj, selectors.EVENT_READ, callback)
+
+    def unregister(self, fileobj):
+        self.selector.unregister(fileobj)
+
+    def call_later(self, delay, callback):
+        """Run callback after delay seconds; returns a Timer to cancel.
+        """
+        timer = Timer(self.clock() + delay, callback)
+        heapq.heappush(self.timers, timer)
+        return timer
+
+    def timeout(self):
+        """Seconds until the next timer is due, or None if there's none.
+        """
+        timers = self.timers
+        while timers and timers[0].cancelled:
+            heapq.heappop(timers)
+        if not timers:
+            return None
+        return max(0.0, timers[0].when - self.clock())
+
+    def run_once(self, limit=None):
+        """Wait for one round of events, at most limit seconds.
+        """
+        timeout = self.timeout()
+        if limit is not None and (timeout is None or timeout > limit):
+            timeout = limit
+        for key, _ in self.selector.select(timeout):
+            key.data()
+        now = self.clock()
+        timers = self.timers
+        while timers and timers[0].when <= now:
+            timer = heapq.heappop(timers)
+            if not timer.cancelled:
+                timer.callback()
+
+    def close(self):
+        self.selector.close()
@@ -0,0 +1,414 @@
+"""Rebuild the archive and user state from old text logs, in parallel.
+
+Logs are cut into byte ranges on line boundaries (a gzipped log is one
+range, since it can't be entered in the middle) and each range is
+parsed in a worker process with segment.parse_text. A worker writes
+its range's messages to a binary segment in the work directory, with
+times counted from day 0 of the range, and returns a summary: message
+count, first and last times, and per-nick state.
+
+Finished ranges are appended to a manifest in the work directory, so
+an interrupted run picks up where it left off. Merging then happens in
+log order whatever order the workers finished in: each range is placed
+on the common timeline the way one sequential parse_text over every
+log would have placed it, and the archive, user snapshot and message
+counts are built from that.
+
+    otp22logbot-reindex --date 2013-03-01 --archive archive.db \\
+        --state-dir state otp22logbot.log*
+"""
+import argparse
+import calendar
+import concurrent.futures
+import datetime
+import gzip
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+import time
+from otp22logbot import segment
+from otp22logbot.archive import Archive
+from otp22logbot.state import SNAPSHOT_VERSION, StateStore
+from otp22logbot.stats import log_order
+
+RANGE_SIZE = 64 * 1024 * 1024
+# parse_text's day 0; any date does, the merge shifts it away.
+LOCAL_DATE = datetime.date(1970, 1, 1)
+
+
+class ReindexError(Exception):
+    """Reindexing can't go ahead as asked.
+    """
+
+
+def split_ranges(path, range_size=RANGE_SIZE):
+    """[(start, end)] byte ranges covering path, cut after newlines.
+    """
+    size = os.path.getsize(path)
+    if path.endswith('.gz') or size <= range_size:
+        return [(0, size)]
+    ranges = []
+    start = 0
+    with open(path, 'rb') as log:
+        while start < size:
+            log.seek(start + range_size - 1)
+            log.readline()
+            end = min(log.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def read_lines(path, start, end):
+    if path.endswith('.gz'):
+        with gzip.open(path, 'rt', encoding='utf-8',
+                       errors='replace') as log:
+            for line in log:
+                yield line
+        return
+    with open(path, 'rb') as log:
+        log.seek(start)
+        position = start
+        for line in log:
+            if position >= end:
+                break
+            position += len(line)
+            yield line.decode('utf-8', 'replace')
+
+
+def ends_line(path):
+    """Whether path is empty or ends in a newline.
+    """
+    with open(path, 'rb') as data:
+        data.seek(0, os.SEEK_END)
+        if not data.tell():
+            return True
+        data.seek(-1, os.SEEK_END)
+        return data.read(1) == b'\n'
+
+
+def part_name(key):
+    digest = hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()
+    return 'part-{0}.seg'.format(digest[:20])
+
+
+def parse_range(key, part):
+    """Parse one range into the segment file part. Runs in a worker.
+
+    Returns the range's summary, with times local to the range: its
+    first message is on day 0.
+    """
+    path, start, end = key
+    users = {}
+    messages = 0
+    first = last = None
+    last_message = None
+    partial = part + '.tmp'
+    with open(partial, 'wb') as output:
+        writer = segment.SegmentWriter(output.write)
+        for when, nick, targets, text in segment.parse_text(
+                read_lines(path, start, end), LOCAL_DATE):
+            if not nick:
+                # "connection closed" and the like
+                continue
+            writer.append(when, nick, targets, text)
+            messages += 1
+            if first is None:
+                first = when
+            last = when
+            last_message = segment.format_record(when, nick, targets, text)
+            user = users.get(nick)
+            if user is None:
+                # channels, last message, seen, time, message count
+                user = users[nick] = [[], None, None, None, 0]
+            for target in targets:
+                if target[:1] == '#' and target not in user[0]:
+                    user[0].append(target)
+            user[1] = last_message
+            user[2] = user[3] = when
+            user[4] += 1
+        writer.close()
+    os.replace(partial, part)
+    return {
+        'key': list(key),
+        'part': os.path.basename(part),
+        'messages': messages,
+        'first': first,
+        'last': last,
+        'last_message': last_message,
+        'users': users,
+    }
+
+
+def place(summaries, date):
+    """Seconds to add to each summary's local times, or None for ranges
+    without messages.
+
+    A range's first message starts a new day if its time of day is
+    before the previous range's last one, as it would in parse_text.
+    """
+    base = calendar.timegm(date.timetuple())
+    shifts = []
+    day = 0
+    last_offset = None
+    for summary in summaries:
+        if not summary['messages']:
+            shifts.append(None)
+            continue
+        if last_offset is not None and summary['first'] < last_offset:
+            day += 1
+        shifts.append(base + day * 86400)
+        last_day, last_offset = divmod(summary['last'], 86400)
+        day += int(last_day)
+    return shifts
+
+
+class Reindexer(object):
+    """Parses logs into the work directory, resuming past runs.
+
+    jobs is the number of worker processes; 0 parses in this process.
+    """
+    def __init__(self, work_dir, logger, range_size=RANGE_SIZE, jobs=None):
+        self.work_dir = work_dir
+        self.logger = logger
+        self.range_size = range_size
+        self.jobs = jobs
+        if not os.path.isdir(work_dir):
+            os.makedirs(work_dir)
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.work_dir, 'manifest')
+
+    def tasks(self, paths):
+        """Range keys, [path, start, end], in log order.
+        """
+        keys = []
+        for path in sorted((os.path.abspath(path) for path in paths),
+                           key=log_order):
+            for start, end in split_ranges(path, self.range_size):
+                keys.append((path, start, end))
+        return keys
+
+    def load_manifest(self):
+        done = {}
+        if not os.path.exists(self.manifest_path):
+            return done
+        with open(self.manifest_path) as manifest:
+            for line in manifest:
+                try:
+                    summary = json.loads(line)
+                except ValueError:
+                    # Torn last line from an interrupted run.
+                    continue
+                part = os.path.join(self.work_dir, summary['part'])
+                if os.path.exists(part):
+                    done[tuple(summary['key'])] = summary
+        return done
+
+    def run(self, paths):
+        """Parse whatever isn't parsed yet. Returns summaries in order.
+        """
+        keys = self.tasks(paths)
+        done = self.load_manifest()
+        todo = [key for key in keys if key not in done]
+        if done:
+            self.logger.info("resuming: {0} of {1} range(s) already done"
+                             .format(len(keys) - len(todo), len(keys)))
+        total_bytes = sum(end - start for _, start, end in todo)
+        state = {'count': len(keys) - len(todo), 'bytes': 0,
+                 'start': time.time()}
+        with open(self.manifest_path, 'a') as manifest:
+            if not ends_line(self.manifest_path):
+                # Don't append to a torn line.
+                manifest.write('\n')
+
+            def finished(summary):
+                manifest.write(json.dumps(summary) + '\n')
+                manifest.flush()
+                done[tuple(summary['key'])] = summary
+                path, start, end = summary['key']
+                state['count'] += 1
+                state['bytes'] += end - start
+                elapsed = time.time() - state['start']
+                rate = state['bytes'] / elapsed if elapsed else 0
+                remaining = ((total_bytes - state['bytes']) / rate
+                             if rate else 0)
+                self.logger.info(
+                    "[{0}/{1}] {2} {3}-{4}: {5} message(s), "
+                    "{6:.1f} MB/s, {7:.0f} s left".format(
+                        state['count'], len(keys), path, start, end,
+                        summary['messages'], rate / 1e6, remaining))
+
+            parts = [os.path.join(self.work_dir, part_name(key))
+                     for key in todo]
+            if self.jobs == 0:
+                for key, part in zip(todo, parts):
+                    finished(parse_range(key, part))
+            else:
+                with concurrent.futures.ProcessPoolExecutor(
+                        self.jobs) as pool:
+                    futures = [pool.submit(parse_range, key, part)
+                               for key, part in zip(todo, parts)]
+                    for future in concurrent.futures.as_completed(futures):
+                        finished(future.result())
+        return [done[key] for key in keys]
+
+    def records(self, summaries, shifts):
+        """Every message, in order, on the common timeline.
+        """
+        for summary, shift in zip(summaries, shifts):
+            if shift is None:
+                continue
+            with open(os.path.join(self.work_dir, summary['part']),
+                      'rb') as part:
+                data = part.read()
+            for when, nick, targets, text in segment.read_segment(data):
+                yield when + shift, nick, targets, text
+
+    def clean(self):
+        shutil.rmtree(self.work_dir)
+
+
+def merge_users(summaries, shifts):
+    """(users oldest activity first, as StateStore captures them,
+    message counts by nick, last message).
+    """
+    users = {}
+    counts = {}
+    last_message = None
+    for summary, shift in zip(summaries, shifts):
+        if shift is None:
+            continue
+        last_message = summary['last_message']
+        for nick, (channels, message, seen, when, count) in sorted(
+                summary['users'].items()):
+            user = users.get(nick)
+            if user is None:
+                user = users[nick] = [nick, [], None, None, None]
+            user[1].extend(channel for channel in channels
+                           if channel not in user[1])
+            user[2] = message
+            user[3] = seen + shift
+            user[4] = when + shift
+            counts[nick] = counts.get(nick, 0) + count
+    ordered = sorted(users.values(), key=lambda user: (user[3], user[0]))
+    return ([(nick, tuple(channels), message, seen, when)
+             for nick, channels, message, seen, when in ordered],
+            counts, last_message)
+
+
+def build_archive(path, records, logger, batch_size=10000):
+    """Write a new archive at path from records, replacing any old one.
+    """
+    partial = path + '.part'
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(partial + suffix):
+            os.remove(partial + suffix)
+    archive = Archive(partial, logger)
+    db = archive.connect()
+    count = 0
+    rows = []
+    for when, nick, targets, text in records:
+        rows.append((when, nick, ','.join(targets), text))
+        if len(rows) >= batch_size:
+            archive.insert(db, rows)
+            count += len(rows)
+            rows = []
+    archive.insert(db, rows)
+    count += len(rows)
+    archive.close()
+    db.close()
+    for suffix in ('-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    os.replace(partial, path)
+    return count
+
+
+def empty_state(directory, logger):
+    """StateStore for a directory that must not hold any state yet.
+    """
+    store = StateStore(directory, logger)
+    if store.journal_seqs() or os.path.exists(store.snapshot_path):
+        raise ReindexError(
+            "{0} already holds state; use an empty directory"
+            .format(directory))
+    return store
+
+
+def write_state(store, users, last_message):
+    """Snapshot the users for the bot's --state-dir to load.
+    """
+    store.write_snapshot({
+        'version': SNAPSHOT_VERSION,
+        'next_seq': 0,
+        'last_message': last_message,
+        'users': users,
+    })
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        description="Rebuild the archive and user state from text logs, "
+                    "plain or gzipped, using several processes.")
+    parser.add_argument('logs', nargs='+', metavar='log')
+    parser.add_argument('--date', required=True,
+                        help='UTC date the first log starts on, as '
+                             'YYYY-MM-DD')
+    parser.add_argument('--archive', help='SQLite archive to write')
+    parser.add_argument('--state-dir',
+                        help='empty directory to write a user snapshot to')
+    parser.add_argument('--counts', help='file to write message counts '
+                                         'by nick to, as JSON')
+    parser.add_argument('--work-dir', default='otp22logbot-reindex',
+                        help='where parsed ranges are kept until done; '
+                             'rerun with the same one to resume')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='worker processes (default: one per CPU, '
+                             '0: none)')
+    parser.add_argument('--range-size', type=int, default=RANGE_SIZE,
+                        help='bytes of log per unit of work')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the work directory when done')
+    return parser
+
+
+def main(argv=None):
+    args = make_parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="[+] %(message)s")
+    logger = logging.getLogger("otp22logbot.reindex")
+    date = datetime.datetime.strptime(args.date, '%Y-%m-%d').date()
+    store = None
+    if args.state_dir:
+        try:
+            store = empty_state(args.state_dir, logger)
+        except ReindexError as error:
+            logger.error(str(error))
+            return 1
+    reindexer = Reindexer(args.work_dir, logger, args.range_size, args.jobs)
+    summaries = reindexer.run(args.logs)
+    shifts = place(summaries, date)
+    users, counts, last_message = merge_users(summaries, shifts)
+    logger.info("{0} message(s) from {1} user(s)".format(
+        sum(counts.values()), len(users)))
+    if args.archive:
+        count = build_archive(
+            args.archive, reindexer.records(summaries, shifts), logger)
+        logger.info("archived {0} message(s) to {1}"
+                    .format(count, args.archive))
+    if store:
+        write_state(store, users, last_message)
+    if args.counts:
+        with open(args.counts, 'w') as output:
+            json.dump(counts, output, indent=2, sort_keys=True)
+    if not args.keep:
+        reindexer.clean()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,339 @@
+"""Compact binary log segments, and conversion to and from text logs.
+
+A segment is MAGIC followed by blocks. Each block is
+
+    u32 length of the rest of the block
+    u32 number of new dictionary strings, then each as varint length
+        and UTF-8 bytes
+    u32 number of records
+    i64 base time, in milliseconds since the epoch
+    records
+
+and each record is
+
+    zigzag varint time delta in ms from the previous record (or base)
+    varint nick id
+    varint target count, then a varint id per target
+    varint text length, then the UTF-8 text
+
+Nick and target strings are numbered in order of first appearance in
+the segment, so every block only carries the strings it introduces. A
+record with an empty nick and no targets is a plain line, like
+"connection closed", kept verbatim. Segments can be concatenated: the
+string numbering starts over after each MAGIC.
+
+A crash can leave the last block cut short. Reading stops cleanly
+before it, and repair() cuts it off before the file is appended to.
+"""
+import argparse
+import datetime
+import os
+import re
+import struct
+import sys
+import time
+
+MAGIC = b'OTP22SEG\x01'
+BLOCK_HEADER = struct.Struct('<I')
+BLOCK_COUNTS = struct.Struct('<Iq')
+TEXT_LINE = re.compile(r'^<(\d\d):(\d\d):(\d\d)> (\S*) \(([^)]*)\): (.*)$')
+
+
+class FormatError(Exception):
+    """Data is not a valid segment.
+    """
+
+
+def write_varint(out, value):
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def read_varint(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        if pos >= len(data):
+            raise FormatError("truncated varint")
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+class SegmentWriter(object):
+    """Encode records into blocks and hand each block to write().
+
+    write is any callable taking bytes, e.g. a file's write method, so
+    the actual I/O can happen somewhere else. A block is written when
+    it reaches block_size, and, if max_delay is set, once its first
+    record is max_delay seconds old, so a crash loses no more than that
+    (see flush_due).
+    """
+    def __init__(self, write, block_size=65536, max_delay=None,
+                 clock=time.monotonic):
+        self.write = write
+        self.block_size = block_size
+        self.max_delay = max_delay
+        self.clock = clock
+        self.ids = {}
+        write(MAGIC)
+        self.reset()
+
+    def reset(self):
+        self.strings = []
+        self.records = bytearray()
+        self.count = 0
+        self.base = None
+        self.previous = None
+        self.started = None
+
+    def intern(self, string):
+        ident = self.ids.get(string)
+        if ident is None:
+            ident = self.ids[string] = len(self.ids)
+            self.strings.append(string)
+        return ident
+
+    def append(self, when, nick, targets, text):
+        """Add one record; when is seconds since the epoch.
+        """
+        millis = int(round(when * 1000))
+        if self.base is None:
+            self.base = self.previous = millis
+            self.started = self.clock()
+        delta = millis - self.previous
+        self.previous = millis
+        out = self.records
+        # zigzag, so small negative deltas stay small too
+        write_varint(out, (delta << 1) ^ (delta >> 63))
+        write_varint(out, self.intern(nick))
+        write_varint(out, len(targets))
+        for target in targets:
+            write_varint(out, self.intern(target))
+        encoded = text.encode('utf-8')
+        write_varint(out, len(encoded))
+        out += encoded
+        self.count += 1
+        if len(out) >= self.block_size:
+            self.flush()
+        else:
+            self.flush_due()
+
+    def flush_due(self):
+        """Write the current block if it has waited max_delay seconds.
+
+        append() checks this too; call it when nothing is appended for
+        a while.
+        """
+        if (self.count and self.max_delay is not None and
+                self.clock() - self.started >= self.max_delay):
+            self.flush()
+
+    def flush(self):
+        if not self.count:
+            return
+        body = bytearray(BLOCK_HEADER.pack(len(self.strings)))
+        for string in self.strings:
+            encoded = string.encode('utf-8')
+            write_varint(body, len(encoded))
+            body += encoded
+        body += BLOCK_COUNTS.pack(self.count, self.base)
+        body += self.records
+        self.write(BLOCK_HEADER.pack(len(body)) + bytes(body))
+        self.reset()
+
+    def close(self):
+        self.flush()
+
+
+def read_segment(data):
+    """Yield (when, nick, targets, text) from the bytes of a segment.
+    """
+    if not data.startswith(MAGIC):
+        raise FormatError("not a segment")
+    strings = []
+    pos = len(MAGIC)
+    size = len(data)
+    while pos < size:
+        if data.startswith(MAGIC, pos):
+            strings = []
+            pos += len(MAGIC)
+            continue
+        start = pos
+        end = size + 1
+        try:
+            if pos + 4 <= size:
+                length, = BLOCK_HEADER.unpack_from(data, pos)
+                end = pos + 4 + length
+            if end > size:
+                raise FormatError("truncated block")
+            records = read_block(data[pos + 4:end], strings)
+        except FormatError:
+            if end > size:
+                # Cut short by a crash.
+                return
+            # Or appended to after one, without repair().
+            pos = data.find(MAGIC, start)
+            if pos == -1:
+                raise
+            continue
+        pos = end
+        for record in records:
+            yield record
+
+
+def read_block(data, strings):
+    """[(when, nick, targets, text)] from the body of one block.
+
+    New strings are added to strings, and only once the whole block
+    has been read.
+    """
+    try:
+        pos = 0
+        new, = BLOCK_HEADER.unpack_from(data, pos)
+        pos += 4
+        added = []
+        for _ in range(new):
+            strlen, pos = read_varint(data, pos)
+            added.append(data[pos:pos + strlen].decode('utf-8'))
+            pos += strlen
+        known = strings + added
+        count, millis = BLOCK_COUNTS.unpack_from(data, pos)
+        pos += BLOCK_COUNTS.size
+        records = []
+        for _ in range(count):
+            zigzag, pos = read_varint(data, pos)
+            millis += (zigzag >> 1) ^ -(zigzag & 1)
+            nick, pos = read_varint(data, pos)
+            ntargets, pos = read_varint(data, pos)
+            targets = []
+            for _ in range(ntargets):
+                target, pos = read_varint(data, pos)
+                targets.append(known[target])
+            textlen, pos = read_varint(data, pos)
+            text = data[pos:pos + textlen].decode('utf-8')
+            pos += textlen
+            records.append((millis / 1000.0, known[nick], targets, text))
+    except (IndexError, struct.error, UnicodeDecodeError) as error:
+        raise FormatError("bad block: {0}".format(error))
+    if pos != len(data):
+        raise FormatError("block length mismatch")
+    strings.extend(added)
+    return records
+
+
+def repair(path):
+    """Cut a block left unfinished by a crash off the end of a file.
+
+    Returns the number of bytes removed. Only block lengths are read,
+    not the blocks themselves.
+    """
+    if not os.path.exists(path):
+        return 0
+    with open(path, 'r+b') as segment:
+        size = segment.seek(0, os.SEEK_END)
+        pos = 0
+        while pos < size:
+            segment.seek(pos)
+            head = segment.read(len(MAGIC))
+            if head == MAGIC:
+                pos += len(MAGIC)
+                continue
+            if len(head) < BLOCK_HEADER.size:
+                break
+            length, = BLOCK_HEADER.unpack_from(head)
+            if pos + BLOCK_HEADER.size + length > size:
+                break
+            pos += BLOCK_HEADER.size + length
+        if pos < size:
+            segment.truncate(pos)
+    return size - pos
+
+
+def format_record(when, nick, targets, text, timeformat='%H:%M:%S'):
+    """The line Bot.format_message would have logged for a record.
+    """
+    if not nick and not targets:
+        return text
+    stamp = datetime.datetime.utcfromtimestamp(when).strftime(timeformat)
+    return '<{0}> {1} ({2}): {3}'.format(
+        stamp, nick, ','.join(targets), text)
+
+
+def parse_text(lines, date):
+    """Yield records from text log lines, which only carry time of day.
+
+    date is the UTC day the log starts on; a clock going backwards is
+    taken to mean the next day.
+    """
+    epoch = datetime.datetime(1970, 1, 1)
+    day = (datetime.datetime.combine(date, datetime.time()) -
+           epoch).total_seconds()
+    last = None
+    when = day
+    for line in lines:
+        line = line.rstrip('\n')
+        match = TEXT_LINE.match(line)
+        if not match:
+            yield when, '', [], line
+            continue
+        hours, minutes, seconds, nick, targets, text = match.groups()
+        offset = int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+        if last is not None and offset < last:
+            day += 86400
+        last = offset
+        when = day + offset
+        yield when, nick, targets.split(',') if targets else [], text
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        description="Convert between binary log segments and text logs.")
+    commands = parser.add_subparsers(dest='command')
+    to_text = commands.add_parser(
+        'to-text', help='print a segment as text log lines')
+    to_text.add_argument('segment')
+    to_text.add_argument(
+        '-o', '--output', type=argparse.FileType('w'), default=sys.stdout)
+    from_text = commands.add_parser(
+        'from-text', help='write a text log as a segment')
+    from_text.add_argument('log', type=argparse.FileType('r'))
+    from_text.add_argument('-o', '--output', required=True)
+    from_text.add_argument(
+        '--date', help='UTC date the log starts on, as YYYY-MM-DD '
+        '(default: today)')
+    return parser
+
+
+def main(argv=None):
+    parser = make_parser()
+    args = parser.parse_args(argv)
+    if args.command == 'to-text':
+        with open(args.segment, 'rb') as segment:
+            data = segment.read()
+        for record in read_segment(data):
+            args.output.write(format_record(*record) + '\n')
+        args.output.flush()
+    elif args.command == 'from-text':
+        if args.date:
+            date = datetime.datetime.strptime(args.date, '%Y-%m-%d').date()
+        else:
+            date = datetime.datetime.utcfromtimestamp(time.time()).date()
+        with open(args.output, 'wb') as segment:
+            writer = SegmentWriter(segment.write)
+            for record in parse_text(args.log, date):
+                writer.append(*record)
+            writer.close()
+    else:
+        parser.print_help()
+        return 2
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,159 @@
+import collections
+import threading
+import time
+from otp22logbot import metrics
+
+# Lanes, most urgent first. URGENT skips flood control entirely.
+URGENT = 0   # PONG, QUIT
+NORMAL = 1   # registration, JOIN and other protocol traffic
+REPLY = 2    # answers to users' commands
+
+
+class TokenBucket(object):
+    """Allow burst lines at once, refilling at rate lines per second.
+    """
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.clock = clock
+        self.tokens = self.burst
+        self.stamp = clock()
+
+    def refill(self):
+        now = self.clock()
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def take(self):
+        """Use up a token if there is one.
+
+        Returns 0 on success, else the seconds until one is available.
+        """
+        self.refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class SendStats(object):
+    def __init__(self):
+        self.lines = 0
+        self.writes = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+
+    def as_dict(self, depth=0):
+        return {
+            'depth': depth,
+            'max_depth': self.max_depth,
+            'lines': self.lines,
+            'writes': self.writes,
+            'dropped': self.dropped,
+            'mean_wait_ms': self.wait_time * 1000 / (self.lines or 1),
+            'max_wait_ms': self.max_wait * 1000,
+        }
+
+
+class SendQueue(object):
+    """Outbound lines, written by a background thread under flood control.
+
+    Each priority lane is drained in order before the next one, and
+    everything waiting that the token bucket allows is joined into a
+    single write, up to max_coalesce lines.
+    """
+    def __init__(self, write, logger, rate=1.0, burst=5, max_coalesce=16):
+        self.write = write
+        self.logger = logger
+        self.bucket = TokenBucket(rate, burst)
+        self.max_coalesce = max_coalesce
+        self.lanes = (collections.deque(), collections.deque(),
+                      collections.deque())
+        self.condition = threading.Condition()
+        self.closing = False
+        self.deadline = None
+        self.stats = SendStats()
+        self.thread = threading.Thread(
+            target=self.run, name="otp22logbot-sender")
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def depth(self):
+        return sum(len(lane) for lane in self.lanes)
+
+    def put(self, message, priority=NORMAL):
+        with self.condition:
+            if self.closing:
+                return 0
+            self.lanes[priority].append((message, time.monotonic()))
+            depth = self.depth
+            self.stats.max_depth = max(self.stats.max_depth, depth)
+            if metrics.enabled:
+                metrics.SEND_QUEUE_DEPTH.set(depth)
+            self.condition.notify()
+        return len(message)
+
+    def close(self, timeout=5.0):
+        """Send what is queued, giving up on the rest after timeout.
+        """
+        with self.condition:
+            self.closing = True
+            self.deadline = time.monotonic() + timeout
+            self.condition.notify()
+        self.thread.join()
+
+    def take(self):
+        """Pick the next lines to write, or how long to wait for them.
+        """
+        chunk = []
+        lanes = self.lanes
+        while lanes[URGENT] and len(chunk) < self.max_coalesce:
+            chunk.append(lanes[URGENT].popleft())
+        wait = None
+        for lane in lanes[NORMAL], lanes[REPLY]:
+            while lane and len(chunk) < self.max_coalesce:
+                wait = self.bucket.take()
+                if wait:
+                    break
+                chunk.append(lane.popleft())
+            if wait:
+                break
+        return chunk, wait
+
+    def run(self):
+        while True:
+            with self.condition:
+                chunk, wait = self.take()
+                while not chunk:
+                    if self.closing and (
+                            not self.depth or
+                            time.monotonic() >= self.deadline):
+                        self.stats.dropped += self.depth
+                        if metrics.enabled:
+                            metrics.SEND_QUEUE_DEPTH.set(0)
+                        return
+                    if self.closing:
+                        wait = min(wait or 0,
+                                   self.deadline - time.monotonic())
+                    self.condition.wait(wait)
+                    chunk, wait = self.take()
+                depth = self.depth
+            now = time.monotonic()
+            for _, queued in chunk:
+                waited = now - queued
+                self.stats.wait_time += waited
+                self.stats.max_wait = max(self.stats.max_wait, waited)
+                if metrics.enabled:
+                    metrics.SEND_QUEUE_WAIT_SECONDS.observe(waited)
+            if metrics.enabled:
+                metrics.SEND_QUEUE_DEPTH.set(depth)
+            self.stats.lines += len(chunk)
+            self.stats.writes += 1
+            try:
+                self.write(b"".join(message for message, _ in chunk))
+            except Exception:
+                self.logger.exception("error writing to socket")
@@ -0,0 +1,212 @@
+"""Persist user state across restarts: snapshot plus journal.
+
+The directory holds one snapshot (a pickle of every user, oldest
+activity first, plus the last message) and journal segments named
+journal.<seq>, each a JSON list per line recording one user's full
+state after an update. Loading replays the journals the snapshot does
+not already cover, so the newest entry for a nick wins.
+"""
+import json
+import os
+import pickle
+import sys
+import threading
+import time
+from otp22logbot.user import User
+from otp22logbot.writer import LogWriter
+
+SNAPSHOT_VERSION = 1
+intern = sys.intern
+
+
+class Journal(object):
+    """File-like journal segment that the log writer can switch.
+    """
+    def __init__(self, directory, seq):
+        self.directory = directory
+        self.file = None
+        self.open(seq)
+
+    def open(self, seq):
+        self.seq = seq
+        self.name = os.path.join(self.directory, 'journal.{0}'.format(seq))
+        self.file = open(self.name, 'a')
+
+    def switch(self, seq):
+        self.file.close()
+        self.open(seq)
+
+    def write(self, data):
+        self.file.write(data)
+
+    def flush(self):
+        self.file.flush()
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
+
+
+class StateStore(object):
+    """Snapshot and journal of Bot's user registry in a directory.
+
+    record() and record_last() journal each change through a LogWriter
+    thread. Every compact_every journal entries, compact() captures the
+    registry, starts a new journal segment and writes the snapshot on a
+    background thread; journal segments the snapshot covers are then
+    deleted.
+    """
+    def __init__(self, directory, logger, compact_every=200000,
+                 flush_interval=1.0):
+        self.directory = directory
+        self.logger = logger
+        self.compact_every = compact_every
+        self.flush_interval = flush_interval
+        self.entries = 0
+        self.seq = 0
+        self.compactor = None
+        self.writer = None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @property
+    def snapshot_path(self):
+        return os.path.join(self.directory, 'snapshot')
+
+    def journal_seqs(self):
+        seqs = []
+        for name in os.listdir(self.directory):
+            prefix, _, seq = name.partition('.')
+            if prefix == 'journal' and seq.isdigit():
+                seqs.append(int(seq))
+        return sorted(seqs)
+
+    def load(self, registry):
+        """Fill registry from disk. Returns the last message, if any.
+        """
+        start = time.time()
+        last_message = None
+        next_seq = 0
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'rb') as snapshot:
+                data = pickle.load(snapshot)
+            if data.get('version') == SNAPSHOT_VERSION:
+                next_seq = data['next_seq']
+                last_message = data['last_message']
+                for record in data['users']:
+                    registry.add(self.restore(record))
+            else:
+                self.logger.error("ignoring snapshot with version {0}"
+                                  .format(data.get('version')))
+        replayed = 0
+        seqs = [seq for seq in self.journal_seqs() if seq >= next_seq]
+        for seq in seqs:
+            path = os.path.join(self.directory, 'journal.{0}'.format(seq))
+            with open(path) as journal:
+                for line in journal:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Torn last line from a crash.
+                        continue
+                    if record[0] is None:
+                        last_message = record[1]
+                    else:
+                        registry.add(self.restore(record))
+                    replayed += 1
+        self.seq = max(seqs + [next_seq - 1]) + 1
+        self.entries = replayed
+        self.logger.info(
+            "loaded {0} user(s), replayed {1} journal entries in {2:.0f} ms"
+            .format(len(registry), replayed, (time.time() - start) * 1000))
+        return last_message
+
+    @staticmethod
+    def restore(record):
+        nick, channels, message, seen, when = record
+        user = User(nick)
+        user.channels = tuple(map(intern, channels))
+        user.message = message
+        user.seen = seen
+        user.time = when
+        return user
+
+    @staticmethod
+    def capture(user):
+        return (user.nick, user.channels, user.message, user.seen,
+                user.time)
+
+    def start(self):
+        self.writer = LogWriter(
+            Journal(self.directory, self.seq),
+            self.logger.getChild("journal"),
+            flush_lines=1000, flush_interval=self.flush_interval)
+        self.writer.start()
+
+    def record(self, user):
+        self.writer.write(json.dumps(self.capture(user)) + '\n')
+        self.entries += 1
+
+    def record_last(self, message):
+        self.writer.write(json.dumps([None, message]) + '\n')
+        self.entries += 1
+
+    def maybe_compact(self, registry, last_message):
+        if self.entries >= self.compact_every:
+            self.compact(registry, last_message)
+
+    def compact(self, registry, last_message, wait=False):
+        """Snapshot the registry as of now, without blocking on disk.
+        """
+        if self.compactor and self.compactor.is_alive():
+            if not wait:
+                return
+            self.compactor.join()
+        # Capturing has to happen here, on the thread that changes the
+        # registry; everything after it goes to the next journal.
+        users = [self.capture(user) for user in registry]
+        self.seq += 1
+        next_seq = self.seq
+        self.writer.call(lambda: self.writer.output.switch(next_seq))
+        self.entries = 0
+        data = {
+            'version': SNAPSHOT_VERSION,
+            'next_seq': next_seq,
+            'last_message': last_message,
+            'users': users,
+        }
+        self.compactor = threading.Thread(
+            target=self.write_snapshot, args=(data,),
+            name="otp22logbot-snapshot")
+        self.compactor.daemon = True
+        self.compactor.start()
+        if wait:
+            self.compactor.join()
+
+    def write_snapshot(self, data):
+        start = time.time()
+        partial = self.snapshot_path + '.part'
+        try:
+            with open(partial, 'wb') as snapshot:
+                pickle.dump(data, snapshot, pickle.HIGHEST_PROTOCOL)
+                snapshot.flush()
+                os.fsync(snapshot.fileno())
+            os.replace(partial, self.snapshot_path)
+        except (IOError, OSError):
+            self.logger.exception("error writing snapshot")
+            return
+        for seq in self.journal_seqs():
+            if seq < data['next_seq']:
+                os.remove(os.path.join(
+                    self.directory, 'journal.{0}'.format(seq)))
+        self.logger.info("snapshot of {0} user(s) written in {1:.0f} ms"
+                         .format(len(data['users']),
+                                 (time.time() - start) * 1000))
+
+    def close(self, registry, last_message):
+        """Take a final snapshot so the next start has no journal to replay.
+        """
+        self.compact(registry, last_message, wait=True)
+        self.writer.close()
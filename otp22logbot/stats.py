@@ -0,0 +1,322 @@
+"""Activity reports over text logs: top talkers, busiest hours and days.
+
+Logs are read in large chunks cut at line boundaries, so memory stays
+bounded by the chunk size and the number of distinct nicks, however
+big the archive. With NumPy installed each chunk is parsed as a byte
+array in a handful of vectorized passes; without it a regex per line
+does the same job more slowly.
+
+Only message lines, "<HH:MM:SS> nick (targets): text", are counted.
+The log carries no dates, so days are counted from the first line: a
+clock going backwards is taken to mean the next day, as in
+segment.parse_text.
+"""
+import argparse
+import collections
+import datetime
+import gzip
+import json
+import re
+import sys
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Nicks are compared on at most this many bytes, so they fit a fixed
+# width NumPy string type. Servers cap nicks well below this.
+NICK_WIDTH = 32
+CHUNK_SIZE = 8 * 1024 * 1024
+# Anything longer without a newline is not a log line; it is dropped.
+LINE_LIMIT = 64 * 1024
+MESSAGE_LINE = re.compile(
+    br'^<(\d\d):(\d\d):(\d\d)> (\S+) \(', re.MULTILINE)
+ROTATED = re.compile(r'\.(\d{8}-\d{6})(?:\.(\d+))?(?:\.gz)?$')
+
+
+class Report(object):
+    """Counts gathered from message lines.
+
+    nicks maps nick bytes to a list of 24 per hour counts, days maps
+    the day number (0 for the first day) to a count.
+    """
+
+    def __init__(self):
+        self.messages = 0
+        self.hours = [0] * 24
+        self.nicks = {}
+        self.days = collections.Counter()
+        self.day = 0
+        self.last_offset = None
+
+    def add_hours(self, nick, counts):
+        row = self.nicks.get(nick)
+        if row is None:
+            self.nicks[nick] = list(counts)
+        else:
+            for hour, count in enumerate(counts):
+                row[hour] += count
+
+    def top_talkers(self, count):
+        """[(nick, messages, busiest hour)] for the count busiest nicks.
+        """
+        totals = sorted(((sum(row), nick) for nick, row
+                         in self.nicks.items()),
+                        key=lambda item: (-item[0], item[1]))
+        return [(nick.decode('utf-8', 'replace'), total,
+                 busiest(self.nicks[nick]))
+                for total, nick in totals[:count]]
+
+    def busiest_hours(self, count=24):
+        return sorted(range(24), key=lambda hour: -self.hours[hour])[:count]
+
+    def user_hours(self, nick):
+        return self.nicks.get(nick.encode('utf-8')[:NICK_WIDTH])
+
+    def busiest_days(self, count, start=None):
+        """[(day, messages)]; day is a date if start is given.
+        """
+        days = sorted(self.days.items(), key=lambda item: (-item[1], item[0]))
+        if start is not None:
+            days = [(start + datetime.timedelta(days=day), total)
+                    for day, total in days]
+        return days[:count]
+
+
+def busiest(row):
+    return max(range(len(row)), key=lambda hour: row[hour])
+
+
+def scan_python(report, data):
+    """Count the message lines in data, a run of whole lines.
+    """
+    for match in MESSAGE_LINE.finditer(data):
+        hours, minutes, seconds, nick = match.groups()
+        hour = int(hours)
+        if hour > 23:
+            continue
+        offset = hour * 3600 + int(minutes) * 60 + int(seconds)
+        if report.last_offset is not None and offset < report.last_offset:
+            report.day += 1
+        report.last_offset = offset
+        report.days[report.day] += 1
+        report.hours[hour] += 1
+        report.messages += 1
+        nick = nick[:NICK_WIDTH]
+        row = report.nicks.get(nick)
+        if row is None:
+            row = report.nicks[nick] = [0] * 24
+        row[hour] += 1
+
+
+def digits(data, positions):
+    """The two digit numbers starting at positions, and whether they are
+    digits at all.
+    """
+    tens = data[positions].astype(numpy.int64) - 48
+    units = data[positions + 1].astype(numpy.int64) - 48
+    valid = (tens >= 0) & (tens <= 9) & (units >= 0) & (units <= 9)
+    return tens * 10 + units, valid
+
+
+def scan_numpy(report, data):
+    """scan_python, one pass over the whole chunk per field.
+    """
+    array = numpy.frombuffer(data, dtype=numpy.uint8)
+    ends = numpy.flatnonzero(array == 10)
+    if not len(ends):
+        return
+    starts = numpy.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    # "<HH:MM:SS> n (" is 14 bytes before the newline
+    keep = ends - starts >= 14
+    starts, ends = starts[keep], ends[keep]
+    keep = ((array[starts] == ord('<')) & (array[starts + 3] == ord(':')) &
+            (array[starts + 6] == ord(':')) &
+            (array[starts + 9] == ord('>')) &
+            (array[starts + 10] == ord(' ')) &
+            (array[starts + 11] != ord(' ')))
+    starts, ends = starts[keep], ends[keep]
+    hours, valid_hours = digits(array, starts + 1)
+    minutes, valid_minutes = digits(array, starts + 4)
+    seconds, valid_seconds = digits(array, starts + 7)
+    # The nick ends at the first space after it, which has to be
+    # followed by " (" on the same line.
+    spaces = numpy.flatnonzero(array == 32)
+    nick_starts = starts + 11
+    found = numpy.searchsorted(spaces, nick_starts)
+    nick_ends = spaces[numpy.minimum(found, len(spaces) - 1)]
+    keep = (valid_hours & valid_minutes & valid_seconds & (hours < 24) &
+            (found < len(spaces)) & (nick_ends < ends))
+    keep[keep] &= array[nick_ends[keep] + 1] == ord('(')
+    if not keep.any():
+        return
+    hours, nick_starts, nick_ends = (
+        hours[keep], nick_starts[keep], nick_ends[keep])
+    offsets = hours * 3600 + minutes[keep] * 60 + seconds[keep]
+
+    previous = numpy.empty_like(offsets)
+    previous[0] = (offsets[0] if report.last_offset is None
+                   else report.last_offset)
+    previous[1:] = offsets[:-1]
+    days = report.day + numpy.cumsum(offsets < previous)
+    report.day = int(days[-1])
+    report.last_offset = int(offsets[-1])
+    first = int(days[0])
+    for day, total in enumerate(numpy.bincount(days - first)):
+        if total:
+            report.days[first + day] += int(total)
+
+    # Gather each nick into a fixed width row, zero padded, and look at
+    # the rows as NumPy byte strings to group them.
+    columns = nick_starts[:, None] + numpy.arange(NICK_WIDTH)
+    inside = columns < nick_ends[:, None]
+    rows = array[numpy.minimum(columns, len(array) - 1)] * inside
+    nicks = numpy.ascontiguousarray(rows).view('S{0}'.format(NICK_WIDTH))
+    unique, inverse = numpy.unique(nicks.ravel(), return_inverse=True)
+    per_hour = numpy.bincount(
+        inverse * 24 + hours, minlength=len(unique) * 24
+    ).reshape(len(unique), 24)
+    for nick, counts in zip(unique.tolist(), per_hour.tolist()):
+        report.add_hours(nick, counts)
+    for hour, total in enumerate(per_hour.sum(axis=0).tolist()):
+        report.hours[hour] += total
+    report.messages += len(hours)
+
+
+def read_chunks(path, chunk_size=CHUNK_SIZE):
+    """Yield the contents of a log, possibly gzipped, as runs of whole
+    lines of about chunk_size bytes each.
+    """
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as log:
+        rest = b''
+        while True:
+            data = log.read(chunk_size)
+            if not data:
+                break
+            end = data.rfind(b'\n')
+            if end == -1:
+                # No line is this long; don't let one grow forever.
+                rest = b'' if len(rest) > LINE_LIMIT else rest + data
+                continue
+            yield rest + data[:end + 1]
+            rest = data[end + 1:]
+        if rest:
+            yield rest + b'\n'
+
+
+def log_order(path):
+    """Sort key putting rotated logs in order, before the current one.
+    """
+    match = ROTATED.search(path)
+    if match:
+        return (0, path[:match.start()], match.group(1),
+                int(match.group(2) or 0))
+    return (1, path, '', 0)
+
+
+def analyze(paths, chunk_size=CHUNK_SIZE, vectorized=None):
+    """Report on the given logs, read in log_order.
+    """
+    if vectorized is None:
+        vectorized = numpy is not None
+    scan = scan_numpy if vectorized else scan_python
+    report = Report()
+    for path in sorted(paths, key=log_order):
+        for data in read_chunks(path, chunk_size):
+            scan(report, data)
+    return report
+
+
+def format_report(report, top=10, user=None, start=None):
+    lines = ['{0} messages from {1} nicks over {2} days'.format(
+        report.messages, len(report.nicks), report.day + 1
+        if report.messages else 0)]
+    lines.append('')
+    lines.append('top talkers:')
+    for nick, total, hour in report.top_talkers(top):
+        lines.append('  {0:20s} {1:10d}  busiest at {2:02d}:00'
+                     .format(nick, total, hour))
+    lines.append('')
+    lines.append('messages by hour (UTC):')
+    lines.extend(histogram(report.hours))
+    if user:
+        row = report.user_hours(user)
+        lines.append('')
+        if row is None:
+            lines.append('no messages from {0}'.format(user))
+        else:
+            lines.append('{0} by hour (UTC):'.format(user))
+            lines.extend(histogram(row))
+    lines.append('')
+    lines.append('busiest days:')
+    for day, total in report.busiest_days(top, start):
+        label = str(day) if start else 'day {0}'.format(day + 1)
+        lines.append('  {0:12s} {1:10d}'.format(label, total))
+    return '\n'.join(lines)
+
+
+def histogram(row, width=50):
+    peak = max(row) or 1
+    return ['  {0:02d} {1:10d} {2}'.format(
+        hour, count, '#' * int(round(count * width / float(peak))))
+        for hour, count in enumerate(row)]
+
+
+def report_dict(report, top=10, user=None, start=None):
+    result = {
+        'messages': report.messages,
+        'nicks': len(report.nicks),
+        'hours': report.hours,
+        'top_talkers': [
+            {'nick': nick, 'messages': total, 'busiest_hour': hour}
+            for nick, total, hour in report.top_talkers(top)],
+        'busiest_hours': report.busiest_hours(),
+        'busiest_days': [
+            [str(day), total]
+            for day, total in report.busiest_days(top, start)],
+    }
+    if user:
+        result['user'] = {'nick': user, 'hours': report.user_hours(user)}
+    return result
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        description="Activity report over text logs, gzipped or not.")
+    parser.add_argument('logs', nargs='+', metavar='log')
+    parser.add_argument('--top', type=int, default=10,
+                        help='how many talkers and days to list')
+    parser.add_argument('--user', help='also show this nick by hour')
+    parser.add_argument(
+        '--date', help='UTC date the first log starts on, as YYYY-MM-DD, '
+        'to show dates instead of day numbers')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help='bytes read at a time')
+    parser.add_argument('--no-numpy', action='store_true',
+                        help='use the plain Python scanner')
+    parser.add_argument('--json', action='store_true',
+                        help='print the report as JSON')
+    return parser
+
+
+def main(argv=None):
+    args = make_parser().parse_args(argv)
+    start = None
+    if args.date:
+        start = datetime.datetime.strptime(args.date, '%Y-%m-%d').date()
+    report = analyze(args.logs, args.chunk_size,
+                     vectorized=False if args.no_numpy else None)
+    if args.json:
+        json.dump(report_dict(report, args.top, args.user, start),
+                  sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        print(format_report(report, args.top, args.user, start))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
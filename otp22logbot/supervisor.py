@@ -0,0 +1,211 @@
+"""Run one bot per network, each in its own worker process.
+
+A busy network only uses up its own process's CPU and GIL. The
+supervisor restarts a worker that crashes, with backoff, and leaves a
+network alone once its bot stops cleanly (.kill, or --no-reconnect).
+Workers send metric snapshots back over a queue; the supervisor
+serves or writes them together, labelled by network, and logs one
+line per network on shutdown.
+"""
+import multiprocessing
+import queue
+import signal
+import threading
+import time
+from otp22logbot import metrics
+from otp22logbot.backoff import Backoff
+
+
+def run_network(name, app_args, reports, interval):
+    """Worker process: run one network's bot until it stops.
+    """
+    from otp22logbot.main import configure_logging, run_bot
+    # The supervisor stops workers with SIGTERM; make it the
+    # KeyboardInterrupt the bot already answers by QUITting.
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    logger = configure_logging(app_args, name)
+    stopped = threading.Event()
+
+    def report():
+        while not stopped.wait(interval):
+            reports.put((name, metrics.REGISTRY.snapshot()))
+    reporter = None
+    if app_args.metrics:
+        reporter = threading.Thread(target=report, name="otp22logbot-report")
+        reporter.daemon = True
+        reporter.start()
+    try:
+        run_bot(app_args, logger)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stopped.set()
+        reports.put((name, metrics.REGISTRY.snapshot()))
+
+
+class Worker(object):
+    """One network's process, and its restart history.
+    """
+    def __init__(self, name, app_args, backoff):
+        self.name = name
+        self.app_args = app_args
+        self.backoff = backoff
+        self.process = None
+        self.started = None
+        self.restart_at = None
+        self.restarts = 0
+        self.exitcode = None
+        self.done = False
+
+
+class Supervisor(object):
+    """Keeps a worker process running for each network.
+
+    networks is [(name, parsed args)], args as from main.make_parser.
+    A worker that exits with status 0 is done; any other exit is a
+    crash, and the worker is started again after a delay that grows
+    while it keeps crashing within stable_after seconds of starting.
+    """
+    def __init__(self, networks, logger, target=run_network,
+                 report_interval=5.0, restart_delay=1.0,
+                 restart_max_delay=60.0, stable_after=60.0,
+                 stop_timeout=10.0, context=None):
+        self.logger = logger
+        self.target = target
+        self.report_interval = report_interval
+        self.stable_after = stable_after
+        self.stop_timeout = stop_timeout
+        # spawn: workers start clean, without the supervisor's threads.
+        self.context = context or multiprocessing.get_context('spawn')
+        self.reports = self.context.Queue()
+        self.aggregate = metrics.Aggregate()
+        self.stopping = threading.Event()
+        self.workers = [
+            Worker(name, app_args, Backoff(restart_delay, restart_max_delay))
+            for name, app_args in networks]
+
+    def start(self, worker):
+        worker.process = self.context.Process(
+            target=self.target,
+            args=(worker.name, worker.app_args, self.reports,
+                  self.report_interval),
+            name="otp22logbot-{0}".format(worker.name))
+        worker.process.start()
+        worker.started = time.time()
+        worker.restart_at = None
+        self.logger.info("started {0} (pid {1})"
+                         .format(worker.name, worker.process.pid))
+
+    def check(self, worker, now):
+        """Notice a worker exiting, and restart it when it's time.
+        """
+        if worker.done:
+            return
+        if worker.restart_at is not None:
+            if now >= worker.restart_at:
+                worker.restarts += 1
+                self.start(worker)
+            return
+        if worker.process.is_alive():
+            return
+        worker.process.join()
+        worker.exitcode = worker.process.exitcode
+        if worker.exitcode == 0:
+            self.logger.info("{0} stopped".format(worker.name))
+            worker.done = True
+            return
+        if now - worker.started >= self.stable_after:
+            worker.backoff.reset()
+        delay = worker.backoff.next()
+        worker.restart_at = now + delay
+        self.logger.error("{0} exited with status {1}; restarting in "
+                          "{2:.1f}s".format(worker.name, worker.exitcode,
+                                            delay))
+
+    def collect(self):
+        """Take metric snapshots off the queue.
+        """
+        while True:
+            try:
+                name, snapshot = self.reports.get_nowait()
+            except queue.Empty:
+                return
+            self.aggregate.update(name, snapshot)
+
+    def run(self, poll=0.2):
+        """Run until every network is done or stop() is called.
+        """
+        for worker in self.workers:
+            self.start(worker)
+        try:
+            while not self.stopping.is_set():
+                now = time.time()
+                for worker in self.workers:
+                    self.check(worker, now)
+                self.collect()
+                if all(worker.done for worker in self.workers):
+                    break
+                self.stopping.wait(poll)
+        except KeyboardInterrupt:
+            self.logger.info("received KeyboardInterrupt")
+        self.shutdown()
+
+    def stop(self):
+        self.stopping.set()
+
+    def shutdown(self):
+        """Ask every worker to quit, then kill those that don't.
+        """
+        running = [worker for worker in self.workers
+                   if worker.process and worker.process.is_alive()]
+        for worker in running:
+            worker.process.terminate()
+        deadline = time.time() + self.stop_timeout
+        for worker in running:
+            worker.process.join(max(0, deadline - time.time()))
+            if worker.process.is_alive():
+                self.logger.error("{0} did not stop; killing it"
+                                  .format(worker.name))
+                worker.process.kill()
+                worker.process.join()
+            worker.exitcode = worker.process.exitcode
+        # Workers flush their final snapshot before exiting.
+        self.collect()
+        for worker in self.workers:
+            line = "{0}: exit status {1}, {2} restart(s)".format(
+                worker.name, worker.exitcode, worker.restarts)
+            if worker.name in self.aggregate.snapshots:
+                line += ", parsed {0} lines, sent {1} lines".format(
+                    self.aggregate.total(
+                        worker.name, metrics.LINES_PARSED.name),
+                    self.aggregate.total(
+                        worker.name, metrics.LINES_SENT.name))
+            self.logger.info(line)
+
+
+def run(networks, app_args, logger):
+    """Supervise networks, exporting their metrics as app_args says.
+    """
+    supervisor = Supervisor(networks, logger)
+    signal.signal(signal.SIGTERM, lambda signum, frame: supervisor.stop())
+    exporter = server = None
+    if app_args.metrics_file:
+        exporter = metrics.TextfileExporter(
+            app_args.metrics_file, logger.getChild("metrics"),
+            registry=supervisor.aggregate)
+    if app_args.metrics_port:
+        server = metrics.serve_http(
+            app_args.metrics_port, logger.getChild("metrics"),
+            registry=supervisor.aggregate)
+    logger.info("running {0} network(s): {1}".format(
+        len(networks), ', '.join(name for name, _ in networks)))
+    try:
+        supervisor.run()
+    finally:
+        if exporter:
+            exporter.close()
+        if server:
+            server.shutdown()
+    crashed = [worker for worker in supervisor.workers
+               if worker.exitcode not in (0, None)]
+    return 1 if crashed else 0
@@ -0,0 +1,174 @@
+import logging
+import threading
+import time
+from otp22logbot import activity
+from otp22logbot.activity import OTHERS, Activity, Ring
+from otp22logbot.bot import Bot
+from otp22logbot.main import make_parser
+
+# A Monday, 00:00 UTC.
+MIDNIGHT = 1388966400.0
+
+
+class Test_Ring(object):
+    def test_window_covers_whole_buckets(self):
+        ring = Ring(300, 12, 10)
+        ring.add('a', 2, MIDNIGHT)
+        ring.add('a', 3, MIDNIGHT + 299)
+        ring.add('b', 1, MIDNIGHT + 300)
+        assert ring.totals(3600, MIDNIGHT + 300) == {'a': [2, 5],
+                                                     'b': [1, 1]}
+        assert ring.totals(300, MIDNIGHT + 300) == {'b': [1, 1]}
+        # Eleven buckets later the first one has left the hour.
+        assert ring.totals(3600, MIDNIGHT + 12 * 300) == {'b': [1, 1]}
+
+    def test_stale_periods_are_ignored(self):
+        ring = Ring(300, 12, 10)
+        ring.add('a', 1, MIDNIGHT + 3600)
+        assert not ring.add('b', 1, MIDNIGHT)
+        assert not ring.add('b', 1, MIDNIGHT - 3600)
+        assert ring.add('c', 1, MIDNIGHT + 300)
+        assert ring.totals(3600, MIDNIGHT + 3600) == {'a': [1, 1],
+                                                      'c': [1, 1]}
+
+    def test_old_buckets_are_reused(self):
+        ring = Ring(300, 12, 10)
+        ring.add('a', 1, MIDNIGHT)
+        ring.add('b', 1, MIDNIGHT + 3600)
+        assert ring.buckets[0] == {'b': [1, 1]}
+        assert ring.totals(3600, MIDNIGHT + 3600) == {'b': [1, 1]}
+        assert ring.totals(3600, MIDNIGHT + 10 * 3600) == {}
+
+    def test_nicks_past_the_limit_are_lumped(self):
+        ring = Ring(300, 12, 2)
+        for nick in 'abcd':
+            ring.add(nick, 1, MIDNIGHT)
+        ring.add('a', 1, MIDNIGHT)
+        assert ring.totals(300, MIDNIGHT) == {'a': [2, 2], 'b': [1, 1],
+                                              OTHERS: [2, 2]}
+
+
+class Test_Activity(object):
+    def test_top_and_windows(self):
+        stats = Activity()
+        stats.add('alice', ['#a'], 'one two three', MIDNIGHT - 2 * 86400)
+        stats.add('bob', ['#a', '#B'], 'hi', MIDNIGHT - 7200)
+        stats.add('bob', ['#a'], 'hi there', MIDNIGHT - 60)
+        stats.add('carol', ['#a'], 'hello', MIDNIGHT - 60)
+        assert stats.top('#a', 'hour', MIDNIGHT) == [('bob', 1, 2),
+                                                     ('carol', 1, 1)]
+        assert stats.top('#a', 'day', MIDNIGHT) == [('bob', 2, 3),
+                                                    ('carol', 1, 1)]
+        assert stats.top('#a', 'week', MIDNIGHT, count=1) == [('bob', 2, 3)]
+        assert stats.top('#b', 'day', MIDNIGHT) == [('bob', 1, 1)]
+        assert stats.top('#c', 'day', MIDNIGHT) == []
+        assert stats.busiest_hours('#a') == [(23, 2), (0, 1), (22, 1)]
+        assert stats.user('#a', 'bob') == [2, 3]
+        assert stats.user('#a', 'dave') is None
+
+    def test_users_are_bounded(self):
+        stats = Activity(max_nicks=2)
+        for nick in ['a', 'b', 'a', 'c']:
+            stats.add(nick, ['#a'], 'x', MIDNIGHT)
+        assert list(stats.channel('#a').users) == ['a', 'c']
+
+    def test_save_and_load(self, tmpdir):
+        path = str(tmpdir.join('activity.json'))
+        stats = Activity()
+        assert not activity.load(stats, path)
+        stats.add('alice', ['#a'], 'one two', MIDNIGHT - 60)
+        stats.add('bob', ['#a'], 'three', MIDNIGHT - 7200)
+        activity.save(stats.snapshot(), path)
+        loaded = Activity()
+        assert activity.load(loaded, path)
+        for window in activity.WINDOWS:
+            assert loaded.top('#a', window, MIDNIGHT) == \
+                stats.top('#a', window, MIDNIGHT)
+        assert loaded.busiest_hours('#a') == stats.busiest_hours('#a')
+        assert loaded.user('#a', 'alice') == [1, 2]
+        loaded.add('alice', ['#a'], 'four', MIDNIGHT)
+        assert loaded.top('#a', 'hour', MIDNIGHT) == [('alice', 2, 3)]
+
+    def test_queries_while_adding(self):
+        stats = Activity()
+        done = threading.Event()
+
+        def add():
+            for number in range(20000):
+                stats.add('nick{0}'.format(number), ['#a'], 'x',
+                          MIDNIGHT + number)
+            done.set()
+        thread = threading.Thread(target=add)
+        thread.start()
+        while not done.is_set():
+            stats.top('#a', 'week', MIDNIGHT + 20000)
+            stats.busiest_hours('#a')
+        thread.join()
+        assert stats.top('#a', 'hour', MIDNIGHT + 20000, count=1) == \
+            [('nick16500', 1, 1)]
+
+    def test_playback_from_before_the_hour(self):
+        stats = Activity()
+        for _ in range(50):
+            stats.add('alice', ['#a'], 'x', MIDNIGHT + 60)
+        # Replayed with server-time, into the slot alice's bucket holds.
+        stats.add('bob', ['#a'], 'x', MIDNIGHT + 60 - 3600)
+        assert stats.top('#a', 'hour', MIDNIGHT + 60) == [('alice', 50, 50)]
+        assert stats.top('#a', 'day', MIDNIGHT + 60) == [('alice', 50, 50),
+                                                         ('bob', 1, 1)]
+        # Past the week ring's span: counted for no window or hour.
+        stats.add('carol', ['#a'], 'x', MIDNIGHT - 8 * 86400)
+        assert stats.top('#a', 'week', MIDNIGHT + 60, count=3) == [
+            ('alice', 50, 50), ('bob', 1, 1)]
+        assert stats.busiest_hours('#a') == [(0, 50), (23, 1)]
+
+
+class Conn(object):
+    def __init__(self):
+        self.sent = []
+
+    def privmsg_user(self, nick, text):
+        self.sent.append((nick, text))
+
+    def privmsg_channel(self, channel, text):
+        self.sent.append((channel, text))
+
+
+class Test_Bot_top(object):
+    logger = logging.getLogger("")
+
+    def test_top(self, tmpdir):
+        app_args = make_parser().parse_args(
+            ['-o', str(tmpdir.join('out.log')), '-c', 'ircugm,otp22',
+             '--state-dir', str(tmpdir.join('state'))])
+        bot = Bot(app_args, self.logger)
+        bot.startup()
+        conn = Conn()
+        bot.top(conn, 'd', '#ircugm', [''])
+        assert conn.sent == [
+            ('#ircugm', 'nobody has said anything in #ircugm in the last '
+                        'day')]
+        now = time.time()
+        bot.activity.add('alice', ['#otp22'], 'a b c', now)
+        bot.activity.add('bob', ['#otp22'], 'a', now)
+        bot.activity.add('alice', ['#otp22'], 'a', now)
+        hour = int(now // 3600) % 24
+        conn = Conn()
+        bot.top(conn, 'd', 'otp22logbot', ['week #otp22'])
+        assert conn.sent == [
+            ('d', 'top in #otp22, last week: alice 2 msgs/4 words, '
+                  'bob 1 msgs/1 words'),
+            ('d', 'busiest hours (UTC): {0:02d}:00 (3)'.format(hour))]
+        conn = Conn()
+        bot.top(conn, 'd', '#elsewhere', ['hour'])
+        assert conn.sent == [('#elsewhere', '#elsewhere is not logged here')]
+        conn = Conn()
+        bot.top(conn, 'd', '#otp22', ['alice'])
+        bot.top(conn, 'd', '#otp22', ['carol'])
+        assert conn.sent == [('#otp22', 'alice in #otp22: 2 msgs/4 words'),
+                             ('#otp22', 'nothing counted from carol in '
+                                        '#otp22')]
+        bot.shutdown()
+        loaded = Activity()
+        assert activity.load(loaded, bot.activity_path)
+        assert loaded.user('#otp22', 'alice') == [2, 4]
@@ -0,0 +1,138 @@
+import asyncio
+import logging
+import threading
+from otp22logbot import metrics
+from otp22logbot.aio import AsyncBot
+from otp22logbot.main import make_parser
+
+
+class Test_AsyncBot(object):
+    logger = logging.getLogger("")
+
+    def test_logs_pongs_and_answers_commands(self, tmpdir):
+        received = []
+        output = str(tmpdir.join('out.log'))
+
+        async def serve(reader, writer):
+            # Handshake: NICK, USER, JOIN, greeting, channel hello.
+            for _ in range(5):
+                received.append(await reader.readline())
+            writer.write(b"PING :irc.example.net\r\n")
+            writer.write(b":a!b@c PRIVMSG #ircugm :hel")
+            await writer.drain()
+            writer.write(b"lo\r\n:a!b@c PRIVMSG #ircugm :.version\r\n")
+            await writer.drain()
+            received.append(await reader.readline())
+            received.append(await reader.readline())
+            writer.close()
+
+        async def run():
+            server = await asyncio.start_server(serve, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            app_args = make_parser().parse_args(
+                ['-o', output, '-p', str(port), '-s', '127.0.0.1',
+                 '--flood-burst', '10', '--no-reconnect'])
+            bot = AsyncBot(app_args, self.logger)
+            bot.writer.start()
+            await bot.main_async()
+            server.close()
+            bot.shutdown()
+
+        asyncio.run(run())
+        assert received[0] == b"NICK otp22logbot\r\n"
+        assert received[5] == b"PONG :irc.example.net\r\n"
+        assert received[6].startswith(b"PRIVMSG #ircugm :0.0.4a")
+        with open(output) as log:
+            lines = log.read().splitlines()
+        assert lines[0].endswith("a (#ircugm): hello")
+        assert lines[1].endswith("a (#ircugm): .version")
+
+    def test_unpooled_commands_leave_the_loop_free(self, tmpdir):
+        release = threading.Event()
+        received = []
+
+        def slow(conn, requester, target, args):
+            released = release.wait(5)
+            conn.privmsg_user(requester, 'done' if released else 'stuck')
+
+        async def serve(reader, writer):
+            for _ in range(5):
+                await reader.readline()
+            writer.write(b":a!b@c PRIVMSG otp22logbot :.slow\r\n"
+                         b"PING :irc.example.net\r\n")
+            await writer.drain()
+            received.append(await reader.readline())
+            release.set()
+            received.append(await reader.readline())
+            writer.close()
+
+        async def run():
+            server = await asyncio.start_server(serve, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            app_args = make_parser().parse_args(
+                ['-o', str(tmpdir.join('out.log')), '-p', str(port),
+                 '-s', '127.0.0.1', '--command-workers', '0',
+                 '--no-reconnect'])
+            bot = AsyncBot(app_args, self.logger)
+            bot.commands['.slow'] = slow
+            bot.writer.start()
+            await bot.main_async()
+            server.close()
+            bot.shutdown()
+
+        asyncio.run(run())
+        assert received == [b"PONG :irc.example.net\r\n",
+                            b"PRIVMSG a :done\r\n"]
+
+    def test_reconnects_and_marks_gap(self, tmpdir):
+        output = str(tmpdir.join('out.log'))
+        connections = []
+
+        async def serve(reader, writer):
+            connections.append(writer)
+            lines = []
+            # Handshake: NICK, USER, JOIN, then greetings only the
+            # first time.
+            for _ in range(5 if len(connections) == 1 else 3):
+                lines.append(await reader.readline())
+            assert lines[0] == b"NICK otp22logbot\r\n"
+            if len(connections) == 1:
+                writer.write(b":irc 001 otp22logbot :Welcome\r\n"
+                             b":a!b@c PRIVMSG #ircugm :before\r\n")
+                await writer.drain()
+                writer.close()
+                return
+            writer.write(b":a!b@c PRIVMSG #ircugm :after\r\n"
+                         b":a!b@c PRIVMSG otp22logbot :.kill secret\r\n")
+            await writer.drain()
+            await reader.read()
+
+        async def run():
+            server = await asyncio.start_server(serve, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            app_args = make_parser().parse_args(
+                ['-o', output, '-p', str(port), '-s', '127.0.0.1',
+                 '-k', 'secret', '--reconnect-delay', '0.05'])
+            bot = AsyncBot(app_args, self.logger)
+            bot.writer.start()
+            metrics.enable()
+            try:
+                await asyncio.wait_for(bot.main_async(), 10)
+            finally:
+                metrics.disable()
+            server.close()
+            bot.shutdown()
+            return bot
+
+        metrics.REGISTRY.reset()
+        asyncio.run(run())
+        assert len(connections) == 2
+        assert metrics.RECONNECTS.value('closed') == 1
+        assert metrics.RECONNECT_SECONDS.count() == 1
+        with open(output) as log:
+            lines = log.read().splitlines()
+        assert lines[0].endswith("a (#ircugm): before")
+        assert lines[1] == "connection closed"
+        assert lines[2].startswith("-- connection lost (closed) at ")
+        assert lines[3].startswith("-- reconnected after ")
+        assert lines[4].endswith("a (#ircugm): after")
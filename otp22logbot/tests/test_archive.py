@@ -0,0 +1,73 @@
+import logging
+from otp22logbot.archive import Archive
+from otp22logbot.bot import Bot
+from otp22logbot.main import make_parser
+
+
+class Test_Archive(object):
+    logger = logging.getLogger("")
+
+    def archive(self, tmpdir):
+        archive = Archive(str(tmpdir.join('archive.db')), self.logger,
+                          batch_size=3)
+        archive.add(1.0, 'alice', '#a', 'the quick brown fox')
+        archive.add(2.0, 'bob', '#a', 'a quick "test" of search')
+        archive.add(3.0, 'Alice', '#b', 'nothing to see')
+        archive.add(4.0, 'alice', '#a', 'QUICK again')
+        archive.close()
+        return archive
+
+    def test_terms(self, tmpdir):
+        archive = self.archive(tmpdir)
+        total, rows = archive.search(['quick'])
+        assert total == 3
+        assert [row[0] for row in rows] == [4.0, 2.0, 1.0]
+
+    def test_nick_and_paging(self, tmpdir):
+        archive = self.archive(tmpdir)
+        total, rows = archive.search(['quick'], nick='ALICE', per_page=1)
+        assert total == 2
+        assert rows == [(4.0, 'alice', '#a', 'QUICK again')]
+        total, rows = archive.search(['quick'], nick='alice', page=2,
+                                     per_page=1)
+        assert rows == [(1.0, 'alice', '#a', 'the quick brown fox')]
+
+    def test_query_syntax_is_literal(self, tmpdir):
+        archive = self.archive(tmpdir)
+        assert archive.search(['"test"'])[0] == 1
+        assert archive.search(['OR'])[0] == 0
+
+    def test_like_fallback(self, tmpdir):
+        archive = self.archive(tmpdir)
+        archive.fts = False
+        assert archive.search(['quick'])[0] == 3
+        assert archive.search(['100%'])[0] == 0
+
+
+class Conn(object):
+    def __init__(self):
+        self.sent = []
+
+    def privmsg_user(self, nick, text):
+        self.sent.append((nick, text))
+
+
+class Test_Bot_search(object):
+    logger = logging.getLogger("")
+
+    def test_long_results_are_split(self, tmpdir):
+        app_args = make_parser().parse_args(
+            ['-o', str(tmpdir.join('out.log')),
+             '--archive', str(tmpdir.join('archive.db'))])
+        bot = Bot(app_args, self.logger)
+        text = 'needle ' + 'x' * 480
+        bot.archive.add(0.0, 'alice', '#a', text)
+        bot.archive.close()
+        conn = Conn()
+        bot.search(conn, 'd', '#a', ['needle'])
+        assert conn.sent[0] == ('d', '1 match(es), page 1 of 1')
+        pieces = [line for nick, line in conn.sent[1:]]
+        assert len(pieces) == 2
+        assert all(len(piece.encode('utf-8')) <= 400 for piece in pieces)
+        assert ''.join(pieces).endswith('alice (#a): ' + text)
+        bot.writer.close()
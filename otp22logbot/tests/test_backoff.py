@@ -0,0 +1,19 @@
+from otp22logbot.backoff import Backoff
+
+
+class Test_Backoff(object):
+    def test_doubles_up_to_maximum(self):
+        backoff = Backoff(1.0, 10.0, random=lambda: 1.0)
+        assert [backoff.next() for _ in range(6)] == [
+            1.0, 2.0, 4.0, 8.0, 10.0, 10.0]
+
+    def test_jitter_is_upper_half(self):
+        backoff = Backoff(4.0, 100.0, random=lambda: 0.0)
+        assert [backoff.next() for _ in range(3)] == [2.0, 4.0, 8.0]
+
+    def test_reset(self):
+        backoff = Backoff(1.0, 10.0, random=lambda: 1.0)
+        backoff.next()
+        backoff.next()
+        backoff.reset()
+        assert backoff.next() == 1.0
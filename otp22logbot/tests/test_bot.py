@@ -0,0 +1,125 @@
+import logging
+import socket
+import pytest
+import threading
+from otp22logbot.bot import Bot
+from otp22logbot.connection import Connection
+from otp22logbot.main import make_parser
+
+
+class Test_run(object):
+    logger = logging.getLogger("")
+
+    def serve(self, listener, connections):
+        for number in range(2):
+            sock, _ = listener.accept()
+            connections.append(sock)
+            reader = sock.makefile('rb')
+            # NICK, USER, JOIN, then greetings on the first connection.
+            lines = [reader.readline() for _ in range(5 - 2 * number)]
+            assert lines[0] == b"NICK otp22logbot\r\n"
+            if number == 0:
+                sock.sendall(b":irc 001 otp22logbot :Welcome\r\n"
+                             b":a!b@c PRIVMSG #ircugm :before\r\n")
+                reader.close()
+                sock.close()
+                continue
+            # Taken nick (our ghost), then the rest.
+            sock.sendall(b":irc 433 * otp22logbot :Nickname is in use\r\n")
+            assert reader.readline() == b"NICK otp22logbot_\r\n"
+            sock.sendall(b":a!b@c PRIVMSG #ircugm :after\r\n"
+                         b":a!b@c PRIVMSG otp22logbot_ :.kill secret\r\n")
+            reader.read()
+            reader.close()
+            sock.close()
+
+    @pytest.mark.parametrize('options', [[], ['--selector']])
+    def test_reconnects_and_marks_gap(self, tmpdir, options):
+        output = str(tmpdir.join('out.log'))
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(2)
+        port = listener.getsockname()[1]
+        connections = []
+        server = threading.Thread(
+            target=self.serve, args=(listener, connections))
+        server.daemon = True
+        server.start()
+        app_args = make_parser().parse_args(
+            ['-o', output, '-p', str(port), '-s', '127.0.0.1',
+             '-k', 'secret', '--reconnect-delay', '0.05',
+             '--command-workers', '0'] + options)
+        bot = Bot(app_args, self.logger)
+        bot.writer.start()
+        bot.run()
+        bot.shutdown()
+        server.join(5)
+        listener.close()
+        assert len(connections) == 2
+        with open(output) as log:
+            lines = log.read().splitlines()
+        assert lines[0].endswith("a (#ircugm): before")
+        assert lines[1] == "connection closed"
+        assert lines[2].startswith("-- connection lost (closed) at ")
+        assert lines[3].startswith("-- reconnected after ")
+        assert lines[4].endswith("a (#ircugm): after")
+        assert bot.activity.user('#ircugm', 'a') == [2, 2]
+
+
+class Test_select_loop(object):
+    logger = logging.getLogger("")
+
+    def test_keepalive_pings_then_gives_up(self, tmpdir):
+        ours, theirs = socket.socketpair()
+        app_args = make_parser().parse_args(
+            ['-o', str(tmpdir.join('out.log')), '--keepalive', '1',
+             '--flood-rate', '0'])
+        bot = Bot(app_args, self.logger)
+        conn = Connection(ours, self.logger)
+        theirs.sendall(b":a!b@c PRIVMSG #ircugm :hello\r\n")
+        assert bot.select_loop(conn) == 'keepalive'
+        assert theirs.recv(100) == b"PING :localhost\r\n"
+        bot.writer.close()
+        theirs.close()
+        assert tmpdir.join('out.log').read().endswith(
+            "a (#ircugm): hello\n")
+
+    def test_endless_input_does_not_starve_timers(self, tmpdir):
+        ours, theirs = socket.socketpair()
+        app_args = make_parser().parse_args(
+            ['-o', str(tmpdir.join('out.log')), '--keepalive', '1',
+             '--flood-rate', '0'])
+        bot = Bot(app_args, self.logger)
+        conn = Connection(ours, self.logger)
+        line = b":a!b@c PRIVMSG #ircugm :more\r\n"
+        # A server that always has more: the socket stays readable and
+        # every read returns data.
+        conn.recv_into = lambda: memoryview(line)
+        theirs.sendall(b"x")
+        bot.writer.start()
+        threading.Timer(0.5, setattr, (bot, 'should_die', True)).start()
+        thread = threading.Thread(target=bot.select_loop, args=(conn,))
+        thread.daemon = True
+        thread.start()
+        thread.join(10)
+        assert not thread.is_alive()
+        bot.writer.close()
+        theirs.close()
+
+
+class Test_file_send(object):
+    logger = logging.getLogger("")
+
+    @pytest.mark.parametrize('overflow', ['drop', 'error'])
+    def test_full_queue_drops_lines(self, tmpdir, overflow):
+        output = tmpdir.join('out.log')
+        app_args = make_parser().parse_args(
+            ['-o', str(output), '--queue-size', '1',
+             '--overflow', overflow])
+        bot = Bot(app_args, self.logger)
+        bot.file_send("a")
+        bot.file_send("b")
+        assert bot.log_full
+        assert bot.writer.stats.dropped == 1
+        bot.writer.close()
+        assert output.read() == "a\n"
@@ -0,0 +1,73 @@
+import io
+import pytest
+from otp22logbot import config
+from otp22logbot.main import make_parser, network_args
+
+CONFIG = """
+[DEFAULT]
+nick = logbot
+output = logs/%(network)s.log
+flood-rate = 2.5
+async = yes
+
+[network:freenode]
+server = irc.freenode.net
+channel = ircugm,otp22
+
+[network:oftc]
+server = irc.oftc.net
+no-reconnect = true
+"""
+
+
+class Test_config(object):
+    def test_load(self):
+        defaults, networks = config.load(io.StringIO(CONFIG))
+        assert defaults['output'] == 'logs/otp22logbot.log'
+        assert [name for name, _ in networks] == ['freenode', 'oftc']
+        assert networks[0][1]['output'] == 'logs/freenode.log'
+        assert networks[1][1]['server'] == 'irc.oftc.net'
+
+    def test_apply_converts_like_command_line(self):
+        defaults, networks = config.load(io.StringIO(CONFIG))
+        app_args = config.apply(
+            make_parser(), dict(defaults, **networks[1][1])).parse_args([])
+        assert app_args.nick == 'logbot'
+        assert app_args.flood_rate == 2.5
+        assert app_args.use_async is True
+        assert app_args.reconnect is False
+        # Command line wins.
+        app_args = config.apply(make_parser(), defaults).parse_args(
+            ['--flood-rate', '4', '-n', 'other'])
+        assert app_args.flood_rate == 4.0
+        assert app_args.nick == 'other'
+
+    @pytest.mark.parametrize("text", [
+        "[DEFAULT]\nno-such-option = 1\n",
+        "[DEFAULT]\nasync = maybe\n",
+        "[DEFAULT]\ninit = other.ini\n",
+        "[freenode]\nserver = x\n",
+        "[network:]\nserver = x\n",
+        "[DEFAULT\n",
+    ])
+    def test_errors(self, text):
+        with pytest.raises(config.ConfigError):
+            defaults, networks = config.load(io.StringIO(text))
+            config.apply(make_parser(), defaults)
+
+    @pytest.mark.parametrize('channels', ['', ',', ' # ,'])
+    def test_empty_channel_list(self, channels, capsys):
+        with pytest.raises(SystemExit):
+            make_parser().parse_args(['-c', channels])
+        assert 'no channel name' in capsys.readouterr().err
+
+    def test_networks_need_own_files(self, tmpdir):
+        path = tmpdir.join('bot.ini')
+        path.write(CONFIG.replace('%(network)s', 'shared'))
+        defaults, networks = config.load(io.StringIO(path.read()))
+        argv = ['-i', str(path)]
+        parsed = [(name, network_args(argv, defaults, options))
+                  for name, options in networks]
+        assert parsed[0][1].init == str(path)
+        with pytest.raises(config.ConfigError):
+            config.check_networks(parsed)
@@ -0,0 +1,106 @@
+import logging
+import socket
+from otp22logbot.connection import Connection, ReceiveBuffer
+
+
+class Socket(object):
+    def __init__(self):
+        self.sent = []
+
+    def sendall(self, data):
+        self.sent.append(data)
+
+
+class Test_write(object):
+    logger = logging.getLogger("")
+
+    def test_socket_errors_are_not_raised(self):
+        for error in [BrokenPipeError(), ConnectionResetError(),
+                      socket.timeout("timed out")]:
+            sock = Socket()
+
+            def sendall(data, error=error):
+                raise error
+            sock.sendall = sendall
+            conn = Connection(sock, self.logger)
+            assert conn.write(b"PONG :a\r\n") == 0
+
+
+class Test_join(object):
+    logger = logging.getLogger("")
+
+    def connection(self):
+        return Connection(Socket(), self.logger)
+
+    def test_one_line(self):
+        conn = self.connection()
+        conn.join(['#a', '#b', '#c'])
+        assert conn.sock.sent == [b"JOIN #a,#b,#c\r\n"]
+
+    def test_keys_go_first(self):
+        conn = self.connection()
+        conn.join(['#a', '#b', '#c'], keys=['k1', 'k2'])
+        assert conn.sock.sent == [b"JOIN #a,#b,#c k1,k2\r\n"]
+
+    def test_keyed_channel_moved_ahead(self):
+        conn = self.connection()
+        conn.join(['#a', '#b'], keys=[None, 'kb'])
+        assert conn.sock.sent == [b"JOIN #b,#a kb\r\n"]
+
+    def test_splits_at_line_limit(self):
+        conn = self.connection()
+        channels = ['#channel{0:04d}'.format(i) for i in range(200)]
+        conn.join(channels)
+        # 200 * 13 bytes of channel list needs six lines.
+        assert len(conn.sock.sent) == 6
+        assert all(len(line) <= 512 for line in conn.sock.sent)
+        joined = []
+        for line in conn.sock.sent:
+            joined.extend(line[5:-2].decode('ascii').split(','))
+        assert joined == channels
+
+
+class Test_ReceiveBuffer(object):
+    def test_grows_when_filled_and_shrinks_when_idle(self):
+        buffer = ReceiveBuffer(size=1024, minimum=1024, maximum=4096,
+                               shrink_after=3)
+        assert len(buffer.filled(1024)) == 1024
+        assert len(buffer.buffer) == 2048
+        buffer.filled(2048)
+        buffer.filled(4096)
+        assert len(buffer.buffer) == 4096
+        for _ in range(3):
+            buffer.filled(10)
+        assert len(buffer.buffer) == 2048
+        # A middling read breaks the run of small ones.
+        buffer.filled(10)
+        buffer.filled(1000)
+        buffer.filled(10)
+        buffer.filled(10)
+        assert len(buffer.buffer) == 2048
+
+
+class Test_recv_into(object):
+    logger = logging.getLogger("")
+
+    def test_reads_until_empty_then_closed(self):
+        ours, theirs = socket.socketpair()
+        conn = Connection(ours, self.logger)
+        conn.set_nonblocking()
+        assert conn.recv_into() is None
+        theirs.sendall(b"x" * 10000)
+        received = b""
+        while len(received) < 10000:
+            data = conn.recv_into()
+            if data is not None:
+                received += bytes(data)
+        assert received == b"x" * 10000
+        conn.write(b"PONG :a\r\n")
+        assert theirs.recv(100) == b"PONG :a\r\n"
+        theirs.close()
+        while True:
+            data = conn.recv_into()
+            if data is not None:
+                break
+        assert len(data) == 0
+        conn.close()
@@ -0,0 +1,57 @@
+import asyncio
+import gzip
+import logging
+import socket
+import threading
+from otp22logbot.bot import Bot
+from otp22logbot.fakeserver import FakeServer, verify
+from otp22logbot.main import make_parser
+
+
+class Session(object):
+    def __init__(self, id, sent):
+        self.id = id
+        self.sent = sent
+
+
+class Test_verify(object):
+    def test_counts_missing_across_rotated_logs(self, tmpdir):
+        log = tmpdir.join('bot.log')
+        log.write("<00:00:01> user1 (#a): soak-0-2 xx\n"
+                  "<00:00:01> user1 (#a): soak-1-0\n")
+        with gzip.open(str(log) + '.20140101-000000.gz', 'wt') as rotated:
+            rotated.write("<00:00:00> user2 (#a): soak-0-0 x\n")
+        sessions = [Session(0, 3), Session(1, 2)]
+        # soak-0-1 and soak-1-1 never made it.
+        assert verify(sessions, [str(log)]) == 2
+
+
+class Test_FakeServer(object):
+    logger = logging.getLogger("")
+
+    def test_bot_logs_everything_and_dies_on_kill(self, tmpdir):
+        output = str(tmpdir.join('out.log'))
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        port = listener.getsockname()[1]
+        server = FakeServer(users=10, rate=200, duration=0.5,
+                            ping_interval=0.1, fragment=50, timeout=10,
+                            kill='secret')
+        thread = threading.Thread(target=asyncio.run, args=(
+            server.serve('127.0.0.1', port, sock=listener),))
+        thread.daemon = True
+        thread.start()
+        app_args = make_parser().parse_args(
+            ['-o', output, '-p', str(port), '-s', '127.0.0.1',
+             '-k', 'secret', '--no-reconnect', '--command-workers', '0'])
+        bot = Bot(app_args, self.logger)
+        bot.writer.start()
+        bot.run()
+        bot.shutdown()
+        thread.join(10)
+        assert not thread.is_alive()
+        assert bot.should_die
+        session, = server.sessions
+        assert session.sent > 0
+        assert session.report()['pongs'] > 0
+        assert verify(server.sessions, [output]) == 0
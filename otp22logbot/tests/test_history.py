@@ -0,0 +1,118 @@
+import logging
+import socket
+from otp22logbot.bot import Bot
+from otp22logbot.connection import Connection
+from otp22logbot.history import History, chunks
+from otp22logbot.main import make_parser
+
+
+def message(number, nick='a', target='#ircugm'):
+    return '<00:00:{0:02d}> {1} ({2}): line {0}'.format(number, nick, target)
+
+
+class Test_History(object):
+    def write_log(self, tmpdir, lines):
+        log = tmpdir.join('out.log')
+        log.write(''.join(line + '\n' for line in lines))
+        return str(log)
+
+    def test_ring_answers_without_the_file(self, tmpdir):
+        history = History(size=10)
+        for number in range(5):
+            history.add('a', ['#ircugm'], message(number))
+        missing = str(tmpdir.join('missing.log'))
+        assert history.lines(missing, 3) == [
+            message(2), message(3), message(4)]
+
+    def test_scans_file_backwards_for_older_lines(self, tmpdir):
+        lines = [message(number, nick='a' if number % 3 else 'b')
+                 for number in range(30)]
+        lines.insert(10, 'connection closed')
+        lines.insert(20, message(99, target='otp22logbot'))
+        path = self.write_log(tmpdir, lines)
+        history = History(size=2)
+        synced = []
+        found = history.lines(path, 4, nick='B',
+                              sync=lambda: synced.append(1))
+        assert found == [message(number, nick='b')
+                         for number in (18, 21, 24, 27)]
+        assert synced == [1]
+        # Private messages to the bot are never history.
+        assert message(99, target='otp22logbot') not in history.lines(
+            path, 50)
+
+    def test_index_picks_up_new_lines(self, tmpdir):
+        path = self.write_log(
+            tmpdir, [message(number) for number in range(10)])
+        history = History(size=1, depth=5)
+        assert history.lines(path, 3) == [message(7), message(8), message(9)]
+        with open(path, 'a') as log:
+            log.write(message(10) + '\n' + message(11) + '\n<00:00:12> a')
+        # The half written last line is left out.
+        assert history.lines(path, 6) == [
+            message(number) for number in range(6, 12)]
+        index, = history.indexes.values()
+        assert len(index.offsets) == 6
+
+    def test_index_dropped_on_rotation(self, tmpdir):
+        path = self.write_log(
+            tmpdir, [message(number) for number in range(10)])
+        history = History(size=1)
+        history.lines(path, 2)
+        tmpdir.join('out.log').rename(tmpdir.join('out.log.1'))
+        self.write_log(tmpdir, [message(50), message(51), message(52)])
+        assert history.lines(path, 5) == [message(50), message(51),
+                                          message(52)]
+
+    def test_chunks_keep_characters_whole(self):
+        text = 'x' + 'é' * 300
+        pieces = chunks(text, 100)
+        assert ''.join(pieces) == text
+        assert all(len(piece.encode('utf-8')) <= 100 for piece in pieces)
+
+
+class Conn(object):
+    def __init__(self):
+        self.sent = []
+
+    def privmsg_user(self, nick, text):
+        self.sent.append((nick, text))
+
+
+class Test_Bot_history(object):
+    logger = logging.getLogger("")
+
+    def test_history_is_sent_privately(self, tmpdir):
+        output = tmpdir.join('out.log')
+        output.write(''.join(message(number) + '\n' for number in range(20)))
+        app_args = make_parser().parse_args(
+            ['-o', str(output), '-c', 'ircugm,otp22', '--history-max', '5',
+             '--history-size', '3'])
+        bot = Bot(app_args, self.logger)
+        bot.backlog.add('c', ['#otp22'], message(30, 'c', '#otp22'))
+        conn = Conn()
+        bot.history(conn, 'd', '#ircugm', ['100'])
+        assert conn.sent == [('d', message(number))
+                             for number in range(15, 20)]
+        conn = Conn()
+        bot.last(conn, 'd', 'otp22logbot', ['1 #otp22'])
+        assert conn.sent == [('d', message(30, 'c', '#otp22'))]
+        conn = Conn()
+        bot.history(conn, 'd', 'otp22logbot', ['#elsewhere'])
+        assert conn.sent == [('d', '#elsewhere is not logged here')]
+        bot.writer.close()
+
+    def test_non_ascii_history_is_sent(self, tmpdir):
+        output = tmpdir.join('out.log')
+        output.write_text('<00:00:00> a (#ircugm): café\n', 'utf-8')
+        app_args = make_parser().parse_args(
+            ['-o', str(output), '-c', 'ircugm'])
+        bot = Bot(app_args, self.logger)
+        ours, theirs = socket.socketpair()
+        bot.history(Connection(ours, self.logger), 'd', '#ircugm', ['1'])
+        ours.close()
+        assert theirs.makefile('rb').read() == (
+            'PRIVMSG d :<00:00:00> a (#ircugm): café\r\n'
+            .encode('utf-8'))
+        theirs.close()
+        bot.writer.close()
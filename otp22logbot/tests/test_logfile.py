@@ -0,0 +1,96 @@
+import gzip
+import logging
+import os
+from otp22logbot.logfile import RotatingLog, ShardedLog, shard_filename
+
+
+class Test_RotatingLog(object):
+    logger = logging.getLogger("")
+
+    def segments(self, tmpdir):
+        return sorted(name for name in os.listdir(str(tmpdir))
+                      if name != 'out.log')
+
+    def test_rotate_on_size(self, tmpdir):
+        path = str(tmpdir.join('out.log'))
+        log = RotatingLog(path, self.logger, max_bytes=10)
+        log.write("12345\n")
+        log.write("67890\n")
+        log.write("abc\n")
+        log.close()
+        segment, = self.segments(tmpdir)
+        assert tmpdir.join(segment).read() == "12345\n67890\n"
+        assert tmpdir.join('out.log').read() == "abc\n"
+
+    def test_rotate_empty_is_noop(self, tmpdir):
+        log = RotatingLog(str(tmpdir.join('out.log')), self.logger)
+        assert log.rotate() is None
+        log.close()
+        assert self.segments(tmpdir) == []
+
+    def test_failed_rename_keeps_writing(self, tmpdir, monkeypatch):
+        log = RotatingLog(str(tmpdir.join('out.log')), self.logger,
+                          max_bytes=10)
+        renames = []
+
+        def rename(source, dest):
+            renames.append(dest)
+            raise OSError(18, "Invalid cross-device link")
+        monkeypatch.setattr(os, 'rename', rename)
+        log.write("first line\n")
+        log.write("second\n")
+        log.write("third\n")
+        # Not retried on every line.
+        assert len(renames) == 1
+        monkeypatch.undo()
+        log.retry_after = 0
+        log.write("fourth\n")
+        log.close()
+        segment, = self.segments(tmpdir)
+        assert tmpdir.join(segment).read() == \
+            "first line\nsecond\nthird\nfourth\n"
+
+    def test_rotate_and_compress(self, tmpdir):
+        log = RotatingLog(str(tmpdir.join('out.log')), self.logger,
+                          compress=True)
+        log.write("first\n")
+        log.rotate()
+        log.write("second\n")
+        log.rotate()
+        log.close()
+        segments = self.segments(tmpdir)
+        assert len(segments) == 2
+        contents = set()
+        for name in segments:
+            assert name.endswith('.gz')
+            with gzip.open(str(tmpdir.join(name))) as segment:
+                contents.add(segment.read())
+        assert contents == set([b"first\n", b"second\n"])
+
+
+class Test_ShardedLog(object):
+    logger = logging.getLogger("")
+
+    def test_lru_closes_idle_channels(self, tmpdir):
+        main = RotatingLog(str(tmpdir.join('out.log')), self.logger)
+        shards = str(tmpdir.join('channels'))
+        log = ShardedLog(main, shards, self.logger, max_open=2)
+        log.write_shard('#a', "a1\n")
+        log.write_shard('#B', "b1\n")
+        log.write_shard('#a', "a2\n")
+        log.write_shard('#c', "c1\n")
+        assert list(log.shards) == ['#a', '#c']
+        log.write_shard('#b', "b2\n")
+        log.write("main\n")
+        log.close()
+        assert tmpdir.join('channels', '#a.log').read() == "a1\na2\n"
+        assert tmpdir.join('channels', '#b.log').read() == "b1\nb2\n"
+        assert tmpdir.join('channels', '#c.log').read() == "c1\n"
+        assert tmpdir.join('out.log').read() == "main\n"
+
+    def test_shard_filename(self):
+        assert shard_filename('#Foo') == '#foo.log'
+        assert shard_filename('#../x') == '#..%2fx.log'
+        assert shard_filename('..') == '.log'
+        assert shard_filename('#caf\xe9') == '#caf%c3%a9.log'
+        assert shard_filename('#\u0101') != shard_filename('#\x101')
@@ -0,0 +1,121 @@
+import logging
+import sys
+import threading
+from otp22logbot import metrics
+from otp22logbot.protocol import message_iterator
+
+
+class Test_Registry(object):
+    def test_exposition(self):
+        registry = metrics.Registry()
+        counter = registry.counter('things_total', 'Things.', label='kind')
+        histogram = registry.histogram('wait_seconds', 'Waits.',
+                                       buckets=(0.1, 1.0))
+        counter.inc(label='a"b')
+        counter.inc(2, label='c')
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        assert registry.exposition().splitlines() == [
+            '# HELP things_total Things.',
+            '# TYPE things_total counter',
+            'things_total{kind="a\\"b"} 1',
+            'things_total{kind="c"} 2',
+            '# HELP wait_seconds Waits.',
+            '# TYPE wait_seconds histogram',
+            'wait_seconds_bucket{le="0.1"} 1',
+            'wait_seconds_bucket{le="1.0"} 2',
+            'wait_seconds_bucket{le="+Inf"} 3',
+            'wait_seconds_sum 5.55',
+            'wait_seconds_count 3',
+        ]
+        assert histogram.quantile(0.5) == 1.0
+        assert counter.total() == 3
+
+    def test_updates_while_rendering(self):
+        registry = metrics.Registry()
+        counter = registry.counter('things_total', 'Things.', label='kind')
+        histogram = registry.histogram('wait_seconds', 'Waits.',
+                                       label='kind')
+
+        def update():
+            for number in range(20000):
+                # New labels grow the dicts while they are rendered.
+                counter.inc(label=str(number))
+                counter.inc(label='all')
+                histogram.observe(0.001, label=str(number % 1000))
+        threads = [threading.Thread(target=update) for _ in range(4)]
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            for thread in threads:
+                thread.start()
+            while any(thread.is_alive() for thread in threads):
+                registry.exposition()
+                registry.snapshot()
+        finally:
+            sys.setswitchinterval(interval)
+            for thread in threads:
+                thread.join()
+        assert counter.value('all') == 80000
+        assert counter.total() == 160000
+        assert sum(histogram.count(str(number))
+                   for number in range(1000)) == 80000
+
+
+class Test_instrumentation(object):
+    logger = logging.getLogger("")
+
+    def test_parse_counters(self):
+        metrics.REGISTRY.reset()
+        metrics.enable()
+        try:
+            it = message_iterator(self.logger)
+            it.send(None)
+            it.send(b"PING :a\r\n:bad\r\n" + b"x" * 600 + b"\r\n")
+        finally:
+            metrics.disable()
+        assert metrics.LINES_PARSED.total() == 1
+        assert metrics.PARSE_ERRORS.value('Malformed') == 1
+        assert metrics.PARSE_ERRORS.value('TooBig') == 1
+        metrics.REGISTRY.reset()
+
+    def test_disabled_records_nothing(self):
+        metrics.REGISTRY.reset()
+        it = message_iterator(self.logger)
+        it.send(None)
+        it.send(b"PING :a\r\n")
+        assert metrics.LINES_PARSED.total() == 0
+
+
+class Test_Aggregate(object):
+    def test_labels_by_network(self):
+        registry = metrics.Registry()
+        counter = registry.counter('things_total', 'Things.', label='kind')
+        histogram = registry.histogram('wait_seconds', 'Waits.',
+                                       buckets=(1.0,))
+        counter.inc(label='a')
+        histogram.observe(0.5)
+        aggregate = metrics.Aggregate(registry)
+        aggregate.update('one', registry.snapshot())
+        counter.inc(2, label='a')
+        aggregate.update('two', registry.snapshot())
+        # Snapshots are copies.
+        counter.inc(label='a')
+        assert aggregate.total('two', 'things_total') == 3
+        assert aggregate.exposition().splitlines() == [
+            '# HELP things_total Things.',
+            '# TYPE things_total counter',
+            'things_total{kind="a",network="one"} 1',
+            'things_total{kind="a",network="two"} 3',
+            '# HELP wait_seconds Waits.',
+            '# TYPE wait_seconds histogram',
+            'wait_seconds_bucket{network="one",le="1.0"} 1',
+            'wait_seconds_bucket{network="one",le="+Inf"} 1',
+            'wait_seconds_sum{network="one"} 0.5',
+            'wait_seconds_count{network="one"} 1',
+            'wait_seconds_bucket{network="two",le="1.0"} 1',
+            'wait_seconds_bucket{network="two",le="+Inf"} 1',
+            'wait_seconds_sum{network="two"} 0.5',
+            'wait_seconds_count{network="two"} 1',
+        ]
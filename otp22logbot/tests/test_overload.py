@@ -0,0 +1,105 @@
+import logging
+from otp22logbot.bot import Bot
+from otp22logbot.main import make_parser
+from otp22logbot.overload import FloodDetector, Overload
+from otp22logbot import metrics
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class Test_FloodDetector(object):
+    def test_over_limit_then_forgiven(self):
+        floods = FloodDetector(limit=5, window=10.0)
+        assert not any(floods.hit('a', 0.5 * i) for i in range(5))
+        assert floods.hit('a', 3.0)
+        assert not floods.hit('b', 3.0)
+        # Most of the last window still counts against a.
+        assert floods.hit('a', 12.0)
+        assert not floods.hit('a', 25.0)
+
+    def test_quiet_nicks_forgotten(self):
+        floods = FloodDetector(limit=5, window=1.0)
+        floods.hit('a', 0.0)
+        floods.hit('b', 1.5)
+        floods.hit('b', 2.5)
+        assert list(floods.nicks) == ['b']
+
+
+class Test_Overload(object):
+    def test_enters_and_leaves(self):
+        clock = Clock()
+        overload = Overload(interval=1.0, clock=clock)
+        clock.now += 0.5
+        assert not overload.busy(0.5)
+        clock.now += 0.5
+        assert overload.busy(0.45)
+        assert overload.active
+        clock.now += 1.0
+        assert not overload.busy(0.6)
+        assert overload.active
+        clock.now += 1.0
+        assert overload.busy(0.1)
+        assert not overload.active
+
+
+class Conn(object):
+    def __init__(self):
+        self.sent = []
+
+    def send(self, data):
+        self.sent.append(data)
+
+    def pong(self, server):
+        self.sent.append('PONG ' + server)
+
+    def privmsg_channel(self, channel, text):
+        self.sent.append(text)
+
+
+class Test_Bot_shedding(object):
+    logger = logging.getLogger("")
+
+    def make_bot(self, tmpdir, *options):
+        app_args = make_parser().parse_args(
+            ['-o', str(tmpdir.join('out.log')), '--command-workers', '0']
+            + list(options))
+        return Bot(app_args, self.logger)
+
+    def feed(self, bot, conn, data):
+        return bot.handle_batch(conn, bot.message_iterator().send(data))
+
+    def test_flooder_is_logged_but_shed(self, tmpdir):
+        metrics.REGISTRY.reset()
+        metrics.enable()
+        try:
+            bot = self.make_bot(tmpdir, '--user-flood-limit', '3')
+            conn = Conn()
+            self.feed(bot, conn, b":spam!b@c PRIVMSG #ircugm :.version\r\n"
+                      * 5 + b"PING :irc\r\n")
+            assert conn.sent[0] == 'PONG :irc'
+            assert len(conn.sent) == 4
+            assert metrics.SHED.value('command') == 2
+            assert metrics.SHED.value('user_update') == 2
+            assert metrics.FLOOD_MESSAGES.total() == 2
+            bot.writer.close()
+            assert len(tmpdir.join('out.log').readlines()) == 5
+        finally:
+            metrics.disable()
+            metrics.REGISTRY.reset()
+
+    def test_overloaded_sheds_user_updates(self, tmpdir):
+        bot = self.make_bot(tmpdir, '--overload-command-rate', '0')
+        bot.overload.active = True
+        conn = Conn()
+        self.feed(bot, conn, b":a!b@c PRIVMSG #ircugm :hi\r\n"
+                  b":a!b@c PRIVMSG #ircugm :.version\r\n")
+        assert conn.sent == []
+        assert bot.get_user('a') is None
+        assert bot.last_message.endswith("a (#ircugm): hi")
+        bot.writer.close()
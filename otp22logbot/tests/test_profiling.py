@@ -0,0 +1,63 @@
+import logging
+import tracemalloc
+from otp22logbot.profiling import Profiler
+
+
+def busy():
+    return sum(len(str(i)) for i in range(20000))
+
+
+class Test_Profiler(object):
+    logger = logging.getLogger("")
+
+    def run(self, tmpdir, mode):
+        profiler = Profiler(str(tmpdir), self.logger)
+        replies = []
+        profiler.request('start', mode, callback=replies.append)
+        profiler.poll()
+        assert profiler.running
+        for _ in range(20):
+            busy()
+        profiler.request('stop', callback=replies.append)
+        profiler.poll()
+        assert not profiler.running
+        assert replies[0] == 'profiling started ({0})'.format(mode)
+        assert replies[1].startswith('profiled ')
+        return dict((path.basename.split('.', 1)[1], path.read())
+                    for path in tmpdir.listdir()
+                    if not path.basename.endswith('.pstats'))
+
+    def test_cpu(self, tmpdir):
+        reports = self.run(tmpdir, 'cpu')
+        assert 'busy' in reports['cpu.txt']
+        assert 'allocation sites' in reports['alloc.txt']
+
+    def test_sample(self, tmpdir):
+        reports = self.run(tmpdir, 'sample')
+        assert 'samples every' in reports['cpu.txt']
+
+    def test_stop_when_idle(self, tmpdir):
+        assert Profiler(str(tmpdir), self.logger).stop() == 'not profiling'
+
+    def test_unwritable_directory(self, tmpdir):
+        # A file where the directory should be.
+        tmpdir.join('profiles').write('')
+        profiler = Profiler(str(tmpdir.join('profiles')), self.logger)
+        replies = []
+        profiler.request('start', 'cpu', callback=replies.append)
+        profiler.request('stop', callback=replies.append)
+        profiler.poll()
+        assert not profiler.running
+        assert replies[1].startswith('profiling stopped, but the reports '
+                                     'could not be written: ')
+        assert not tracemalloc.is_tracing()
+
+    def test_leaves_tracemalloc_it_did_not_start(self, tmpdir):
+        tracemalloc.start()
+        try:
+            profiler = Profiler(str(tmpdir), self.logger)
+            profiler.start('cpu')
+            profiler.stop()
+            assert tracemalloc.is_tracing()
+        finally:
+            tracemalloc.stop()
@@ -1,5 +1,9 @@
 import logging
-from otp22logbot.protocol import parse_message, parse_messages, parse_privmsg
+import pytest
+from otp22logbot import protocol
+from otp22logbot.protocol import (
+    TAGS_LIMIT, LineFramer, Message, message_iterator, parse_message,
+    parse_messages, parse_privmsg)
 
 
 class Test_parse_message(object):
@@ -99,3 +103,138 @@ class Test_parse_privmsg(object):
         data = b"otp22logbot :little bunny foo foo"
         result = parse_privmsg(data)
         assert result == ([b"otp22logbot"], b"little bunny foo foo")
+
+
+class Test_LineFramer(object):
+    logger = logging.getLogger("")
+
+    def feed(self, framer, data):
+        return [bytes(line) for line in framer.feed(data)]
+
+    def test_whole_lines(self):
+        framer = LineFramer(self.logger)
+        data = b"PING :a\r\nPING :b\r\n"
+        assert self.feed(framer, data) == [b"PING :a\r\n", b"PING :b\r\n"]
+        assert framer.unconsumed == b""
+
+    def test_fragments(self):
+        framer = LineFramer(self.logger)
+        assert self.feed(framer, b"PING :a\r") == []
+        assert self.feed(framer, b"\nPI") == [b"PING :a\r\n"]
+        assert self.feed(framer, b"NG :b") == []
+        assert framer.unconsumed == b"PING :b"
+        assert self.feed(framer, b"\r\n") == [b"PING :b\r\n"]
+
+    def test_bare_newline_stays_in_line(self):
+        framer = LineFramer(self.logger)
+        data = b"crap\nPING :a\r\n"
+        assert self.feed(framer, data) == [data]
+
+    def test_too_big_is_dropped(self):
+        framer = LineFramer(self.logger)
+        data = b"x" * 600 + b"\r\nPING :a\r\n"
+        assert self.feed(framer, data) == [b"PING :a\r\n"]
+
+    def test_too_big_without_terminator_is_not_buffered(self):
+        framer = LineFramer(self.logger)
+        for _ in range(10):
+            assert self.feed(framer, b"x" * 300) == []
+        assert len(framer.buffer) < 1024
+        assert self.feed(framer, b"\r\nPING :a\r\n") == [b"PING :a\r\n"]
+
+    def test_lines_are_bytes(self):
+        framer = LineFramer(self.logger)
+        data = b"PING :a\r\n"
+        line, = framer.feed(data)
+        framer.feed(memoryview(b"PING :b\r\nPI"))
+        assert line is data
+        assert framer.feed(memoryview(b"NG :c\r\n")) == [b"PING :c\r\n"]
+
+
+class Test_message_iterator(object):
+    logger = logging.getLogger("")
+
+    def test_byte_at_a_time(self):
+        data = b"".join([
+            b":Guest80053!~default@cpe-70-112-152-59.austin.res.rr.com QUIT :Quit: leaving\r\n",
+            b"x" * 600 + b"\r\n",
+            b":default!~default@cpe-70-112-152-59.austin.res.rr.com JOIN #ircugm\r\n",
+        ])
+        it = message_iterator(self.logger)
+        it.send(None)
+        messages = []
+        for i in range(len(data)):
+            messages.extend(it.send(data[i:i + 1]))
+        assert messages == [
+            (b"Guest80053!~default@cpe-70-112-152-59.austin.res.rr.com", b"QUIT", b":Quit: leaving"),
+            (b"default!~default@cpe-70-112-152-59.austin.res.rr.com", b"JOIN", b"#ircugm")
+        ]
+
+
+class Test_Message(object):
+    logger = logging.getLogger("")
+
+    def test_unpacks_like_tuple(self):
+        data = b":L0j1k!~default@unaffiliated/l0j1k PRIVMSG #ircugm :hello\r\n"
+        prefix, command, params = Message.parse(data)
+        assert (prefix, command, params) == parse_message(data)
+
+    def test_tags(self):
+        data = (b"@time=2013-03-07T18:02:11.123Z;account=l0j1k;msgid=a\\sb\\:c;x "
+                b":L0j1k!~default@unaffiliated/l0j1k PRIVMSG #ircugm :hello\r\n")
+        message = Message.parse(data)
+        assert message.command == b"PRIVMSG"
+        assert message.tags == {
+            'time': '2013-03-07T18:02:11.123Z', 'account': 'l0j1k',
+            'msgid': 'a b;c', 'x': ''}
+        assert message.time == pytest.approx(1362679331.123)
+        assert message.nick == "L0j1k"
+        assert message.targets == ["#ircugm"]
+        assert message.text == "hello"
+
+    def test_no_tags(self):
+        message = Message.parse(b"PING :irc.example.net\r\n")
+        assert message.tags == {}
+        assert message.time is None
+        assert message.prefix == b""
+
+    def test_decodes_once(self, monkeypatch):
+        calls = []
+        real = protocol.decode
+
+        def counting(data, encodings):
+            calls.append(data)
+            return real(data, encodings)
+        monkeypatch.setattr(protocol, "decode", counting)
+        message = Message.parse(
+            b":L0j1k!~default@unaffiliated/l0j1k PRIVMSG #ircugm :hello\r\n")
+        assert calls == []
+        for i in range(3):
+            message.nick, message.targets, message.text
+        assert len(calls) == 3
+
+    def test_encoding_fallback(self):
+        data = b":nick!u@h PRIVMSG #ircugm :caf\xe9 \xe2\x82\xac\r\n"
+        assert Message.parse(data).text == "caf\xe9 \xe2\x82\xac"
+        data = b":nick!u@h PRIVMSG #ircugm :caf\xc3\xa9\r\n"
+        assert Message.parse(data).text == "caf\xe9"
+        message = Message.parse(data, encodings=("ascii", "latin-1"))
+        assert message.text == "caf\xc3\xa9"
+
+    def test_long_tags_allowed(self):
+        tags = b"@" + b";".join(
+            b"k" + str(i).encode() + b"=" + b"v" * 40 for i in range(40))
+        line = b":nick!u@h PRIVMSG #ircugm :" + b"x" * 400 + b"\r\n"
+        data = tags + b" " + line
+        assert len(data) > 512
+        it = message_iterator(self.logger, parse=Message.parse,
+                              limit=512 + TAGS_LIMIT + 1)
+        it.send(None)
+        message, = it.send(data)
+        assert len(message.tags) == 40
+        assert message.text == "x" * 400
+
+    def test_long_line_after_tags_refused(self):
+        data = b"@a=b :nick!u@h PRIVMSG #ircugm :" + b"x" * 600 + b"\r\n"
+        with pytest.raises(protocol.TooBig):
+            Message.parse(data)
@@ -0,0 +1,232 @@
+"""Randomized tests of framing and parsing.
+
+Streams are made of valid and broken IRC lines and cut into chunks at
+random byte boundaries; however they are cut, what comes out must be
+the same. Each test runs a fixed set of seeds, so a failure always
+reproduces: the seed is in the assertion message.
+"""
+import logging
+import random
+import time
+from otp22logbot import protocol
+
+SEEDS = range(200)
+logger = logging.getLogger("fuzz")
+logger.disabled = True
+
+
+def word(rng, alphabet=b'abcdefghijklmnopqrstuvwxyz0123456789'):
+    return bytes(rng.choice(alphabet) for _ in range(rng.randint(1, 12)))
+
+
+def valid_line(rng):
+    roll = rng.random()
+    prefix = b':' + word(rng) + b'!~' + word(rng) + b'@' + word(rng)
+    if roll < 0.5:
+        text = b' '.join(word(rng) for _ in range(rng.randint(0, 30)))
+        line = prefix + b' PRIVMSG #' + word(rng) + b' :' + text
+    elif roll < 0.6:
+        line = b'PING :' + word(rng)
+    elif roll < 0.7:
+        line = (b'@time=2014-01-01T00:00:00.000Z;id=' + word(rng) + b' ' +
+                prefix + b' PRIVMSG #a :' + word(rng))
+    elif roll < 0.8:
+        line = prefix + b' JOIN #' + word(rng)
+    else:
+        line = (b':irc.example.net 353 bot = #a :' +
+                b' '.join(word(rng) for _ in range(rng.randint(1, 40))))
+    return line + b'\r\n'
+
+
+def broken_line(rng):
+    roll = rng.random()
+    if roll < 0.2:
+        # Too long, with or without a prefix.
+        return (b':a!b@c PRIVMSG #a :' + b'x' * rng.randint(500, 1500) +
+                b'\r\n')
+    if roll < 0.4:
+        # Arbitrary bytes, CR and LF included.
+        return bytes(rng.randint(0, 255)
+                     for _ in range(rng.randint(0, 80))) + b'\r\n'
+    if roll < 0.5:
+        return b'\r\n'
+    if roll < 0.6:
+        return b':nospace\r\n'
+    if roll < 0.7:
+        # Bare CR or LF inside the line.
+        return b'PRIVMSG #a :one\rtwo\nthree\r\n'
+    if roll < 0.8:
+        return b'@' + b'k' * rng.randint(8000, 9000) + b' PING :a\r\n'
+    return b'\r' * rng.randint(1, 3) + b'\n' * rng.randint(1, 3)
+
+
+def make_stream(rng, broken=True):
+    lines = []
+    for _ in range(rng.randint(0, 60)):
+        if broken and rng.random() < 0.25:
+            lines.append(broken_line(rng))
+        else:
+            lines.append(valid_line(rng))
+    if rng.random() < 0.5:
+        # A partial line at the end.
+        lines.append(valid_line(rng)[:rng.randint(0, 20)])
+    return b''.join(lines)
+
+
+def cut(rng, data):
+    """data in chunks of random sizes, including empty and single bytes.
+    """
+    chunks = []
+    position = 0
+    while position < len(data):
+        roll = rng.random()
+        if roll < 0.1:
+            size = 0
+        elif roll < 0.4:
+            size = 1
+        else:
+            size = rng.randint(2, 2048)
+        chunks.append(data[position:position + size])
+        position += size
+    return chunks
+
+
+def frame(chunks, limit=512):
+    framer = protocol.LineFramer(logger, limit=limit)
+    lines = []
+    for chunk in chunks:
+        lines.extend(bytes(line) for line in framer.feed(chunk))
+    return lines
+
+
+def reference_lines(data, limit=512):
+    """What framing should give: every CR LF terminated line that fits.
+    """
+    lines = []
+    start = 0
+    end = data.find(b'\r\n')
+    while end != -1:
+        line = data[start:end + 2]
+        if len(line) <= limit:
+            lines.append(line)
+        start = end + 2
+        end = data.find(b'\r\n', start)
+    return lines
+
+
+def iterate(chunks, **kwargs):
+    it = protocol.message_iterator(logger, **kwargs)
+    it.send(None)
+    messages = []
+    for chunk in chunks:
+        messages.extend(tuple(message) for message in it.send(chunk)
+                        if message is not None)
+    return messages
+
+
+class Test_framing_fuzz(object):
+    def test_chunking_never_changes_lines(self):
+        for seed in SEEDS:
+            rng = random.Random(seed)
+            data = make_stream(rng)
+            expected = reference_lines(data)
+            assert frame([data]) == expected, seed
+            assert frame(cut(rng, data)) == expected, seed
+
+    def test_byte_at_a_time(self):
+        for seed in range(20):
+            rng = random.Random(seed)
+            data = make_stream(rng)
+            chunks = [data[i:i + 1] for i in range(len(data))]
+            assert frame(chunks) == reference_lines(data), seed
+
+    def test_unterminated_flood_is_not_buffered(self):
+        framer = protocol.LineFramer(logger)
+        rng = random.Random(1)
+        for _ in range(2000):
+            framer.feed(b'x' * rng.randint(1, 300))
+            assert len(framer.buffer) <= 512 + 300
+        assert [bytes(line) for line in framer.feed(b'\r\nPING :a\r\n')] \
+            == [b'PING :a\r\n']
+
+
+class Test_message_iterator_fuzz(object):
+    def test_chunking_never_changes_messages(self):
+        for seed in SEEDS:
+            rng = random.Random(seed)
+            data = make_stream(rng)
+            whole = iterate([data])
+            assert iterate(cut(rng, data)) == whole, seed
+            tagged = iterate(
+                [data], parse=protocol.Message.parse,
+                limit=512 + protocol.TAGS_LIMIT + 1)
+            assert iterate(
+                cut(rng, data), parse=protocol.Message.parse,
+                limit=512 + protocol.TAGS_LIMIT + 1) == tagged, seed
+
+    def test_agrees_with_parse_messages(self):
+        for seed in SEEDS:
+            rng = random.Random(seed)
+            # parse_messages doesn't know about tags.
+            data = make_stream(rng, broken=False).replace(
+                b'@time=', b'PING :time=')
+            messages, unconsumed = protocol.parse_messages(data, logger)
+            assert iterate(cut(rng, data)) == messages, seed
+            assert data.endswith(unconsumed), seed
+
+
+class Test_parse_fuzz(object):
+    def test_garbage_only_raises_parse_errors(self):
+        rng = random.Random(22)
+        for _ in range(5000):
+            line = bytes(rng.randint(0, 255)
+                         for _ in range(rng.randint(0, 600)))
+            if rng.random() < 0.5:
+                line += b'\r\n'
+            try:
+                parsed = protocol.parse_message(line)
+            except protocol.ParseError:
+                continue
+            if parsed is not None:
+                prefix, command, params = parsed
+                assert b' ' not in prefix and b' ' not in command
+
+    def test_privmsg_round_trip(self):
+        rng = random.Random(22)
+        for _ in range(2000):
+            targets = [b'#' + word(rng) for _ in range(rng.randint(1, 4))]
+            text = b' '.join(word(rng, b'ab: ') for _ in range(
+                rng.randint(1, 10)))
+            params = b','.join(targets) + b' :' + text
+            assert protocol.parse_privmsg(params) == (targets, text)
+
+
+class Test_linear_time(object):
+    """Work must grow with the input, not with its square.
+
+    Sixteen times the input should take about sixteen times as long;
+    quadratic behaviour would take 256 times. Best of three runs, with
+    plenty of room for a busy machine.
+    """
+    def best(self, function, *args):
+        times = []
+        for _ in range(3):
+            start = time.perf_counter()
+            function(*args)
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    def ratio(self, make):
+        small = self.best(frame, make(2000))
+        large = self.best(frame, make(32000))
+        return large / small
+
+    def test_small_chunks(self):
+        rng = random.Random(3)
+        data = b''.join(valid_line(rng) for _ in range(5000))
+        assert self.ratio(
+            lambda size: [data[i:i + 7] for i in range(0, size * 7, 7)]
+        ) < 64
+
+    def test_long_unterminated_lines(self):
+        assert self.ratio(lambda size: [b'x' * 100] * size) < 64
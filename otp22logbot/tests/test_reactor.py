@@ -0,0 +1,41 @@
+import socket
+from otp22logbot.reactor import Reactor
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class Test_Reactor(object):
+    def test_timers_run_in_order_unless_cancelled(self):
+        clock = Clock()
+        reactor = Reactor(clock=clock)
+        ran = []
+        reactor.call_later(2, lambda: ran.append('b'))
+        reactor.call_later(1, lambda: ran.append('a'))
+        reactor.call_later(1.5, lambda: ran.append('x')).cancel()
+        assert reactor.timeout() == 1
+        clock.now += 5
+        reactor.run_once()
+        assert ran == ['a', 'b']
+        assert reactor.timeout() is None
+        reactor.close()
+
+    def test_readable_socket_calls_back(self):
+        ours, theirs = socket.socketpair()
+        reactor = Reactor()
+        seen = []
+        reactor.register(ours, lambda: seen.append(ours.recv(10)))
+        reactor.run_once(limit=0)
+        assert seen == []
+        theirs.sendall(b"hi")
+        reactor.run_once(limit=5)
+        assert seen == [b"hi"]
+        reactor.unregister(ours)
+        reactor.close()
+        ours.close()
+        theirs.close()
@@ -0,0 +1,134 @@
+import collections
+import datetime
+import gzip
+import io
+import json
+import logging
+import sqlite3
+import pytest
+from otp22logbot import reindex, segment
+from otp22logbot.reindex import (
+    Reindexer, main, place, split_ranges)
+from otp22logbot.state import StateStore
+from otp22logbot.user import UserRegistry
+
+DATE = datetime.date(2013, 3, 1)
+
+
+def make_log(count, start, nicks=("alice", "bob", "carol")):
+    lines = []
+    offset = start
+    for i in range(count):
+        offset = (offset + 997) % 86400
+        stamp = "{0:02d}:{1:02d}:{2:02d}".format(
+            offset // 3600, offset // 60 % 60, offset % 60)
+        if i % 40 == 0:
+            lines.append("connection closed")
+        lines.append("<{0}> {1} (#ircugm): message {2}".format(
+            stamp, nicks[i % len(nicks)], i))
+    return "\n".join(lines) + "\n"
+
+
+def write_logs(tmpdir):
+    rotated = tmpdir.join("otp22logbot.log.20130301-000000.gz")
+    with gzip.open(str(rotated), "wt") as log:
+        log.write(make_log(300, 0))
+    second = tmpdir.join("otp22logbot.log.20130305-000000")
+    second.write(make_log(400, 50000, nicks=("bob", "dave")))
+    current = tmpdir.join("otp22logbot.log")
+    current.write(make_log(200, 3000))
+    texts = [make_log(300, 0), make_log(400, 50000, nicks=("bob", "dave")),
+             make_log(200, 3000)]
+    return [str(current), str(second), str(rotated)], "".join(texts)
+
+
+def sequential(text):
+    return [record for record in segment.parse_text(
+        io.StringIO(text), DATE) if record[1]]
+
+
+class Test_reindex(object):
+    logger = logging.getLogger("")
+
+    def test_split_ranges(self, tmpdir):
+        log = tmpdir.join("log")
+        log.write(make_log(100, 0))
+        data = log.read_binary()
+        ranges = split_ranges(str(log), 500)
+        assert len(ranges) > 1
+        assert ranges[0][0] == 0 and ranges[-1][1] == len(data)
+        for (start, end), (next_start, _) in zip(ranges, ranges[1:]):
+            assert end == next_start
+            assert data[end - 1:end] == b"\n"
+
+    @pytest.mark.parametrize("jobs", [0, 2])
+    def test_matches_sequential(self, tmpdir, jobs):
+        paths, text = write_logs(tmpdir)
+        reindexer = Reindexer(str(tmpdir.join("work")), self.logger,
+                              range_size=700, jobs=jobs)
+        summaries = reindexer.run(paths)
+        assert len(summaries) > 3
+        shifts = place(summaries, DATE)
+        assert list(reindexer.records(summaries, shifts)) == sequential(text)
+
+    def test_resume(self, tmpdir, monkeypatch):
+        paths, text = write_logs(tmpdir)
+        work = str(tmpdir.join("work"))
+        first = Reindexer(work, self.logger, range_size=700, jobs=0)
+        keys = first.tasks(paths)
+        real = reindex.parse_range
+        calls = []
+
+        def interrupted(key, part):
+            if len(calls) == 5:
+                raise KeyboardInterrupt()
+            calls.append(key)
+            return real(key, part)
+        monkeypatch.setattr(reindex, "parse_range", interrupted)
+        with pytest.raises(KeyboardInterrupt):
+            first.run(paths)
+        # A torn manifest line is ignored
+        with open(first.manifest_path, "a") as manifest:
+            manifest.write('{"key": ')
+        calls[:] = []
+        monkeypatch.setattr(reindex, "parse_range",
+                            lambda key, part: calls.append(key) or
+                            real(key, part))
+        second = Reindexer(work, self.logger, range_size=700, jobs=0)
+        summaries = second.run(paths)
+        assert calls == keys[5:]
+        assert len(second.load_manifest()) == len(keys)
+        shifts = place(summaries, DATE)
+        assert list(second.records(summaries, shifts)) == sequential(text)
+
+    def test_main(self, tmpdir):
+        paths, text = write_logs(tmpdir)
+        records = sequential(text)
+        archive = str(tmpdir.join("archive.db"))
+        state = str(tmpdir.join("state"))
+        counts = str(tmpdir.join("counts.json"))
+        work = str(tmpdir.join("work"))
+        assert main(["--date", "2013-03-01", "--archive", archive,
+                     "--state-dir", state, "--counts", counts,
+                     "--work-dir", work, "--range-size", "1000",
+                     "--jobs", "2"] + paths) == 0
+        assert not tmpdir.join("work").check()
+        db = sqlite3.connect(archive)
+        rows = db.execute("SELECT time, nick, targets, text FROM messages "
+                          "ORDER BY id").fetchall()
+        assert rows == [(when, nick, ",".join(targets), text)
+                        for when, nick, targets, text in records]
+        with open(counts) as data:
+            assert json.load(data) == collections.Counter(
+                nick for _, nick, _, _ in records)
+        registry = UserRegistry()
+        last = StateStore(state, self.logger).load(registry)
+        assert last == segment.format_record(*records[-1])
+        bob = registry.get("bob")
+        assert bob.time == max(when for when, nick, _, _ in records
+                               if nick == "bob")
+        assert bob.channels == ("#ircugm",)
+        # Most recently active last, as the bot keeps them
+        assert [user.nick for user in registry][-1] == records[-1][1]
+        assert main(["--date", "2013-03-01", "--state-dir", state,
+                     "--work-dir", work] + paths) == 1
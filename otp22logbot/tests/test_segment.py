@@ -0,0 +1,109 @@
+import datetime
+import io
+import pytest
+from otp22logbot.segment import (
+    MAGIC, FormatError, SegmentWriter, format_record, main, parse_text,
+    read_segment, read_varint, repair)
+
+
+RECORDS = [
+    (1000.5, 'alice', ['#a'], 'hello'),
+    (999.25, 'bob', ['#a', '#b'], 'caf\xe9 ☃'),
+    (1000000.0, 'alice', ['otp22logbot'], '.help'),
+    (1000000.0, '', [], 'connection closed'),
+]
+
+
+def encode(records, block_size=65536):
+    out = io.BytesIO()
+    writer = SegmentWriter(out.write, block_size=block_size)
+    for record in records:
+        writer.append(*record)
+    writer.close()
+    return out.getvalue()
+
+
+class Test_segment(object):
+    def test_round_trip(self):
+        assert list(read_segment(encode(RECORDS))) == RECORDS
+
+    def test_small_blocks(self):
+        assert list(read_segment(encode(RECORDS, block_size=1))) == RECORDS
+
+    def test_concatenated(self):
+        data = encode(RECORDS[:2]) + encode(RECORDS[2:])
+        assert list(read_segment(data)) == RECORDS
+
+    def test_truncated(self):
+        data = encode(RECORDS[:2]) + encode(RECORDS[2:])
+        assert list(read_segment(data[:-3])) == RECORDS[:2]
+        assert list(read_segment(data[:len(MAGIC) + 10])) == []
+
+    def test_truncated_mid_block(self, tmpdir):
+        path = tmpdir.join('out.seg')
+        path.write_binary(encode(RECORDS[:2]) + encode(RECORDS[2:])[:-3])
+        assert list(read_segment(path.read_binary())) == RECORDS[:2]
+        # After a restart, the bot repairs the file and appends a new
+        # segment to it.
+        assert repair(str(path)) == \
+            len(encode(RECORDS[2:])) - len(MAGIC) - 3
+        assert repair(str(path)) == 0
+        with open(str(path), 'ab') as out:
+            out.write(encode(RECORDS[1:2]))
+        assert list(read_segment(path.read_binary())) == \
+            RECORDS[:2] + RECORDS[1:2]
+
+    def test_corrupt_block(self):
+        data = bytearray(encode(RECORDS))
+        data[len(MAGIC) + 8] = 0xff
+        with pytest.raises(FormatError):
+            list(read_segment(bytes(data)))
+
+    def test_truncated_varint(self):
+        with pytest.raises(FormatError):
+            read_varint(b'\x80\x80', 0)
+
+    def test_flush_after_max_delay(self):
+        out = io.BytesIO()
+        clock = [0.0]
+        writer = SegmentWriter(out.write, max_delay=1.0,
+                               clock=lambda: clock[0])
+        writer.append(*RECORDS[0])
+        writer.flush_due()
+        assert out.getvalue() == MAGIC
+        clock[0] = 1.0
+        writer.flush_due()
+        assert list(read_segment(out.getvalue())) == RECORDS[:1]
+        writer.append(*RECORDS[1])
+        clock[0] = 2.5
+        writer.append(*RECORDS[2])
+        assert list(read_segment(out.getvalue())) == RECORDS[:3]
+
+    def test_not_a_segment(self):
+        with pytest.raises(FormatError):
+            list(read_segment(b"<00:00:00> a (#a): b\n"))
+
+
+class Test_text(object):
+    def test_parse_rolls_over_midnight(self):
+        lines = ["<23:59:59> alice (#a,#b): late\n",
+                 "connection closed\n",
+                 "<00:00:01> bob (#a): early: yes\n"]
+        records = list(parse_text(lines, datetime.date(1970, 1, 2)))
+        assert records == [
+            (86400 + 86399, 'alice', ['#a', '#b'], 'late'),
+            (86400 + 86399, '', [], 'connection closed'),
+            (2 * 86400 + 1, 'bob', ['#a'], 'early: yes'),
+        ]
+        assert [format_record(*record) + "\n"
+                for record in records] == lines
+
+    def test_cli_round_trip(self, tmpdir):
+        log = tmpdir.join('in.log')
+        log.write("<12:00:00> alice (#a): hi\nshutdown at 12:00:01\n")
+        segment = str(tmpdir.join('out.seg'))
+        text = str(tmpdir.join('out.log'))
+        assert main(['from-text', str(log), '-o', segment,
+                     '--date', '2014-01-01']) == 0
+        assert main(['to-text', segment, '-o', text]) == 0
+        assert tmpdir.join('out.log').read() == log.read()
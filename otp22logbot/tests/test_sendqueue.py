@@ -0,0 +1,92 @@
+import logging
+import threading
+from otp22logbot import metrics
+from otp22logbot.sendqueue import (
+    SendQueue, TokenBucket, NORMAL, REPLY, URGENT)
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class Test_TokenBucket(object):
+    def test_burst_then_rate(self):
+        clock = Clock()
+        bucket = TokenBucket(rate=2, burst=3, clock=clock)
+        assert [bucket.take() for _ in range(3)] == [0, 0, 0]
+        assert bucket.take() == 0.5
+        clock.now = 0.5
+        assert bucket.take() == 0
+        clock.now = 100
+        assert [bucket.take() for _ in range(3)] == [0, 0, 0]
+        assert bucket.take() > 0
+
+
+class Test_SendQueue(object):
+    logger = logging.getLogger("")
+
+    def test_priority_and_coalescing(self):
+        writes = []
+        entered = threading.Event()
+        gate = threading.Event()
+
+        def write(data):
+            entered.set()
+            gate.wait()
+            writes.append(data)
+
+        queue = SendQueue(write, self.logger, rate=1000, burst=100)
+        # The first write holds the sender so the rest pile up.
+        queue.put(b"NICK a\r\n", NORMAL)
+        entered.wait()
+        queue.put(b"PRIVMSG #a :x\r\n", REPLY)
+        queue.put(b"JOIN #a\r\n", NORMAL)
+        queue.put(b"PONG :s\r\n", URGENT)
+        gate.set()
+        queue.close()
+        assert writes[0] == b"NICK a\r\n"
+        assert writes[1] == b"PONG :s\r\nJOIN #a\r\nPRIVMSG #a :x\r\n"
+        assert queue.stats.lines == 4
+
+    def test_metrics(self):
+        writes = []
+        entered = threading.Event()
+        gate = threading.Event()
+
+        def write(data):
+            entered.set()
+            gate.wait()
+            writes.append(data)
+
+        metrics.REGISTRY.reset()
+        metrics.enable()
+        try:
+            queue = SendQueue(write, self.logger, rate=1000, burst=100)
+            queue.put(b"NICK a\r\n")
+            entered.wait()
+            queue.put(b"JOIN #a\r\n")
+            queue.put(b"JOIN #b\r\n")
+            assert metrics.SEND_QUEUE_DEPTH.value() == 2
+            gate.set()
+            queue.close()
+        finally:
+            metrics.disable()
+        assert metrics.SEND_QUEUE_DEPTH.value() == 0
+        assert metrics.SEND_QUEUE_WAIT_SECONDS.count() == 3
+        assert 'otp22logbot_send_queue_depth 0' in \
+            metrics.REGISTRY.exposition()
+        metrics.REGISTRY.reset()
+
+    def test_close_gives_up_after_timeout(self):
+        writes = []
+        queue = SendQueue(writes.append, self.logger, rate=0.001, burst=1)
+        queue.put(b"a\r\n")
+        queue.put(b"b\r\n")
+        queue.put(b"QUIT\r\n", URGENT)
+        queue.close(timeout=0.1)
+        assert b"".join(writes) in (b"a\r\nQUIT\r\n", b"QUIT\r\na\r\n")
+        assert queue.stats.dropped == 1
@@ -0,0 +1,62 @@
+import logging
+import os
+from otp22logbot.state import StateStore
+from otp22logbot.user import UserRegistry
+
+
+class Test_StateStore(object):
+    logger = logging.getLogger("")
+
+    def run(self, directory, nicks, compact_every=1000):
+        users = UserRegistry()
+        store = StateStore(directory, self.logger,
+                           compact_every=compact_every)
+        last = store.load(users)
+        store.start()
+        for i, nick in enumerate(nicks):
+            user = users.touch(nick)
+            user.update(channels=['#a'], message=nick + ' says', now=i + 1.0)
+            store.record(user)
+            store.record_last(user.message)
+            last = user.message
+            store.maybe_compact(users, last)
+        return users, store, last
+
+    def reload(self, directory):
+        users = UserRegistry()
+        last = StateStore(directory, self.logger).load(users)
+        return users, last
+
+    def test_journal_only(self, tmpdir):
+        directory = str(tmpdir)
+        users, store, last = self.run(directory, ['a', 'b', 'a'])
+        # Simulate a crash: flush the journal, take no final snapshot.
+        store.writer.close()
+        assert not os.path.exists(store.snapshot_path)
+        loaded, loaded_last = self.reload(directory)
+        assert [user.nick for user in loaded] == ['b', 'a']
+        assert loaded.get('a').message == 'a says'
+        assert loaded.get('a').time == 3.0
+        assert loaded_last == 'a says'
+
+    def test_compaction_and_close(self, tmpdir):
+        directory = str(tmpdir)
+        nicks = [str(i % 50) for i in range(500)]
+        users, store, last = self.run(directory, nicks, compact_every=100)
+        store.close(users, last)
+        assert store.journal_seqs() == [store.seq]
+        loaded, loaded_last = self.reload(directory)
+        assert [user.nick for user in loaded] == [
+            user.nick for user in users]
+        assert loaded.get('7').seen == users.get('7').seen
+        assert loaded.get('7').channels == ('#a',)
+        assert loaded_last == last
+
+    def test_torn_journal_line(self, tmpdir):
+        directory = str(tmpdir)
+        users, store, last = self.run(directory, ['a'])
+        store.writer.close()
+        with open(os.path.join(directory, 'journal.0'), 'a') as journal:
+            journal.write('["b", [], "hal')
+        loaded, _ = self.reload(directory)
+        assert [user.nick for user in loaded] == ['a']
@@ -0,0 +1,66 @@
+import gzip
+import json
+import pytest
+from otp22logbot import stats
+from otp22logbot.stats import analyze, log_order, main
+
+
+LOG = "\n".join([
+    "<23:59:58> alice (#ircugm): late",
+    "connection closed",
+    "<00:00:01> bob (#ircugm,otp22logbot): early",
+    "<00:10:00> bob (otp22logbot): .help",
+    "<00:10:00>  (#ircugm): no nick",
+    "<00:11:00> caf\xe9 (#ircugm): bonjour",
+    "<99:11:00> bob (#ircugm): not a time",
+    "<01:00:00> nospace",
+    "<01:30:00> " + "n" * 40 + " (#ircugm): long nick",
+]) + "\n"
+
+
+def write_logs(tmpdir):
+    rotated = tmpdir.join("otp22logbot.log.20240101-000000.gz")
+    with gzip.open(str(rotated), "wt", encoding="utf-8") as log:
+        log.write(LOG)
+    current = tmpdir.join("otp22logbot.log")
+    current.write_text(LOG, encoding="utf-8")
+    return [str(current), str(rotated)]
+
+
+def check(report):
+    assert report.messages == 10
+    assert report.hours[0] == 6 and report.hours[23] == 2
+    assert report.hours[1] == 2
+    assert sum(report.nicks[b"bob"]) == 4
+    assert "caf\xe9".encode("utf-8") in report.nicks
+    assert ("n" * stats.NICK_WIDTH).encode() in report.nicks
+    # Midnight, then midnight again after the second log starts
+    assert report.days == {0: 1, 1: 5, 2: 4}
+
+
+class Test_stats(object):
+    @pytest.mark.parametrize("chunk_size", [7, 100, 1 << 20])
+    def test_python(self, tmpdir, chunk_size):
+        check(analyze(write_logs(tmpdir), chunk_size, vectorized=False))
+
+    @pytest.mark.parametrize("chunk_size", [7, 100, 1 << 20])
+    def test_numpy(self, tmpdir, chunk_size):
+        pytest.importorskip("numpy")
+        check(analyze(write_logs(tmpdir), chunk_size, vectorized=True))
+
+    def test_log_order(self):
+        paths = ["a.log", "a.log.20240102-000000",
+                 "a.log.20240101-000000.1.gz", "a.log.20240101-000000.gz"]
+        assert sorted(paths, key=log_order) == [
+            "a.log.20240101-000000.gz", "a.log.20240101-000000.1.gz",
+            "a.log.20240102-000000", "a.log"]
+
+    def test_main_json(self, tmpdir, capsys):
+        paths = write_logs(tmpdir)
+        assert main(["--json", "--no-numpy", "--top", "1", "--user", "bob",
+                     "--date", "2024-01-01"] + paths) == 0
+        result = json.loads(capsys.readouterr()[0])
+        assert result["top_talkers"] == [
+            {"nick": "bob", "messages": 4, "busiest_hour": 0}]
+        assert result["busiest_days"] == [["2024-01-02", 5]]
+        assert result["user"]["hours"][0] == 4
@@ -0,0 +1,39 @@
+import argparse
+import logging
+import multiprocessing
+import os
+from otp22logbot import metrics
+from otp22logbot.supervisor import Supervisor
+
+
+def crash_twice(name, app_args, reports, interval):
+    """Stand-in worker: crashes on its first two runs, then reports."""
+    runs = os.path.join(app_args.directory, name)
+    with open(runs, 'a') as out:
+        out.write('x')
+    with open(runs) as data:
+        count = len(data.read())
+    if count <= 2:
+        os._exit(3)
+    snapshot = metrics.Registry().snapshot()
+    snapshot[metrics.LINES_PARSED.name] = {None: count * 10}
+    reports.put((name, snapshot))
+
+
+class Test_Supervisor(object):
+    logger = logging.getLogger("")
+
+    def test_restarts_crashed_workers(self, tmpdir):
+        app_args = argparse.Namespace(directory=str(tmpdir))
+        supervisor = Supervisor(
+            [('one', app_args), ('two', app_args)], self.logger,
+            target=crash_twice, restart_delay=0.01,
+            context=multiprocessing.get_context('fork'))
+        supervisor.run(poll=0.01)
+        for worker in supervisor.workers:
+            assert worker.done
+            assert worker.restarts == 2
+            assert worker.exitcode == 0
+        assert supervisor.aggregate.total(
+            'two', metrics.LINES_PARSED.name) == 30
+        assert 'network="one"' in supervisor.aggregate.exposition()
@@ -0,0 +1,40 @@
+from otp22logbot.user import User, UserRegistry
+
+
+class Test_User(object):
+    def test_update(self):
+        user = User("alice")
+        user.update(channels=["#a"], message="hi", now=1.0)
+        user.update(channels=["#a", "#b"], now=2.0)
+        assert user.channels == ("#a", "#b")
+        assert user.message == "hi"
+        assert (user.time, user.seen) == (1.0, 2.0)
+
+    def test_slotted(self):
+        assert not hasattr(User("alice"), '__dict__')
+
+
+class Test_UserRegistry(object):
+    def test_evicts_least_recently_active(self):
+        users = UserRegistry(max_size=2)
+        users.touch("a")
+        users.touch("b")
+        users.touch("a")
+        users.touch("c")
+        assert "b" not in users
+        assert sorted(user.nick for user in users) == ["a", "c"]
+        assert users.evicted == 1
+
+    def test_get_is_not_activity(self):
+        users = UserRegistry(max_size=2)
+        users.touch("a")
+        users.touch("b")
+        users.get("a")
+        users.touch("c")
+        assert "a" not in users
+
+    def test_unbounded(self):
+        users = UserRegistry()
+        for i in range(100):
+            users.touch(str(i))
+        assert len(users) == 100
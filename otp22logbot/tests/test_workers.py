@@ -0,0 +1,63 @@
+import logging
+import threading
+from otp22logbot.workers import CommandPool
+
+
+class Conn(object):
+    def __init__(self):
+        self.sent = []
+
+    def privmsg_user(self, nick, text):
+        self.sent.append((nick, text))
+
+
+class Test_CommandPool(object):
+    logger = logging.getLogger("")
+
+    def test_runs_commands(self):
+        pool = CommandPool(self.logger, workers=2)
+        conn = Conn()
+        for i in range(5):
+            assert pool.submit(
+                'nick{0}'.format(i), 'hello',
+                lambda gated, i=i: gated.privmsg_user('x', str(i)),
+                conn) is None
+        pool.close()
+        assert sorted(text for _, text in conn.sent) == list('01234')
+        assert pool.stats['completed'] == 5
+
+    def test_refuses_when_full_or_greedy(self):
+        gate = threading.Event()
+        pool = CommandPool(self.logger, workers=1, queue_size=1,
+                           per_requester=1)
+        conn = Conn()
+
+        def wait(gated):
+            gate.wait()
+
+        assert pool.submit('a', 'wait', wait, conn) is None
+        assert pool.submit('a', 'wait', wait, conn) == 'requester'
+        assert pool.submit('b', 'wait', wait, conn) is None
+        assert pool.submit('c', 'wait', wait, conn) == 'busy'
+        gate.set()
+        pool.close()
+        assert pool.stats['rejected_busy'] == 1
+        assert pool.stats['rejected_requester'] == 1
+
+    def test_timeout_silences_late_replies(self):
+        gate = threading.Event()
+        timed_out = threading.Event()
+        pool = CommandPool(self.logger, workers=1, timeout=0.05)
+        conn = Conn()
+
+        def slow(gated):
+            timed_out.wait(5)
+            gated.privmsg_user('a', 'too late')
+            gate.set()
+
+        assert pool.submit('a', 'slow', slow, conn,
+                           on_timeout=timed_out.set) is None
+        assert gate.wait(5)
+        pool.close()
+        assert conn.sent == []
+        assert pool.stats['timed_out'] == 1
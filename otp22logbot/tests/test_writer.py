@@ -0,0 +1,88 @@
+import io
+import logging
+import pytest
+from otp22logbot.writer import LogWriter, QueueFull
+
+
+class Output(io.StringIO):
+    def __init__(self):
+        io.StringIO.__init__(self)
+        self.flushes = 0
+        self.contents = None
+
+    def flush(self):
+        self.flushes += 1
+
+    def close(self):
+        self.contents = self.getvalue()
+        io.StringIO.close(self)
+
+
+class Test_LogWriter(object):
+    logger = logging.getLogger("")
+
+    def test_writes_in_order_and_drains_on_close(self):
+        output = Output()
+        writer = LogWriter(output, self.logger, flush_lines=7)
+        writer.start()
+        lines = ["line {0}\n".format(i) for i in range(1000)]
+        for line in lines:
+            writer.write(line)
+        writer.close()
+        assert output.contents == "".join(lines)
+        assert writer.stats.lines == 1000
+        assert output.flushes >= 1
+
+    def test_call_runs_between_lines(self):
+        output = Output()
+        writer = LogWriter(output, self.logger)
+        seen = []
+        writer.start()
+        writer.write("a\n")
+        writer.call(lambda: seen.append(output.getvalue()))
+        writer.write("b\n")
+        writer.close()
+        assert seen == ["a\n"]
+        assert output.contents == "a\nb\n"
+
+    def test_failing_call_keeps_writing(self):
+        output = Output()
+        writer = LogWriter(output, self.logger)
+        writer.start()
+
+        def fail():
+            raise OSError("disk full")
+        writer.write("a\n")
+        writer.call(fail)
+        writer.write("b\n")
+        assert writer.sync(5)
+        writer.close()
+        assert output.contents == "a\nb\n"
+
+    def test_drop_when_full(self):
+        output = Output()
+        writer = LogWriter(output, self.logger, queue_size=2,
+                           overflow='drop')
+        assert writer.write("a\n")
+        assert writer.write("b\n")
+        assert not writer.write("c\n")
+        assert writer.stats.dropped == 1
+        writer.close()
+        assert output.contents == "a\nb\n"
+
+    def test_error_when_full(self):
+        writer = LogWriter(Output(), self.logger, queue_size=1,
+                           overflow='error')
+        writer.write("a\n")
+        with pytest.raises(QueueFull):
+            writer.write("b\n")
+
+    def test_sync_waits_for_flush(self):
+        output = Output()
+        writer = LogWriter(output, self.logger, flush_interval=60)
+        writer.start()
+        writer.write("a\n")
+        assert writer.sync(5)
+        assert output.getvalue() == "a\n"
+        assert output.flushes == 1
+        writer.close()
@@ -1,21 +1,85 @@
-from datetime import datetime as Datetime
+import collections
+import sys
+import time
+
+intern = sys.intern
 
 
 class User(object):
     """Information on one IRC user.
+
+    Kept small since there can be a lot of these: slots instead of a
+    dict, interned nick and channel names shared between all users,
+    channels as a tuple, and times as floats (seconds since the epoch).
     """
+    __slots__ = ('nick', 'channels', 'message', 'seen', 'time')
+
     def __init__(self, nick):
-        self.nicks = set([nick])
-        self.channels = set()
+        self.nick = intern(nick)
+        self.channels = ()
         self.message = None
+        # Last seen doing anything, and time of the last message.
         self.seen = None
         self.time = None
 
     def update(self, channels=None, message=None, now=None):
-        now = now or Datetime.utcnow()
+        now = now or time.time()
         if channels:
-            self.channels |= set(channels)
+            known = self.channels
+            new = tuple(intern(channel) for channel in channels
+                        if channel not in known)
+            if new:
+                self.channels = known + new
         if message:
             self.message = message
+            self.time = now
         self.seen = now
-        self.time = now
+
+
+class UserRegistry(object):
+    """Users by nick, evicting the least recently active past max_size.
+
+    max_size of 0 or None means no limit.
+    """
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.users = collections.OrderedDict()
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.users)
+
+    def __contains__(self, nick):
+        return nick in self.users
+
+    def __iter__(self):
+        return iter(self.users.values())
+
+    def get(self, nick):
+        """Look a user up without counting it as activity.
+        """
+        return self.users.get(nick)
+
+    def touch(self, nick):
+        """Get the user for some activity, creating it if needed.
+        """
+        users = self.users
+        user = users.get(nick)
+        if user is not None:
+            users.move_to_end(nick)
+            return user
+        user = User(nick)
+        users[user.nick] = user
+        if self.max_size and len(users) > self.max_size:
+            users.popitem(last=False)
+            self.evicted += 1
+        return user
+
+    def add(self, user):
+        """Put an existing User in, as the most recently active.
+        """
+        self.users[user.nick] = user
+        self.users.move_to_end(user.nick)
+        if self.max_size and len(self.users) > self.max_size:
+            self.users.popitem(last=False)
+            self.evicted += 1
@@ -0,0 +1,147 @@
+import collections
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class GatedConnection(object):
+    """Stand-in for a Connection, given to one command.
+
+    Once the command has timed out its late replies are dropped, so the
+    requester doesn't get an answer after being told it timed out.
+    """
+    gated = frozenset(['send', 'privmsg_user', 'privmsg_channel', 'notice'])
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.expired = False
+
+    def __getattr__(self, name):
+        attr = getattr(self.conn, name)
+        if name not in self.gated:
+            return attr
+
+        def gated(*args, **kwargs):
+            if not self.expired:
+                return attr(*args, **kwargs)
+        return gated
+
+
+class Job(object):
+    __slots__ = ('requester', 'function', 'on_timeout', 'conn', 'done',
+                 'name')
+
+    def __init__(self, requester, name, function, on_timeout, conn):
+        self.requester = requester
+        self.name = name
+        self.function = function
+        self.on_timeout = on_timeout
+        self.conn = conn
+        self.done = False
+
+
+class CommandPool(object):
+    """Run commands on a bounded pool of worker threads.
+
+    At most workers commands run at once and queue_size more may wait;
+    beyond that, or beyond per_requester running or waiting commands
+    from one nick, submit() refuses. A command still running timeout
+    seconds after it started is reported through its on_timeout and its
+    connection is gated (see GatedConnection). Python can't stop the
+    thread, so it keeps its worker until it returns.
+    """
+    def __init__(self, logger, workers=4, queue_size=32, timeout=10.0,
+                 per_requester=2):
+        self.logger = logger
+        self.capacity = workers + queue_size
+        self.timeout = timeout
+        self.per_requester = per_requester
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="otp22logbot-command")
+        self.condition = threading.Condition()
+        self.pending = 0
+        self.active = collections.Counter()
+        self.deadlines = []
+        self.sequence = itertools.count()
+        self.closed = False
+        self.stats = collections.Counter()
+        self.watchdog = threading.Thread(
+            target=self.watch, name="otp22logbot-command-watchdog")
+        self.watchdog.daemon = True
+        self.watchdog.start()
+
+    def submit(self, requester, name, function, conn, on_timeout=None):
+        """Queue function(gated_conn) to run. Returns None if accepted,
+        else the reason it was refused: 'busy' or 'requester'.
+        """
+        with self.condition:
+            if self.closed or self.pending >= self.capacity:
+                self.stats['rejected_busy'] += 1
+                return 'busy'
+            if self.active[requester] >= self.per_requester:
+                self.stats['rejected_requester'] += 1
+                return 'requester'
+            self.pending += 1
+            self.active[requester] += 1
+            self.stats['submitted'] += 1
+        job = Job(requester, name, function, on_timeout,
+                  GatedConnection(conn))
+        self.executor.submit(self.run, job)
+        return None
+
+    def run(self, job):
+        if self.timeout:
+            with self.condition:
+                heapq.heappush(self.deadlines, (
+                    time.monotonic() + self.timeout, next(self.sequence),
+                    job))
+                self.condition.notify()
+        try:
+            job.function(job.conn)
+        except Exception:
+            self.logger.exception("error running {0} for {1}"
+                                  .format(job.name, job.requester))
+            self.stats['failed'] += 1
+        finally:
+            with self.condition:
+                job.done = True
+                self.pending -= 1
+                self.active[job.requester] -= 1
+                if not self.active[job.requester]:
+                    del self.active[job.requester]
+                self.stats['completed'] += 1
+
+    def watch(self):
+        while True:
+            expired = []
+            with self.condition:
+                while not self.closed and not self.deadlines:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                now = time.monotonic()
+                while self.deadlines and self.deadlines[0][0] <= now:
+                    _, _, job = heapq.heappop(self.deadlines)
+                    if not job.done:
+                        expired.append(job)
+                if not expired and self.deadlines:
+                    self.condition.wait(self.deadlines[0][0] - now)
+            for job in expired:
+                self.stats['timed_out'] += 1
+                job.conn.expired = True
+                self.logger.info("{0} for {1} timed out".format(
+                    job.name, job.requester))
+                if job.on_timeout:
+                    try:
+                        job.on_timeout()
+                    except Exception:
+                        self.logger.exception("error reporting timeout")
+
+    def close(self, wait=True):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.executor.shutdown(wait=wait)
+        self.watchdog.join()
@@ -0,0 +1,262 @@
+import collections
+import os
+import threading
+import time
+from otp22logbot import metrics
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class QueueFull(Exception):
+    """The writer queue is full and the overflow policy is to refuse.
+    """
+
+
+class WriterStats(object):
+    """Counters for tuning the writer's batching.
+    """
+    def __init__(self):
+        self.lines = 0
+        self.batches = 0
+        self.dropped = 0
+        self.flushes = 0
+        self.max_batch = 0
+        self.write_time = 0.0
+        self.max_write_time = 0.0
+        self.flush_time = 0.0
+
+    def record(self, size, elapsed):
+        self.lines += size
+        self.batches += 1
+        self.max_batch = max(self.max_batch, size)
+        self.write_time += elapsed
+        self.max_write_time = max(self.max_write_time, elapsed)
+
+    def as_dict(self):
+        batches = self.batches or 1
+        return {
+            'lines': self.lines,
+            'batches': self.batches,
+            'dropped': self.dropped,
+            'flushes': self.flushes,
+            'max_batch': self.max_batch,
+            'mean_batch': self.lines / batches,
+            'mean_write_ms': self.write_time * 1000 / batches,
+            'max_write_ms': self.max_write_time * 1000,
+            'mean_flush_ms': self.flush_time * 1000 / (self.flushes or 1),
+        }
+
+
+class LogWriter(object):
+    """Write log lines to a file from a background thread.
+
+    Lines are queued by write() and written in batches ("group
+    commits"), so the receive loop never waits on the disk. The file is
+    flushed once flush_lines lines have been written since the last
+    flush, or flush_interval seconds have passed, whichever is first;
+    with fsync=True every flush is also fsynced.
+
+    The queue holds at most queue_size lines. When it is full, overflow
+    decides what write() does: 'block' waits for room, 'drop' discards
+    the line and counts it, 'error' raises QueueFull.
+    """
+    overflows = ('block', 'drop', 'error')
+
+    def __init__(self, output, logger, flush_lines=100, flush_interval=0.2,
+                 fsync=False, queue_size=10000, overflow='block'):
+        assert overflow in self.overflows, overflow
+        self.output = output
+        self.logger = logger
+        self.flush_lines = max(1, flush_lines)
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.overflow = overflow
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stats = WriterStats()
+        self.thread = None
+        self.closed = False
+        # Lines written but not yet flushed, and when we last flushed.
+        self.pending = 0
+        self.last_commit = time.time()
+
+    def start(self):
+        if self.thread:
+            return
+        self.thread = threading.Thread(
+            target=self.run, name="otp22logbot-writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, line, key=None):
+        """Queue one line (including its newline) for writing.
+
+        With a key, the line goes to the output's write_shard(key, ...)
+        instead of its write(); see logfile.ShardedLog.
+        """
+        assert not self.closed, "write after close"
+        if key is not None:
+            line = (key, line)
+        if self.overflow == 'block':
+            self.queue.put(line)
+            return True
+        try:
+            self.queue.put_nowait(line)
+        except queue.Full:
+            if self.overflow == 'error':
+                raise QueueFull(line)
+            self.stats.dropped += 1
+            return False
+        return True
+
+    def call(self, function):
+        """Run function on the writer thread, in order with the lines.
+
+        Lets the file be swapped or inspected without racing the
+        writer. Blocks for queue room like any write.
+        """
+        self.queue.put(function)
+
+    def sync(self, timeout=None):
+        """Wait until every line queued so far is written and flushed.
+
+        Returns False if that took longer than timeout.
+        """
+        if self.closed:
+            return True
+        if not self.thread:
+            self.drain()
+            self.commit()
+            return True
+        done = threading.Event()
+
+        def commit():
+            try:
+                self.commit()
+            except (IOError, OSError, ValueError):
+                self.logger.exception("error flushing log")
+            finally:
+                done.set()
+        self.call(commit)
+        return done.wait(timeout)
+
+    def close(self):
+        """Write everything still queued, flush and close the file.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join()
+        else:
+            self.drain()
+            self.commit()
+        self.output.close()
+
+    def drain(self):
+        batch = []
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                break
+            self.handle(item, batch)
+        self.write_batch(batch)
+
+    def handle(self, item, batch):
+        if callable(item):
+            try:
+                self.write_batch(batch)
+            except (IOError, OSError, ValueError):
+                self.logger.exception("error writing log batch")
+            del batch[:]
+            try:
+                item()
+            except Exception:
+                # The thread has to outlive it: if it died, the queue
+                # would fill up and block whoever writes to it.
+                self.logger.exception("error in queued call")
+        else:
+            batch.append(item)
+
+    def write_batch(self, batch):
+        if not batch:
+            return
+        start = time.time()
+        shards = None
+        lines = []
+        for item in batch:
+            if isinstance(item, tuple):
+                shards = shards or collections.OrderedDict()
+                shards.setdefault(item[0], []).append(item[1])
+            else:
+                lines.append(item)
+        if lines:
+            self.output.write("".join(lines))
+        if shards:
+            for key, shard_lines in shards.items():
+                self.output.write_shard(key, "".join(shard_lines))
+        elapsed = time.time() - start
+        self.stats.record(len(batch), elapsed)
+        if metrics.enabled:
+            metrics.LOG_BATCH_SECONDS.observe(elapsed)
+        self.pending += len(batch)
+
+    def commit(self):
+        if not self.pending:
+            return
+        start = time.time()
+        self.output.flush()
+        if self.fsync:
+            try:
+                if hasattr(self.output, 'fsync'):
+                    self.output.fsync()
+                else:
+                    os.fsync(self.output.fileno())
+            except (AttributeError, OSError, ValueError):
+                self.logger.exception("fsync failed")
+        self.stats.flushes += 1
+        self.stats.flush_time += time.time() - start
+        self.pending = 0
+        self.last_commit = time.time()
+
+    def run(self):
+        self.last_commit = time.time()
+        done = False
+        while not done:
+            timeout = None
+            if self.pending:
+                timeout = max(
+                    0, self.last_commit + self.flush_interval - time.time())
+            batch = []
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = False
+            if item is None:
+                done = True
+            elif item is not False:
+                self.handle(item, batch)
+                # Take whatever else has piled up, up to one commit's
+                # worth, without waiting.
+                while len(batch) < self.flush_lines:
+                    try:
+                        item = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        done = True
+                        break
+                    self.handle(item, batch)
+            try:
+                self.write_batch(batch)
+                if (done or self.pending >= self.flush_lines or
+                        time.time() - self.last_commit
+                        >= self.flush_interval):
+                    self.commit()
+            except (IOError, OSError, ValueError):
+                self.logger.exception("error writing log batch")
@@ -9,9 +9,22 @@ setup(
     description="Simple logging bot",
     license="BSD3",
     packages=['otp22logbot'],
-    scripts=['scripts/otp22logbot'],
+    scripts=[
+        'scripts/otp22logbot',
+        'scripts/otp22logbot-fakeserver',
+        'scripts/otp22logbot-reindex',
+        'scripts/otp22logbot-segment',
+        'scripts/otp22logbot-stats',
+    ],
     classifiers=[
         "This line prevents release on PyPI",
-        "Programming Language :: Python :: 3.4",
+        "Programming Language :: Python :: 3",
+        "Programming Language :: Python :: 3 :: Only",
+        "Programming Language :: Python :: 3.7",
+        "Programming Language :: Python :: 3.8",
+        "Programming Language :: Python :: 3.9",
+        "Programming Language :: Python :: 3.10",
+        "Programming Language :: Python :: 3.11",
+        "Programming Language :: Python :: 3.12",
     ]
 )